@@ -42,6 +42,10 @@ from rascil.workflows.serial.imaging.imaging_serial import weight_list_serial_wo
 from workflows.rsexecute.execution_support.rsexecute import rsexecute
 from workflows.rsexecute.execution_support.dask_init import get_dask_client
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mid_pointing.cache import ProductCache, hash_inputs, hash_file
+from mid_pointing.residual import calculate_residual_visibility
+
 import logging
 
 log = logging.getLogger()
@@ -85,6 +89,9 @@ if __name__ == '__main__':
     parser.add_argument('--integration_time', type=float, default=43200.0/65.0, help="Integration time (s)")
     parser.add_argument('--time_range', type=float, nargs=2, default=[-6.0, 6.0], help="Hourangle range (hours")
     parser.add_argument('--time_series', type=str, default='', help="'wind' or 'tracking' or ''")
+    parser.add_argument('--cache_directory', type=str, default='',
+                        help='Directory for cache of error-free products (none if empty)')
+    parser.add_argument('--cache_size', type=float, default=100.0, help='Maximum size of cache (GB)')
 
     args = parser.parse_args()
     
@@ -242,21 +249,39 @@ if __name__ == '__main__':
         # Primary beam points to the phasecentre
         offset_direction = SkyCoord(ra=+15.0 * u.deg, dec=-45.0 * u.deg, frame='icrs', equinox='J2000')
     
-    # Uniform weighting
-    psf = create_image_from_visibility(vis, npixel=npixel, frequency=frequency,
-                                       nchan=nfreqwin, cellsize=cellsize, phasecentre=phasecentre,
-                                       polarisation_frame=PolarisationFrame("stokesI"))
+    # The weighted visibilities, PSF and error-free visibilities do not depend on the pointing errors
+    if args.cache_directory != '':
+        cache = ProductCache(args.cache_directory, max_size=args.cache_size)
+        no_error_key = hash_inputs(rmax=rmax, times=numpy.array(times), frequency=frequency, phasecentre=phasecentre,
+                                   components=original_components, pbtype=pbtype, use_radec=use_radec,
+                                   use_natural=use_natural, npixel=npixel, pb_npixel=pb_npixel,
+                                   pb_cellsize=pb_cellsize, configuration=hash_file('../../shared/ska1mid_local.cfg'))
+        cached_no_error = cache.load(no_error_key, 'no_error')
+    else:
+        cache = None
+        cached_no_error = None
 
-    if use_natural:
-        print("Using natural weighting")
+    if cached_no_error is None:
+        # Uniform weighting
+        psf = create_image_from_visibility(vis, npixel=npixel, frequency=frequency,
+                                           nchan=nfreqwin, cellsize=cellsize, phasecentre=phasecentre,
+                                           polarisation_frame=PolarisationFrame("stokesI"))
+    
+        if use_natural:
+            print("Using natural weighting")
+        else:
+            print("Using uniform weighting")
+            vis = weight_list_serial_workflow([vis], [psf])[0]
+            block_vis = convert_visibility_to_blockvisibility(vis)
+        
+        print("Inverting to get on-source PSF")
+        psf_list = invert_list_rsexecute_workflow([vis], [psf], '2d', dopsf=True)
+        psf, sumwt = rsexecute.compute(psf_list, sync=True)[0]
     else:
-        print("Using uniform weighting")
-        vis = weight_list_serial_workflow([vis], [psf])[0]
-        block_vis = convert_visibility_to_blockvisibility(vis)
-    
-    print("Inverting to get on-source PSF")
-    psf_list = invert_list_rsexecute_workflow([vis], [psf], '2d', dopsf=True)
-    psf, sumwt = rsexecute.compute(psf_list, sync=True)[0]
+        print("Using weighted visibilities, PSF and error-free visibilities from cache")
+        vis = cached_no_error['vis']
+        block_vis = cached_no_error['block_vis']
+        psf = cached_no_error['psf']
     export_image_to_fits(psf, 'PSF_rascil.fits')
     if show:
         show_image(psf, cm='gray_r', title='PSF', vmin=-0.01, vmax=0.1)
@@ -285,32 +310,43 @@ if __name__ == '__main__':
     print("Voltage pattern:", vp)
     pt = create_pointingtable_from_blockvisibility(block_vis)
     
+    # The error-free gaintables are also needed for the differential prediction of each pointing error
     no_error_pt = simulate_pointingtable(pt, 0.0, 0.0)
-
     export_pointingtable_to_hdf5(no_error_pt, 'pointingsim_%s_noerror_pointingtable.hdf5' % context)
     no_error_gt = simulate_gaintable_from_pointingtable(block_vis, original_components, no_error_pt, vp,
                                                         use_radec=use_radec)
-    # Each component in original components becomes a separate skymodel
-    no_error_sm = [SkyModel(components=[original_components[i]], gaintable=no_error_gt[i])
-                   for i, _ in enumerate(original_components)]
-    
-    # We do this in chunks of eight to avoid creating all visibilities at once
-    no_error_blockvis = copy_visibility(block_vis, zero=True)
-    
-    print("Predicting error-free visibilities in chunks of %d skymodels" % ngroup)
-    future_vis = rsexecute.scatter(no_error_blockvis)
-    chunks = [no_error_sm[i:i + ngroup] for i in range(0, len(no_error_sm), ngroup)]
-    for chunk in chunks:
-        temp_vis = predict_skymodel_list_compsonly_rsexecute_workflow(future_vis, chunk, context='2d', docal=True)
-        work_vis = rsexecute.compute(temp_vis, sync=True)
-        for w in work_vis:
-            no_error_blockvis.data['vis'] += w.data['vis']
-        assert numpy.max(numpy.abs(no_error_blockvis.data['vis'])) > 0.0
+    
+    if cached_no_error is None:
+        # Each component in original components becomes a separate skymodel
+        no_error_sm = [SkyModel(components=[original_components[i]], gaintable=no_error_gt[i])
+                       for i, _ in enumerate(original_components)]
+        
+        # We do this in chunks of eight to avoid creating all visibilities at once
+        no_error_blockvis = copy_visibility(block_vis, zero=True)
+        
+        print("Predicting error-free visibilities in chunks of %d skymodels" % ngroup)
+        future_vis = rsexecute.scatter(no_error_blockvis)
+        chunks = [no_error_sm[i:i + ngroup] for i in range(0, len(no_error_sm), ngroup)]
+        for chunk in chunks:
+            temp_vis = predict_skymodel_list_compsonly_rsexecute_workflow(future_vis, chunk, context='2d', docal=True)
+            work_vis = rsexecute.compute(temp_vis, sync=True)
+            for w in work_vis:
+                no_error_blockvis.data['vis'] += w.data['vis']
+            assert numpy.max(numpy.abs(no_error_blockvis.data['vis'])) > 0.0
+        
+        if cache is not None:
+            cache.save(no_error_key, 'no_error', {'vis': vis, 'block_vis': block_vis, 'psf': psf,
+                                                  'no_error_blockvis': no_error_blockvis})
+    else:
+        no_error_blockvis = cached_no_error['no_error_blockvis']
+        del cached_no_error
     
     no_error_vis = convert_blockvisibility_to_visibility(no_error_blockvis)
     print("Inverting to get dirty image")
     dirty_list = invert_list_rsexecute_workflow([no_error_vis], [model], '2d')
     dirty, sumwt = rsexecute.compute(dirty_list, sync=True)[0]
+    # The error-free visibilities are not needed for the differential prediction
+    del no_error_vis, no_error_blockvis
     print(qa_image(dirty))
     export_image_to_fits(dirty, 'dirty_rascil.fits')
     if show:
@@ -393,21 +429,18 @@ if __name__ == '__main__':
         error_gt = simulate_gaintable_from_pointingtable(block_vis, original_components, error_pt, vp,
                                                          use_radec=use_radec)
         
-        error_sm = [SkyModel(components=[original_components[i]], gaintable=error_gt[i])
-                    for i, _ in enumerate(original_components)]
-        
+        # Predict the error minus error-free visibilities directly, (g_err g_err* - g0 g0*) x DFT, rather than
+        # predicting the corrupted visibilities and subtracting the error-free ones
         error_blockvis = copy_visibility(block_vis, zero=True)
         
-        print("Predicting corrupted visibilities in chunks of %d skymodels" % ngroup)
+        print("Predicting differential visibilities in chunks of %d components" % ngroup)
         future_vis = rsexecute.scatter(error_blockvis)
-        chunks = [error_sm[i:i + ngroup] for i in range(0, len(error_sm), ngroup)]
-        for chunk in chunks:
-            temp_vis = predict_skymodel_list_compsonly_rsexecute_workflow(future_vis, chunk, context='2d', docal=True)
-            work_vis = rsexecute.compute(temp_vis, sync=True)
-            for w in work_vis:
-                error_blockvis.data['vis'] += w.data['vis']
-            assert numpy.max(numpy.abs(error_blockvis.data['vis'])) > 0.0
-        error_blockvis.data['vis'] -= no_error_blockvis.data['vis']
+        for i in range(0, len(original_components), ngroup):
+            temp_vis = rsexecute.execute(calculate_residual_visibility)(future_vis, original_components[i:i + ngroup],
+                                                                        no_error_gt[i:i + ngroup],
+                                                                        error_gt[i:i + ngroup])
+            w = rsexecute.compute(temp_vis, sync=True)
+            error_blockvis.data['vis'] += w.data['vis']
         
         error_blockvis = addnoise_visibility(error_blockvis, tsys)
         
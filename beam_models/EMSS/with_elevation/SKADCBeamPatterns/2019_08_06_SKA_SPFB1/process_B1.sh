@@ -1,6 +1,6 @@
 #!/bin/bash
 
-rm *.mat *.png *.fits interpolated/*.fits
+rm *.mat *.png *.h5
 rm -r 2019_08_06_SKA_15_B1
 rm -r 2019_08_06_SKA_45_B1
 rm -r 2019_08_06_SKA_90_B1
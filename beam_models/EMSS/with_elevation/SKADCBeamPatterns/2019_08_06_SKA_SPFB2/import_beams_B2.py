@@ -1,203 +1,49 @@
 #!/usr/bin/env python3
+"""Import the EMSS band 2 beams into a voltage pattern cube
 
-import matplotlib as mpl
-import astropy.constants as constants
-import numpy as np
-import scipy.interpolate
-import numpy.fft
-import scipy.io
+Run in this directory once the .mat files are unzipped (see process_B2.sh)::
 
-mpl.use('agg')
-import matplotlib.pyplot as plt
+    python import_beams_B2.py --nprocesses 8 --plot True
 
-import numpy
+Beams already in the cube <band>_beams.h5 are skipped unless --overwrite True is given. --fit True also fits each
+beam with Zernike polynomials into <band>_beam_fits.h5, to within --fit_tolerance of the peak at every tabulated point.
+"""
 
-from astropy.wcs import WCS
+import argparse
+import os
+import sys
 
-from rascil.data_models.polarisation import PolarisationFrame
-
-from processing_library.image.operations import create_image_from_array
-from rascil.processing_components.image.operations import export_image_to_fits
-
-
-def create_rascil_image(pol_planes, cellsize, frequency, channel_bandwidth=1e6, shift_peak=False):
-    ny, nx = pol_planes[0].shape
-    
-    assert len(pol_planes) == 4
-    
-    w = WCS(naxis=4)
-    # The negation in the longitude is needed by definition of RA, DEC
-    w.wcs.cdelt = [-cellsize, cellsize, -1.0, channel_bandwidth]
-    w.wcs.crpix = [nx // 2, ny // 2, 1.0, 1.0]
-    w.wcs.ctype = ['AZELGEO long', 'AZELGEO lati', 'STOKES', 'FREQ']
-    w.wcs.crval = [0.0, 0.0, -5.0, frequency]
-    w.wcs.cunit = ['deg', 'deg', '', 'Hz']
-    w.naxis = 4
-    w.wcs.radesys = 'ICRS'
-    w.wcs.equinox = 2000.0
-    
-    beam_out = numpy.zeros([1, 4, ny, nx], dtype=complex)
-    for pol in range(4):
-        beam_out[0, pol, ...] = numpy.transpose(pol_planes[pol])
-    
-    # The following transforms are guessed to provide realistic looking beams
-    # 1. Renormalise
-    beam_out /= numpy.max(numpy.abs(beam_out))
-    # 2. Remove phase error in image plane
-    beam_out *= numpy.conjugate(beam_out[0, 0, ny // 2, nx // 2])
-
-    # 3. Remove phase gradient in image plane
-    dy = numpy.mod(numpy.angle(beam_out[0, 0, ny//2 + 1, nx // 2]) -
-                   numpy.angle(beam_out[0, 0, ny//2 - 1, nx // 2]), numpy.pi) / 2.0
-    wave = constants.c.value/frequency
-    print(dy * wave / cellsize)
-    rotator = numpy.exp(-1.0j * dy * (numpy.arange(ny) - ny / 2.0))
-    beam_out *= rotator[numpy.newaxis, numpy.newaxis, :, numpy.newaxis]
-    for pol in [1, 3]:
-        beam_out[:, pol, ...] = -1.0 * beam_out[:, pol, ...]
-        
-    # FFT interpolate to get peak on nx//2, ny//2
-    if shift_peak:
-        power_beam = beam_out * numpy.conjugate(beam_out)
-        peak_ind = numpy.argmax(power_beam)
-        peak_loc = numpy.unravel_index(peak_ind, power_beam.shape)
-        shifty = peak_loc[2]-ny//2+1
-        print("Shift in y is", shifty)
-        
-        beam_out = numpy.roll(beam_out, -shifty, axis=2)
-
-        power_beam = beam_out * numpy.conjugate(beam_out)
-        peak_ind = numpy.argmax(power_beam)
-        peak_loc = numpy.unravel_index(peak_ind, power_beam.shape)
-        shifty = peak_loc[2]-ny//2+1
-        assert shifty == 0
-
-
-
-    vp_real = create_image_from_array(beam_out.real, w, polarisation_frame=PolarisationFrame("linear"))
-    vp_imag = create_image_from_array(beam_out.imag, w, polarisation_frame=PolarisationFrame("linear"))
-    vp_amp = create_image_from_array(numpy.abs(beam_out), w, polarisation_frame=PolarisationFrame("linear"))
-    vp_phase = create_image_from_array(numpy.angle(beam_out), w, polarisation_frame=PolarisationFrame("linear"))
-    
-    return vp_real, vp_imag, vp_amp, vp_phase
-
-
-def interpolate_beam(th, ph, beam_inp, n, extent):
-    nx, ny = n
-    xmin, xmax, ymin, ymax = extent
-    
-    # Set x and y values of output grid.
-    
-    x = np.linspace(xmin, xmax, nx)
-    y = np.linspace(ymin, ymax, ny)
-    
-    # Make x and y into 2D grids and flatten into 1D arrays.
-    
-    x2, y2 = np.meshgrid(x, y)
-    x2.shape = (-1,)
-    y2.shape = (-1,)
-    
-    # Get (th, ph) values of (x, y) grid points assuming
-    #
-    # x = th * cos(ph)
-    # y = th * sin(ph)
-    
-    thi = np.sqrt(x2 ** 2 + y2 ** 2)
-    phi = np.mod(np.degrees(np.arctan2(y2, x2)), 360.0)
-    xi = np.stack((thi, phi), axis=1)
-    
-    # Interpolate real and imaginary parts separately then combine.
-    
-    tmp_real = scipy.interpolate.interpn((th, ph), beam_inp.real, xi, method="splinef2d")
-    tmp_imag = scipy.interpolate.interpn((th, ph), beam_inp.imag, xi, method="splinef2d")
-    beam_out = tmp_real + 1j * tmp_imag
-    
-    # Reshape output into 2D image.
-    
-    beam_out.shape = (nx, ny)
-    
-    return beam_out
-
-
-def plot_beam(beam, title, extent):
-    fig, axes = plt.subplots(2, 2, sharex=True, sharey=True)
-    fig.suptitle(title)
-    
-    ax = axes[0, 0]
-    ax.set_title('real')
-    ax.set_ylabel('y / deg')
-    im = ax.imshow(beam.real, extent=extent, origin='lower')
-    fig.colorbar(im, ax=ax)
-    
-    ax = axes[0, 1]
-    ax.set_title('imag')
-    im = ax.imshow(beam.imag, extent=extent, origin='lower')
-    fig.colorbar(im, ax=ax)
-    
-    ax = axes[1, 0]
-    ax.set_xlabel('x / deg')
-    ax.set_ylabel('y / deg')
-    ax.set_title('amplitude')
-    im = ax.imshow(np.abs(beam), extent=extent, origin='lower')
-    fig.colorbar(im, ax=ax)
-    
-    ax = axes[1, 1]
-    ax.set_title('phase')
-    ax.set_xlabel('x / deg')
-    im = ax.imshow(np.angle(beam, deg=True), extent=extent, origin='lower')
-    fig.colorbar(im, ax=ax)
-
-
-iform = '{b}_{e}_{f}.mat'
-oform = '{b}_{e}_{f:04d}_{j}.png'
-tform = 'band = {b}, elev = {e} deg, freq = {f} MHz, jones = {j}'
-fitsform = '{b}_{e}_{f:04d}_{t}.fits'
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', '..', '..'))
+from mid_pointing.beam_import import import_beams, plot_imported_beams
+from mid_pointing.beam_fit import fit_beams
 
 # n = nx, ny
 # extent = xmin, xmax, ymin, ymax
 
 n = 1024, 1024
 extent = -4.0, 4.0, -4.0, 4.0
-cellsize = 8 / n[0]
-
-# band = [('B1', [365, 415, 465, 515, 565, 615, 665, 715, 765, 815, 865,
-#                915, 965, 1015, 1050]),
-#        ('B2', [965, 1000, 1060, 110, 1160,
-#                1220, 1252, 1310, 1360, 1410, 1460, 1510, 1610, 1660, 1710,
-#                1760]),
-#        ('Ku', [11452, 11697, 11699, 11700, 12179, 12251, '12501_5'])]
 
 band = [('B2', [965, 1000, 1060, 1100, 1160, 1220, 1252, 1310, 1360,
                 1410, 1460, 1510, 1610, 1660, 1710, 1760])]
-#band = [('B2', [1360])]
 
 elev = [15, 45, 90]
-jones = ['Jpv', 'Jqh', 'Jph', 'Jqv']
 
-for b, freq in band:
-    for e in elev:
-        for f in freq:
-            
-            print(b, e, f)
-            ifile = iform.format(b=b, e=e, f=f)
-            data = scipy.io.loadmat(ifile)
-            ph = data['ph'].squeeze()
-            th = data['th'].squeeze()
-            
-            pol_planes = list()
-            for j in jones:
-                print(b, e, f, j)
-                ofile = oform.format(b=b, e=e, f=f, j=j)
-                title = tform.format(b=b, e=e, f=f, j=j)
-                beam_inp = data[j]
-                beam_out = interpolate_beam(th, ph, beam_inp, n, extent)
-                pol_planes.append(beam_out)
-                plot_beam(beam_out, title, extent)
-                plt.savefig(ofile)
-                plt.close()
-            
-            vp_real, vp_imag, vp_amp, vp_phase = create_rascil_image(pol_planes, cellsize, f*1e6, shift_peak=True)
-            export_image_to_fits(vp_real, fitsform.format(b=b, e=e, f=f, t='real'))
-            export_image_to_fits(vp_imag, fitsform.format(b=b, e=e, f=f, t='imag'))
- #           export_image_to_fits(vp_amp, fitsform.format(b=b, e=e, f=f, t='amp'))
- #           export_image_to_fits(vp_phase, fitsform.format(b=b, e=e, f=f, t='phase'))
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import the EMSS band 2 beams')
+    parser.add_argument('--nprocesses', type=int, default=None, help='Number of processes (default number of CPUs)')
+    parser.add_argument('--plot', type=str, default='False', help='Plot the beams after importing them?')
+    parser.add_argument('--plot_only', type=str, default='False', help='Only plot the beams already imported?')
+    parser.add_argument('--overwrite', type=str, default='False', help='Remake outputs that exist?')
+    parser.add_argument('--fit', type=str, default='False', help='Fit the beams with Zernike polynomials?')
+    parser.add_argument('--fit_tolerance', type=float, default=1e-3,
+                        help='Largest residual of the fits at the tabulated points, relative to the peak')
+    args = parser.parse_args()
+
+    if args.plot_only == 'True':
+        plot_imported_beams(band, elev, extent, nprocesses=args.nprocesses, overwrite=args.overwrite == 'True')
+    else:
+        import_beams(band, elev, n, extent, nprocesses=args.nprocesses, plot=args.plot == 'True',
+                     overwrite=args.overwrite == 'True')
+    if args.fit == 'True':
+        fit_beams(band, elev, n, extent, tolerance=args.fit_tolerance, nprocesses=args.nprocesses,
+                  overwrite=args.overwrite == 'True')
@@ -0,0 +1,38 @@
+""" Support for the distributed pointing error simulations of SKA-MID
+
+The functions here are layered on RASCIL and follow its conventions: processing functions operate on RASCIL data
+models and the rsexecute workflows return lists of graphs.
+
+The modules that need only numpy, scipy and astropy are imported here. Those that import RASCIL are imported when
+one of their names is first used, e.g. by ``from mid_pointing import plan_simulation``, so that the others (and
+their tests) can be used where RASCIL is not installed.
+"""
+
+import importlib
+
+from .file_support import *
+from .process_pool import *
+from .seeding import *
+from .cache import *
+from .psd import *
+from .timeseries import *
+from .dft import *
+from .beams import *
+from .vp_sampler import *
+
+# Modules that import RASCIL, searched in this order for a name not yet found
+_RASCIL_MODULES = ['pointing', 'workflows', 'checkpoint', 'residual', 'planner', 'instrumentation', 'beam_cube',
+                   'beam_import', 'voltage_pattern', 'beam_fit']
+
+
+def __getattr__(name):
+    """ Import a name from the modules that import RASCIL on first use
+    """
+    if not name.startswith('__'):
+        for module_name in _RASCIL_MODULES:
+            module = importlib.import_module('.' + module_name, __name__)
+            if name in module.__all__:
+                value = getattr(module, name)
+                globals()[name] = value
+                return value
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
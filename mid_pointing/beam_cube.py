@@ -0,0 +1,144 @@
+"""Chunked, compressed HDF5 cube of the voltage patterns of one band
+
+The imported beams of a band are held in one HDF5 file as a complex64 dataset 'vp' with axes (frequency, elevation,
+pol, y, x), chunked so that each chunk holds all four polarisations of a 256 x 256 tile of one frequency and
+elevation, and compressed. The tabulated frequencies (Hz) and elevations (deg) are datasets of the same name, a
+boolean dataset 'written' records which planes have been filled, and the FITS header of the WCS of the image axes
+(as for a RASCIL voltage pattern image) is the attribute 'wcs'. The frequency axis of the WCS is set for each plane.
+
+BeamCube reads one frequency and elevation plane at a time, so a worker reads only the plane it needs.
+"""
+
+__all__ = ['create_beam_cube', 'write_beam_plane', 'BeamCube']
+
+import logging
+
+import h5py
+import numpy
+from astropy.io import fits
+from astropy.wcs import WCS
+
+from processing_library.image.operations import create_image_from_array
+from rascil.data_models.polarisation import PolarisationFrame
+
+log = logging.getLogger(__name__)
+
+BEAM_CUBE_AXES = ('frequency', 'elevation', 'pol', 'y', 'x')
+
+# Pixels along each image axis of a chunk
+CHUNK_SIZE = 256
+
+
+def create_beam_cube(filename, frequencies, elevations, wcs, shape):
+    """ Create an empty beam cube, replacing any existing file
+
+    :param filename: Name of the HDF5 file
+    :param frequencies: Frequencies (Hz)
+    :param elevations: Elevations (deg)
+    :param wcs: WCS of the image axes (x, y, pol, frequency) as for a voltage pattern image
+    :param shape: Image shape (ny, nx)
+    """
+    ny, nx = shape
+    with h5py.File(filename, 'w') as f:
+        f.create_dataset('frequency', data=numpy.array(frequencies, dtype='float64'))
+        f.create_dataset('elevation', data=numpy.array(elevations, dtype='float64'))
+        f.create_dataset('written', data=numpy.zeros([len(frequencies), len(elevations)], dtype='bool'))
+        vp = f.create_dataset('vp', shape=(len(frequencies), len(elevations), 4, ny, nx), dtype='complex64',
+                              chunks=(1, 1, 4, min(ny, CHUNK_SIZE), min(nx, CHUNK_SIZE)), compression='gzip',
+                              compression_opts=4, shuffle=True)
+        vp.attrs['axes'] = ','.join(BEAM_CUBE_AXES)
+        vp.attrs['wcs'] = wcs.to_header_string()
+
+
+def _index(values, value, name):
+    """ Index of a tabulated value
+    """
+    matches = numpy.nonzero(numpy.isclose(values, value, rtol=1e-9, atol=1e-6))[0]
+    if len(matches) == 0:
+        raise ValueError("Beam cube: %s %s is not tabulated" % (name, value))
+    return int(matches[0])
+
+
+def write_beam_plane(filename, frequency, elevation, planes):
+    """ Write the voltage pattern of one frequency and elevation into a beam cube
+
+    :param filename: Name of the HDF5 file
+    :param frequency: Frequency (Hz)
+    :param elevation: Elevation (deg)
+    :param planes: Voltage pattern [4, ny, nx]
+    """
+    with h5py.File(filename, 'a') as f:
+        ifreq = _index(f['frequency'][...], frequency, 'frequency')
+        iel = _index(f['elevation'][...], elevation, 'elevation')
+        f['vp'][ifreq, iel] = planes
+        f['written'][ifreq, iel] = True
+
+
+class BeamCube:
+    """ Lazy read access to a beam cube
+
+    Usage::
+
+        cube = BeamCube('B2_beams.h5')
+        vp = cube.image(1.36e9, 45.0)
+    """
+
+    def __init__(self, filename):
+        """ Read the axes and header of a beam cube; the voltage patterns are read as needed
+
+        :param filename: Name of the HDF5 file
+        """
+        self.filename = filename
+        with h5py.File(filename, 'r') as f:
+            self.frequencies = f['frequency'][...]
+            self.elevations = f['elevation'][...]
+            self.written = f['written'][...]
+            self.shape = f['vp'].shape
+            self.header = fits.Header.fromstring(f['vp'].attrs['wcs'])
+
+    def has_plane(self, frequency, elevation):
+        """ Has the plane of a frequency and elevation been written?
+
+        :param frequency: Frequency (Hz)
+        :param elevation: Elevation (deg)
+        :return: bool
+        """
+        try:
+            return bool(self.written[_index(self.frequencies, frequency, 'frequency'),
+                                     _index(self.elevations, elevation, 'elevation')])
+        except ValueError:
+            return False
+
+    def plane(self, frequency, elevation):
+        """ Read the voltage pattern of one tabulated frequency and elevation
+
+        :param frequency: Frequency (Hz)
+        :param elevation: Elevation (deg)
+        :return: Voltage pattern, complex64 [4, ny, nx]
+        """
+        ifreq = _index(self.frequencies, frequency, 'frequency')
+        iel = _index(self.elevations, elevation, 'elevation')
+        if not self.written[ifreq, iel]:
+            raise ValueError("Beam cube: plane for frequency %s elevation %s not written" % (frequency, elevation))
+        with h5py.File(self.filename, 'r') as f:
+            return f['vp'][ifreq, iel]
+
+    def wcs(self, frequency):
+        """ WCS of the voltage pattern image at a frequency
+
+        :param frequency: Frequency (Hz)
+        :return: WCS
+        """
+        wcs = WCS(self.header)
+        wcs.wcs.crval[3] = frequency
+        return wcs
+
+    def image(self, frequency, elevation):
+        """ Voltage pattern image of one tabulated frequency and elevation
+
+        :param frequency: Frequency (Hz)
+        :param elevation: Elevation (deg)
+        :return: Image [1, 4, ny, nx], complex, linear polarisation
+        """
+        return create_image_from_array(self.plane(frequency, elevation)[numpy.newaxis].astype('complex'),
+                                       self.wcs(frequency), polarisation_frame=PolarisationFrame("linear"))
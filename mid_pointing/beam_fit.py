@@ -0,0 +1,566 @@
+"""Compact Zernike fits of the EMSS beams, evaluated directly at any offsets
+
+A voltage pattern image must be held in full by every worker that samples it, whatever the number of offsets. Here
+each Jones term of an EMSS beam (see beams.py) is instead fitted over the disc th <= th_max by a sum of Zernike
+polynomials R_n^m(th / th_max) exp(i m ph), and the gains are evaluated from the coefficients at any offsets.
+
+The position angles of the EMSS grid are uniform over the circle, so the azimuthal harmonics are found by an FFT
+along ph and each harmonic's radial profile is fitted separately by least squares. Harmonics whose summed amplitude
+is below a quarter of the tolerance are dropped, and the radial order is raised until the fit is within the tolerance
+at every tabulated point. Since |R_n^m| <= 1 on the disc, dropping terms whose summed amplitude is less than the
+remaining margin cannot take the fit out of tolerance, so the smallest terms are then pruned. A band's fits are a
+few kilobytes per (elevation, frequency), against 32 MB for a 1024 x 1024 voltage pattern.
+
+The voltage pattern of import_beam is also normalised on its pixel grid: its phase gradient in y is removed and its
+rows are shifted to centre the peak (see normalise_jones_beam). fit_beam finds that normalisation on the same grid
+and records it with the fit, so that a fit gives the gains of the imported voltage pattern at the same offsets.
+
+fit_beams fits all the .mat files of a band in parallel into one HDF5 file <band>_beam_fits.h5, which read_beam_fit
+reads one fit at a time. A BeamFitProvider holds all the fits of a band and gives the fit at any elevation and
+frequency, interpolated as VoltagePatternProvider interpolates the voltage patterns, and create_beam_fits_from_file
+gives the fits of the channels of a BlockVisibility at the elevation of its phasecentre at the middle of its times.
+"""
+
+__all__ = ['zernike_radial', 'ZernikeBeamFit', 'fit_zernike_beam', 'fit_beam', 'write_beam_fit', 'read_beam_fit',
+           'fit_beams', 'InterpolatedBeamFit', 'BeamFitProvider', 'get_beam_fit_provider',
+           'create_beam_fits_from_file']
+
+import logging
+import os
+
+import h5py
+import numpy
+import scipy.io
+from scipy.interpolate import interp1d
+
+from processing_library.util.coordinate_support import hadec_to_azel
+
+from mid_pointing.beams import interpolate_beams
+from mid_pointing.beam_import import JONES, MAT_FORMAT, normalise_jones_beam_with_factors
+from mid_pointing.process_pool import run_jobs
+
+log = logging.getLogger(__name__)
+
+FIT_FORMAT = '{b}_beam_fits.h5'
+FIT_GROUP_FORMAT = 'f{f:.0f}_e{e:g}'
+
+# Points evaluated at a time, bounding the memory of the radial polynomials
+BLOCK_SIZE = 65536
+
+# Points this fraction of the radius beyond the edge are on it, so that rounding does not drop the tabulated edge
+EDGE_TOLERANCE = 1e-9
+
+
+def zernike_radial(m, kmax, rho):
+    """ Zernike radial polynomials R_{m + 2k}^m(rho), k = 0 .. kmax
+
+    These are (-1)^k rho^m P_k^(m, 0)(1 - 2 rho^2), with the Jacobi polynomials made by their three term recurrence,
+    which is stable for 0 <= rho <= 1 at any order.
+
+    :param m: Azimuthal order, >= 0
+    :param kmax: Highest radial index
+    :param rho: Radius, normalised to 1 at the edge of the disc
+    :return: Polynomials [..., kmax + 1]
+    """
+    rho = numpy.asarray(rho, dtype='float')
+    x = 1.0 - 2.0 * rho ** 2
+    polynomials = [numpy.ones_like(rho)]
+    if kmax >= 1:
+        polynomials.append(((m + 2) * x + m) / 2.0)
+    for k in range(2, kmax + 1):
+        a = 2 * k + m
+        polynomials.append(((a - 1) * (a * (a - 2) * x + m * m) * polynomials[k - 1] -
+                            2 * (k + m - 1) * (k - 1) * a * polynomials[k - 2]) / (2 * k * (k + m) * (a - 2)))
+    signs = (-1.0) ** numpy.arange(kmax + 1)
+    return numpy.stack(polynomials, axis=-1) * signs * (rho ** m)[..., numpy.newaxis]
+
+
+class ZernikeBeamFit:
+    """ Zernike polynomial fit of the Jones terms of a beam over the disc th <= radius
+
+    The fit is made on the EMSS grid, with x = th sin(ph) and y = th cos(ph) along the columns and rows of the
+    voltage pattern made by import_beam. evaluate takes the offsets of that voltage pattern from its reference pixel,
+    maps them onto the EMSS grid as scale * (x, y) + shift and removes the phase gradient in y, as import_beam does.
+    The fit is zero outside the disc.
+
+    Usage::
+
+        fit = read_beam_fit('B2_beam_fits.h5', 1.36e9, 45)
+        jones = fit.evaluate(x, y)
+    """
+
+    def __init__(self, radius, modes, coefficients, tolerance=None, residual=None, scale=(1.0, 1.0),
+                 shift=(0.0, 0.0), phase_gradient=0.0, phase_reference=0.0):
+        """ Hold the coefficients of a fit
+
+        :param radius: Radius of the disc (deg)
+        :param modes: (n, m) of each term [nmodes, 2]
+        :param coefficients: Coefficients of each term for each Jones term [nmodes, njones]
+        :param tolerance: Tolerance of the fit
+        :param residual: Largest absolute difference between the fit and the tabulated beams
+        :param scale: Scale of the offsets (x, y) onto the EMSS grid
+        :param shift: Shift of the offsets (x, y) onto the EMSS grid (deg)
+        :param phase_gradient: Phase gradient removed in y on the EMSS grid (rad per deg)
+        :param phase_reference: Offset y on the EMSS grid at which the removed phase is zero (deg)
+        """
+        self.radius = float(radius)
+        self.modes = numpy.asarray(modes, dtype='int').reshape(-1, 2)
+        self.coefficients = numpy.asarray(coefficients, dtype='complex').reshape(len(self.modes), -1)
+        self.tolerance = tolerance
+        self.residual = residual
+        self.scale = tuple(float(value) for value in scale)
+        self.shift = tuple(float(value) for value in shift)
+        self.phase_gradient = float(phase_gradient)
+        self.phase_reference = float(phase_reference)
+        # The terms of each azimuthal order as a dense radial series, for evaluation
+        self._series = dict()
+        for m in numpy.unique(self.modes[:, 1]):
+            select = self.modes[:, 1] == m
+            k = (self.modes[select, 0] - abs(m)) // 2
+            series = numpy.zeros([k.max() + 1, self.njones], dtype='complex')
+            series[k] = self.coefficients[select]
+            self._series[int(m)] = series
+
+    @property
+    def njones(self):
+        """ Number of Jones terms
+        """
+        return self.coefficients.shape[1]
+
+    @property
+    def nbytes(self):
+        """ Size of the coefficients (bytes)
+        """
+        return self.modes.nbytes + self.coefficients.nbytes
+
+    def _radial(self, m, rho):
+        """ Radial profile of azimuthal order m of each Jones term [..., njones]
+        """
+        series = self._series[m]
+        return zernike_radial(abs(m), len(series) - 1, rho) @ series
+
+    def evaluate_polar(self, th, ph):
+        """ Evaluate the fit on a polar grid of the EMSS beams, without the mapping of evaluate
+
+        :param th: Offsets (deg) [nth]
+        :param ph: Position angles (deg) [nph]
+        :return: Jones terms [njones, nth, nph]
+        """
+        th = numpy.asarray(th, dtype='float')
+        rho = numpy.minimum(th / self.radius, 1.0)
+        angle = numpy.deg2rad(numpy.asarray(ph, dtype='float'))
+        result = numpy.zeros([len(th), len(angle), self.njones], dtype='complex')
+        for m in self._series:
+            result += self._radial(m, rho)[:, numpy.newaxis, :] * \
+                numpy.exp(1j * m * angle)[numpy.newaxis, :, numpy.newaxis]
+        result[th > self.radius * (1.0 + EDGE_TOLERANCE)] = 0.0
+        return numpy.moveaxis(result, -1, 0)
+
+    def evaluate(self, x, y, block_size=BLOCK_SIZE):
+        """ Evaluate the fit at arrays of offsets
+
+        The points are taken block_size at a time, so any number can be evaluated in one call.
+
+        :param x: Offsets along the columns of the voltage pattern from its reference pixel (deg)
+        :param y: Offsets along the rows of the voltage pattern from its reference pixel (deg)
+        :param block_size: Number of points evaluated at a time
+        :return: Jones terms [..., njones] with the broadcast shape of x and y
+        """
+        x, y = numpy.broadcast_arrays(numpy.asarray(x, dtype='float'), numpy.asarray(y, dtype='float'))
+        shape = x.shape
+        x = self.scale[0] * x.ravel() + self.shift[0]
+        y = self.scale[1] * y.ravel() + self.shift[1]
+        result = numpy.zeros([len(x), self.njones], dtype='complex')
+        for start in range(0, len(x), block_size):
+            rho = numpy.hypot(x[start:start + block_size], y[start:start + block_size]) / self.radius
+            inside = numpy.nonzero(rho <= 1.0 + EDGE_TOLERANCE)[0]
+            if len(inside) == 0:
+                continue
+            rho = numpy.minimum(rho[inside], 1.0)
+            phase = numpy.exp(1j * numpy.arctan2(x[start:start + block_size][inside],
+                                                 y[start:start + block_size][inside]))
+            value = numpy.zeros([len(inside), self.njones], dtype='complex')
+            for m in self._series:
+                value += self._radial(m, rho) * (phase ** m)[:, numpy.newaxis]
+            result[start + inside] = value
+        if self.phase_gradient != 0.0:
+            result *= numpy.exp(-1j * self.phase_gradient * (y - self.phase_reference))[:, numpy.newaxis]
+        return result.reshape(shape + (self.njones,))
+
+    def to_hdf5(self, group):
+        """ Write the fit into an HDF5 group
+
+        :param group: h5py Group
+        """
+        group.create_dataset('modes', data=self.modes.astype('int16'))
+        group.create_dataset('coefficients', data=self.coefficients)
+        group.attrs['radius'] = self.radius
+        if self.tolerance is not None:
+            group.attrs['tolerance'] = self.tolerance
+        if self.residual is not None:
+            group.attrs['residual'] = self.residual
+        group.attrs['scale'] = self.scale
+        group.attrs['shift'] = self.shift
+        group.attrs['phase_gradient'] = self.phase_gradient
+        group.attrs['phase_reference'] = self.phase_reference
+
+    @classmethod
+    def from_hdf5(cls, group):
+        """ Read a fit from an HDF5 group
+
+        :param group: h5py Group
+        :return: ZernikeBeamFit
+        """
+        return cls(group.attrs['radius'], group['modes'][...], group['coefficients'][...],
+                   tolerance=group.attrs.get('tolerance'), residual=group.attrs.get('residual'),
+                   scale=group.attrs.get('scale', (1.0, 1.0)), shift=group.attrs.get('shift', (0.0, 0.0)),
+                   phase_gradient=group.attrs.get('phase_gradient', 0.0),
+                   phase_reference=group.attrs.get('phase_reference', 0.0))
+
+
+def _azimuthal_harmonics(ph, beams):
+    """ Harmonics c_m(th) of beams on a grid of position angles uniform over the circle
+
+    :return: orders m [nm], harmonics [nm, njones, nth]
+    """
+    ph = numpy.asarray(ph, dtype='float')
+    if numpy.isclose(ph[-1] - ph[0], 360.0):
+        ph = ph[:-1]
+        beams = beams[..., :-1]
+    step = 360.0 / len(ph)
+    if not numpy.allclose(numpy.diff(ph), step):
+        raise ValueError("fit_zernike_beam: the position angles must be uniform over the circle")
+    nph = len(ph)
+    orders = numpy.fft.fftfreq(nph, 1.0 / nph).astype('int')
+    harmonics = numpy.fft.fft(beams, axis=-1) / nph
+    harmonics *= numpy.exp(-1j * orders * numpy.deg2rad(ph[0]))
+    return orders, numpy.moveaxis(harmonics, -1, 0)
+
+
+def fit_zernike_beam(th, ph, beams, tolerance=1e-3, max_order=256, order_step=4):
+    """ Fit Zernike polynomials to beams on a polar grid, to within a tolerance at every grid point
+
+    :param th: Offsets (deg), increasing; the largest is the radius of the fit
+    :param ph: Position angles (deg), uniform over the circle (360 may repeat 0)
+    :param beams: Beams [njones, nth, nph]
+    :param tolerance: Largest absolute difference allowed between the fit and the beams at any grid point
+    :param max_order: Highest radial order n tried
+    :param order_step: Step in the highest radial order between tries
+    :return: ZernikeBeamFit
+    """
+    th = numpy.asarray(th, dtype='float')
+    beams = numpy.asarray(beams, dtype='complex')
+    if beams.ndim == 2:
+        beams = beams[numpy.newaxis, ...]
+    if beams.shape[-2:] != (len(th), len(ph)):
+        raise ValueError("fit_zernike_beam: beams of shape %s are not on the polar grid (%d, %d)" %
+                         (str(beams.shape), len(th), len(ph)))
+    radius = th[-1]
+    rho = th / radius
+    orders, harmonics = _azimuthal_harmonics(ph, beams)
+
+    # The harmonics left out change the beam by at most their summed amplitude
+    amplitude = numpy.max(numpy.abs(harmonics), axis=(1, 2))
+    mmax = int(numpy.max(numpy.abs(orders)))
+    while mmax > 0 and numpy.sum(amplitude[numpy.abs(orders) >= mmax]) <= tolerance / 4.0:
+        mmax -= 1
+    kept = numpy.nonzero(numpy.abs(orders) <= mmax)[0]
+
+    fit = None
+    for nmax in range(mmax + order_step - mmax % order_step, max_order + order_step, order_step):
+        modes = list()
+        coefficients = list()
+        for index in kept:
+            m = int(orders[index])
+            nk = min((nmax - abs(m)) // 2 + 1, len(th))
+            basis = zernike_radial(abs(m), nk - 1, rho)
+            solution = numpy.linalg.lstsq(basis, harmonics[index].T, rcond=None)[0]
+            modes += [(abs(m) + 2 * k, m) for k in range(nk)]
+            coefficients.append(solution)
+        fit = ZernikeBeamFit(radius, modes, numpy.concatenate(coefficients), tolerance=tolerance)
+        fit.residual = float(numpy.max(numpy.abs(fit.evaluate_polar(th, ph) - beams)))
+        log.debug("fit_zernike_beam: order %d, %d terms, residual %g" % (nmax, len(modes), fit.residual))
+        if fit.residual <= tolerance:
+            break
+    else:
+        raise ValueError("fit_zernike_beam: no fit within tolerance %g up to order %d" % (tolerance, max_order))
+
+    # Prune the smallest terms while their summed amplitude fits in half the remaining margin
+    magnitude = numpy.abs(fit.coefficients)
+    by_size = numpy.argsort(numpy.max(magnitude, axis=1))
+    npruned = int(numpy.sum(numpy.all(numpy.cumsum(magnitude[by_size], axis=0) <=
+                                      (tolerance - fit.residual) / 2.0, axis=1)))
+    if npruned > 0:
+        keep = numpy.sort(by_size[npruned:])
+        pruned = ZernikeBeamFit(radius, fit.modes[keep], fit.coefficients[keep], tolerance=tolerance)
+        pruned.residual = float(numpy.max(numpy.abs(pruned.evaluate_polar(th, ph) - beams)))
+        if pruned.residual <= tolerance:
+            fit = pruned
+    return fit
+
+
+def _normalise_polar_beams(th, ph, beams, n, extent):
+    """ Normalise the Jones terms on the polar grid as import_beam does on the Cartesian grid
+
+    The terms are interpolated onto the grid of import_beam to find its normalisation. Its complex factor and the
+    negation of the Jqh and Jqv terms are applied to the terms on the polar grid, and the mapping of the offsets of
+    the voltage pattern onto the EMSS grid and the phase gradient are returned for ZernikeBeamFit.
+
+    :return: Normalised beams [4, nth, nph], dict of the mapping for ZernikeBeamFit
+    """
+    _, factor, dy, shifty = normalise_jones_beam_with_factors(interpolate_beams(th, ph, beams, n, extent),
+                                                              shift_peak=True)
+    beams = beams * factor
+    beams[[1, 3]] *= -1.0
+
+    # The rows of the voltage pattern are at y = th cos(ph) of the EMSS grid and the columns at x = th sin(ph) (see
+    # beams.py), and the pixel sampled at an offset is crpix + offset / cellsize in the WCS of create_vp_wcs
+    nx, ny = n
+    xmin, xmax, ymin, ymax = extent
+    row_step = (xmax - xmin) / (nx - 1)
+    column_step = (ymax - ymin) / (ny - 1)
+    cellsize = (xmax - xmin) / nx
+    mapping = {'scale': (column_step / cellsize, row_step / cellsize),
+               'shift': (ymin + (nx // 2) * column_step, xmin + (ny // 2 + shifty) * row_step),
+               'phase_gradient': dy / row_step,
+               'phase_reference': xmin + (nx / 2.0) * row_step}
+    return beams, mapping
+
+
+def fit_beam(band, elevation, frequency, n, extent, tolerance=1e-3, directory='.'):
+    """ Fit the beam of one band, elevation and frequency
+
+    :param band: Band name e.g. 'B2'
+    :param elevation: Elevation (deg)
+    :param frequency: Frequency (MHz)
+    :param n: Number of pixels (nx, ny) of the voltage pattern of import_beam
+    :param extent: Extent of the voltage pattern of import_beam (xmin, xmax, ymin, ymax) in deg
+    :param tolerance: Largest difference allowed at any tabulated point, relative to the peak
+    :param directory: Directory holding the .mat files
+    :return: ZernikeBeamFit
+    """
+    data = scipy.io.loadmat(os.path.join(directory, MAT_FORMAT.format(b=band, e=elevation, f=frequency)))
+    th = data['th'].squeeze()
+    ph = data['ph'].squeeze()
+    beams, mapping = _normalise_polar_beams(th, ph, numpy.array([data[j] for j in JONES], dtype='complex'), n,
+                                            extent)
+    fit = fit_zernike_beam(th, ph, beams, tolerance=tolerance)
+    return ZernikeBeamFit(fit.radius, fit.modes, fit.coefficients, tolerance=fit.tolerance, residual=fit.residual,
+                          **mapping)
+
+
+def write_beam_fit(filename, frequency, elevation, fit):
+    """ Write the fit of one frequency and elevation into a fits file, replacing any there
+
+    :param filename: Name of the HDF5 file
+    :param frequency: Frequency (Hz)
+    :param elevation: Elevation (deg)
+    :param fit: ZernikeBeamFit
+    """
+    name = FIT_GROUP_FORMAT.format(f=frequency, e=elevation)
+    with h5py.File(filename, 'a') as f:
+        if name in f:
+            del f[name]
+        group = f.create_group(name)
+        group.attrs['frequency'] = frequency
+        group.attrs['elevation'] = elevation
+        fit.to_hdf5(group)
+
+
+def read_beam_fit(filename, frequency, elevation):
+    """ Read the fit of one frequency and elevation, or None if there is none
+
+    :param filename: Name of the HDF5 file
+    :param frequency: Frequency (Hz)
+    :param elevation: Elevation (deg)
+    :return: ZernikeBeamFit or None
+    """
+    if not os.path.exists(filename):
+        return None
+    name = FIT_GROUP_FORMAT.format(f=frequency, e=elevation)
+    with h5py.File(filename, 'r') as f:
+        if name not in f:
+            return None
+        return ZernikeBeamFit.from_hdf5(f[name])
+
+
+def fit_beams(bands, elevations, n, extent, directory='.', tolerance=1e-3, nprocesses=None, overwrite=False):
+    """ Fit the beams of all bands, elevations and frequencies, in parallel, into a fits file per band
+
+    :param bands: List of (band name, list of frequencies in MHz)
+    :param elevations: List of elevations (deg)
+    :param n: Number of pixels (nx, ny) of the voltage patterns of import_beams
+    :param extent: Extent of the voltage patterns of import_beams (xmin, xmax, ymin, ymax) in deg
+    :param directory: Directory holding the .mat files, to which the files <band>_beam_fits.h5 are written
+    :param tolerance: Largest difference allowed at any tabulated point, relative to the peak
+    :param nprocesses: Number of processes (default the number of CPUs, 1 to run in this process)
+    :param overwrite: Refit beams already fitted?
+    :return: Number of beams fitted (not skipped)
+    """
+    jobs = list()
+    fitfiles = dict()
+    for b, freq in bands:
+        fitfiles[b] = os.path.join(directory, FIT_FORMAT.format(b=b))
+        if overwrite and os.path.exists(fitfiles[b]):
+            os.remove(fitfiles[b])
+        band_jobs = [(b, e, f, n, extent, tolerance, directory) for e in elevations for f in freq
+                     if read_beam_fit(fitfiles[b], f * 1e6, e) is None]
+        log.info("fit_beams: %s: %d of %d beams already in %s" % (b, len(freq) * len(elevations) - len(band_jobs),
+                                                                 len(freq) * len(elevations), fitfiles[b]))
+        jobs += band_jobs
+
+    def consume(job, fit):
+        b, e, f = job[:3]
+        write_beam_fit(fitfiles[b], f * 1e6, e, fit)
+        log.info("fit_beams: %s %s %s: %d terms, %d bytes, residual %g" % (b, e, f, len(fit.modes), fit.nbytes,
+                                                                           fit.residual))
+
+    run_jobs(fit_beam, jobs, nprocesses, 'Fit', consume=consume)
+    return len(jobs)
+
+
+class InterpolatedBeamFit:
+    """ Beam fit at an elevation and frequency between the tabulated ones, as a weighted sum of tabulated fits
+
+    The value at offsets (x, y) is the sum of weight * fit.evaluate(factor * x, factor * y) over the terms, as
+    VoltagePatternProvider blends and scales the planes of the tabulated voltage patterns.
+    """
+
+    def __init__(self, terms):
+        """ Hold the terms of the sum
+
+        :param terms: List of (weight, factor, ZernikeBeamFit)
+        """
+        self.terms = [(float(weight), float(factor), fit) for weight, factor, fit in terms if weight != 0.0]
+        assert len(self.terms) > 0, "InterpolatedBeamFit: no terms"
+
+    @property
+    def njones(self):
+        """ Number of Jones terms
+        """
+        return self.terms[0][2].njones
+
+    def evaluate(self, x, y, block_size=BLOCK_SIZE):
+        """ Evaluate the fit at arrays of offsets, as ZernikeBeamFit.evaluate
+
+        :param x: Offsets along the columns of the voltage pattern from its reference pixel (deg)
+        :param y: Offsets along the rows of the voltage pattern from its reference pixel (deg)
+        :param block_size: Number of points evaluated at a time
+        :return: Jones terms [..., njones] with the broadcast shape of x and y
+        """
+        x = numpy.asarray(x, dtype='float')
+        y = numpy.asarray(y, dtype='float')
+        result = None
+        for weight, factor, fit in self.terms:
+            value = weight * fit.evaluate(factor * x, factor * y, block_size=block_size)
+            result = value if result is None else result + value
+        return result
+
+
+class BeamFitProvider:
+    """ Beam fits of a band at any elevation and frequency
+
+    All the fits of the file are read at once, as they are small. At a tabulated frequency the fits of the tabulated
+    elevations are weighted by quadratic interpolation in elevation; between tabulated frequencies the fits of the
+    two either side are scaled with wavelength and interpolated linearly, as in VoltagePatternProvider.
+
+    Usage::
+
+        provider = get_beam_fit_provider('B2_beam_fits.h5')
+        jones = provider.fit(62.3, 1.36e9).evaluate(x, y)
+    """
+
+    def __init__(self, filename):
+        """ Read the fits of a file
+
+        :param filename: Name of the fits file from fit_beams
+        """
+        self.fits = dict()
+        with h5py.File(filename, 'r') as f:
+            for name in f:
+                group = f[name]
+                self.fits[(float(group.attrs['frequency']), float(group.attrs['elevation']))] = \
+                    ZernikeBeamFit.from_hdf5(group)
+        if len(self.fits) == 0:
+            raise ValueError("BeamFitProvider: no fits in %s" % filename)
+        self.frequencies = numpy.array(sorted(set(frequency for frequency, _ in self.fits)))
+        self.elevations = {frequency: numpy.array(sorted(elevation for freq, elevation in self.fits
+                                                         if freq == frequency))
+                           for frequency in self.frequencies}
+        self._interpolators = dict()
+
+    def weights(self, elevation, frequency):
+        """ Weights of the fits of a tabulated frequency for an elevation
+
+        Elevations outside the tabulated range are clamped to it.
+
+        :param elevation: Elevation (deg)
+        :param frequency: Tabulated frequency (Hz)
+        :return: Weights [nelevations]
+        """
+        elevations = self.elevations[frequency]
+        if len(elevations) == 1:
+            return numpy.ones(1)
+        if frequency not in self._interpolators:
+            self._interpolators[frequency] = interp1d(elevations, numpy.identity(len(elevations)), axis=0,
+                                                      kind='linear' if len(elevations) == 2 else 'quadratic')
+        return self._interpolators[frequency](numpy.clip(elevation, elevations[0], elevations[-1]))
+
+    def _tabulated_terms(self, elevation, frequency, weight, factor):
+        """ Terms of the fit at a tabulated frequency, each weighted by weight and scaled by factor
+        """
+        return [(weight * w, factor, self.fits[(frequency, e)])
+                for w, e in zip(self.weights(elevation, frequency), self.elevations[frequency])]
+
+    def fit(self, elevation, frequency):
+        """ Beam fit at an elevation and frequency
+
+        :param elevation: Elevation (deg)
+        :param frequency: Frequency (Hz)
+        :return: InterpolatedBeamFit
+        """
+        tabulated = numpy.nonzero(numpy.isclose(self.frequencies, frequency, rtol=1e-9, atol=1e-6))[0]
+        if len(tabulated) > 0:
+            return InterpolatedBeamFit(self._tabulated_terms(elevation, self.frequencies[tabulated[0]], 1.0, 1.0))
+
+        upper = int(numpy.searchsorted(self.frequencies, frequency))
+        if upper == 0 or upper == len(self.frequencies):
+            nearest = self.frequencies[0 if upper == 0 else -1]
+            return InterpolatedBeamFit(self._tabulated_terms(elevation, nearest, 1.0, frequency / nearest))
+        lower = self.frequencies[upper - 1]
+        upper = self.frequencies[upper]
+        weight = (frequency - lower) / (upper - lower)
+        return InterpolatedBeamFit(self._tabulated_terms(elevation, lower, 1.0 - weight, frequency / lower) +
+                                   self._tabulated_terms(elevation, upper, weight, frequency / upper))
+
+
+# Providers already made, by fits file
+_providers = dict()
+
+
+def get_beam_fit_provider(filename):
+    """ BeamFitProvider of a fits file, made once per process
+
+    :param filename: Name of the fits file
+    :return: BeamFitProvider
+    """
+    key = os.path.abspath(filename)
+    if key not in _providers:
+        _providers[key] = BeamFitProvider(filename)
+    return _providers[key]
+
+
+def create_beam_fits_from_file(bvis, filename):
+    """ Beam fits of the channels of a BlockVisibility, at the elevation of its phasecentre at the middle of its times
+
+    This replaces create_vp_from_beam_cube when the gains are evaluated from the beam fits.
+
+    :param bvis: BlockVisibility
+    :param filename: Name of the fits file
+    :return: List of InterpolatedBeamFit, one per channel
+    """
+    # The time in the BlockVisibility is hour angle in seconds!
+    har = numpy.pi / 43200.0 * numpy.median(numpy.unique(bvis.time))
+    _, elevation = hadec_to_azel(har, bvis.phasecentre.dec.rad, bvis.configuration.location.lat.rad)
+    provider = get_beam_fit_provider(filename)
+    return [provider.fit(numpy.rad2deg(elevation), frequency) for frequency in bvis.frequency]
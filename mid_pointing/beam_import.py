@@ -0,0 +1,244 @@
+"""Parallel import of the EMSS beam models into a voltage pattern cube per band
+
+Each (band, elevation, frequency) .mat file is an independent job: its four Jones terms are interpolated onto the
+Cartesian grid (see beams.py) and normalised. The jobs are fanned out over a process pool, each process making the
+interpolation weights once and reusing them for all its jobs, and the parent writes each voltage pattern into the
+band's beam cube (see beam_cube.py) as it arrives. Planes already written to the cube are skipped, so an interrupted
+import can be rerun and only the missing beams are made.
+
+Plotting is a separate, optional step run after the import: plot_imported_beams reads the planes back from the cube
+and renders one PNG per Jones term, skipping PNGs that exist.
+"""
+
+__all__ = ['normalise_jones_beam', 'normalise_jones_beam_with_factors', 'create_vp_wcs', 'import_beam',
+           'plot_imported_beam', 'import_beams', 'plot_imported_beams']
+
+import logging
+import os
+
+import numpy
+import scipy.io
+from astropy.wcs import WCS
+
+from mid_pointing.beams import interpolate_beams
+from mid_pointing.beam_cube import create_beam_cube, write_beam_plane, BeamCube
+from mid_pointing.process_pool import run_jobs
+
+log = logging.getLogger(__name__)
+
+JONES = ['Jpv', 'Jqh', 'Jph', 'Jqv']
+
+MAT_FORMAT = '{b}_{e}_{f}.mat'
+CUBE_FORMAT = '{b}_beams.h5'
+PNG_FORMAT = '{b}_{e}_{f:04d}_{j}.png'
+TITLE_FORMAT = 'band = {b}, elev = {e} deg, freq = {f} MHz, jones = {j}'
+
+
+def create_vp_wcs(cellsize, frequency, shape, channel_bandwidth=1e6):
+    """ WCS of a linearly polarised voltage pattern image in AZELGEO
+
+    :param cellsize: Cellsize (deg)
+    :param frequency: Frequency (Hz)
+    :param shape: Image shape (ny, nx)
+    :param channel_bandwidth: Channel bandwidth (Hz)
+    :return: WCS
+    """
+    ny, nx = shape
+    w = WCS(naxis=4)
+    # The negation in the longitude is needed by definition of RA, DEC
+    w.wcs.cdelt = [-cellsize, cellsize, -1.0, channel_bandwidth]
+    w.wcs.crpix = [nx // 2, ny // 2, 1.0, 1.0]
+    w.wcs.ctype = ['AZELGEO long', 'AZELGEO lati', 'STOKES', 'FREQ']
+    w.wcs.crval = [0.0, 0.0, -5.0, frequency]
+    w.wcs.cunit = ['deg', 'deg', '', 'Hz']
+    w.naxis = 4
+    w.wcs.radesys = 'ICRS'
+    w.wcs.equinox = 2000.0
+    return w
+
+
+def normalise_jones_beam(pol_planes, shift_peak=False):
+    """ Construct the voltage pattern from the four interpolated Jones terms
+
+    The terms are transposed into image order, the beam is renormalised, its phase at the centre and phase gradient
+    in y are removed, and the sign of the Jqh and Jqv terms is flipped. These transforms are guessed to give
+    realistic looking beams.
+
+    :param pol_planes: Jones terms Jpv, Jqh, Jph, Jqv on the Cartesian grid [4, ny, nx]
+    :param shift_peak: Shift the peak of the power beam in y onto the centre?
+    :return: Voltage pattern [4, ny, nx]
+    """
+    return normalise_jones_beam_with_factors(pol_planes, shift_peak=shift_peak)[0]
+
+
+def normalise_jones_beam_with_factors(pol_planes, shift_peak=False):
+    """ As normalise_jones_beam, also returning the normalisation so that it can be applied elsewhere (see beam_fit.py)
+
+    :param pol_planes: Jones terms Jpv, Jqh, Jph, Jqv on the Cartesian grid [4, ny, nx]
+    :param shift_peak: Shift the peak of the power beam in y onto the centre?
+    :return: Voltage pattern [4, ny, nx], complex factor of the terms, phase gradient removed (rad per row), shift
+        of the rows
+    """
+    assert len(pol_planes) == 4
+
+    beam_out = numpy.transpose(numpy.asarray(pol_planes, dtype='complex'), (0, 2, 1)).copy()
+    _, ny, nx = beam_out.shape
+
+    # 1. Renormalise
+    peak = numpy.max(numpy.abs(beam_out))
+    beam_out /= peak
+    # 2. Remove phase error in image plane
+    centre = numpy.conjugate(beam_out[0, ny // 2, nx // 2])
+    beam_out *= centre
+    factor = centre / peak
+
+    # 3. Remove phase gradient in image plane
+    dy = numpy.mod(numpy.angle(beam_out[0, ny // 2 + 1, nx // 2]) -
+                   numpy.angle(beam_out[0, ny // 2 - 1, nx // 2]), numpy.pi) / 2.0
+    rotator = numpy.exp(-1.0j * dy * (numpy.arange(ny) - ny / 2.0))
+    beam_out *= rotator[numpy.newaxis, :, numpy.newaxis]
+    for pol in [1, 3]:
+        beam_out[pol, ...] = -1.0 * beam_out[pol, ...]
+
+    shifty = 0
+    if shift_peak:
+        power_beam = numpy.abs(beam_out) ** 2
+        shifty = numpy.unravel_index(numpy.argmax(power_beam), power_beam.shape)[1] - ny // 2 + 1
+        log.debug("normalise_jones_beam: shift in y is %d" % shifty)
+        beam_out = numpy.roll(beam_out, -shifty, axis=1)
+
+        power_beam = numpy.abs(beam_out) ** 2
+        assert numpy.unravel_index(numpy.argmax(power_beam), power_beam.shape)[1] - ny // 2 + 1 == 0
+
+    return beam_out, factor, dy, int(shifty)
+
+
+def import_beam(band, elevation, frequency, n, extent, directory='.'):
+    """ Import the beam of one band, elevation and frequency as a voltage pattern
+
+    :param band: Band name e.g. 'B2'
+    :param elevation: Elevation (deg)
+    :param frequency: Frequency (MHz)
+    :param n: Number of pixels (nx, ny)
+    :param extent: Extent of the image (xmin, xmax, ymin, ymax) in deg
+    :param directory: Directory holding the .mat files
+    :return: Voltage pattern, complex64 [4, ny, nx]
+    """
+    data = scipy.io.loadmat(os.path.join(directory, MAT_FORMAT.format(b=band, e=elevation, f=frequency)))
+    th = data['th'].squeeze()
+    ph = data['ph'].squeeze()
+    # All Jones terms, elevations and frequencies share the interpolation weights
+    pol_planes = interpolate_beams(th, ph, numpy.array([data[j] for j in JONES]), n, extent)
+    return normalise_jones_beam(pol_planes, shift_peak=True).astype('complex64')
+
+
+def plot_imported_beam(band, elevation, frequency, extent, directory='.', overwrite=False):
+    """ Plot the real, imaginary, amplitude and phase of each Jones term of an imported beam, one PNG per term
+
+    :param band: Band name e.g. 'B2'
+    :param elevation: Elevation (deg)
+    :param frequency: Frequency (MHz)
+    :param extent: Extent of the image (xmin, xmax, ymin, ymax) in deg
+    :param directory: Directory holding the beam cube, to which the PNGs are written
+    :param overwrite: Remake the PNGs if they exist?
+    :return: Number of PNGs made
+    """
+    import matplotlib as mpl
+    mpl.use('agg')
+    import matplotlib.pyplot as plt
+
+    pngfiles = [os.path.join(directory, PNG_FORMAT.format(b=band, e=elevation, f=frequency, j=j)) for j in JONES]
+    if not overwrite and all(os.path.exists(pngfile) for pngfile in pngfiles):
+        return 0
+
+    vp = BeamCube(os.path.join(directory, CUBE_FORMAT.format(b=band))).plane(frequency * 1e6, elevation)
+    nmade = 0
+    for pol, (j, pngfile) in enumerate(zip(JONES, pngfiles)):
+        if not overwrite and os.path.exists(pngfile):
+            continue
+        beam = numpy.transpose(vp[pol])
+        fig, axes = plt.subplots(2, 2, sharex=True, sharey=True)
+        fig.suptitle(TITLE_FORMAT.format(b=band, e=elevation, f=frequency, j=j))
+        for ax, title, image in [(axes[0, 0], 'real', beam.real), (axes[0, 1], 'imag', beam.imag),
+                                 (axes[1, 0], 'amplitude', numpy.abs(beam)),
+                                 (axes[1, 1], 'phase', numpy.angle(beam, deg=True))]:
+            ax.set_title(title)
+            im = ax.imshow(image, extent=extent, origin='lower')
+            fig.colorbar(im, ax=ax)
+        for ax in axes[:, 0]:
+            ax.set_ylabel('y / deg')
+        for ax in axes[1, :]:
+            ax.set_xlabel('x / deg')
+        plt.savefig(pngfile)
+        plt.close(fig)
+        nmade += 1
+    return nmade
+
+
+def _open_beam_cube(cubefile, frequencies, elevations, n, extent, overwrite):
+    """ Open the beam cube of a band, creating it if it does not exist or is to be overwritten
+
+    A cube for other axes is not remade unless overwrite is set, since that would lose the beams imported into it.
+    """
+    if not overwrite and os.path.exists(cubefile):
+        cube = BeamCube(cubefile)
+        if numpy.array_equal(cube.frequencies, frequencies) and numpy.array_equal(cube.elevations, elevations) and \
+                cube.shape[-2:] == (n[1], n[0]):
+            return cube
+        raise ValueError("import_beams: the frequencies, elevations or image size of %s differ from those requested; "
+                         "use overwrite to remake it" % cubefile)
+    cellsize = (extent[1] - extent[0]) / n[0]
+    create_beam_cube(cubefile, frequencies, elevations, create_vp_wcs(cellsize, frequencies[0], (n[1], n[0])),
+                     (n[1], n[0]))
+    return BeamCube(cubefile)
+
+
+def import_beams(bands, elevations, n, extent, directory='.', nprocesses=None, plot=False, overwrite=False):
+    """ Import the beams of all bands, elevations and frequencies, in parallel, into a beam cube per band
+
+    :param bands: List of (band name, list of frequencies in MHz)
+    :param elevations: List of elevations (deg)
+    :param n: Number of pixels (nx, ny)
+    :param extent: Extent of the images (xmin, xmax, ymin, ymax) in deg
+    :param directory: Directory holding the .mat files, to which the cubes <band>_beams.h5 are written
+    :param nprocesses: Number of processes (default the number of CPUs, 1 to run in this process)
+    :param plot: Plot the imported beams once all are imported?
+    :param overwrite: Remake outputs that exist, including cubes for other axes?
+    :return: Number of beams imported (not skipped)
+    """
+    jobs = list()
+    cubefiles = dict()
+    for b, freq in bands:
+        cubefiles[b] = os.path.join(directory, CUBE_FORMAT.format(b=b))
+        cube = _open_beam_cube(cubefiles[b], 1e6 * numpy.array(freq, dtype='float'),
+                               numpy.array(elevations, dtype='float'), n, extent, overwrite)
+        band_jobs = [(b, e, f, n, extent, directory) for e in elevations for f in freq
+                     if not cube.has_plane(f * 1e6, e)]
+        print("Import %s: %d of %d beams already in %s" % (b, len(freq) * len(elevations) - len(band_jobs),
+                                                         len(freq) * len(elevations), cubefiles[b]), flush=True)
+        jobs += band_jobs
+
+    def consume(job, vp):
+        b, e, f = job[:3]
+        write_beam_plane(cubefiles[b], f * 1e6, e, vp)
+
+    run_jobs(import_beam, jobs, nprocesses, 'Import', consume=consume)
+    if plot:
+        plot_imported_beams(bands, elevations, extent, directory=directory, nprocesses=nprocesses,
+                            overwrite=overwrite)
+    return len(jobs)
+
+
+def plot_imported_beams(bands, elevations, extent, directory='.', nprocesses=None, overwrite=False):
+    """ Plot the imported beams of all bands, elevations and frequencies, in parallel
+
+    :param bands: List of (band name, list of frequencies in MHz)
+    :param elevations: List of elevations (deg)
+    :param extent: Extent of the images (xmin, xmax, ymin, ymax) in deg
+    :param directory: Directory holding the beam cubes, to which the PNGs are written
+    :param nprocesses: Number of processes (default the number of CPUs, 1 to run in this process)
+    :param overwrite: Remake PNGs that exist?
+    :return: Number of PNGs made
+    """
+    jobs = [(b, e, f, extent, directory, overwrite) for b, freq in bands for e in elevations for f in freq]
+    return sum(run_jobs(plot_imported_beam, jobs, nprocesses, 'Plot'))
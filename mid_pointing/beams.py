@@ -0,0 +1,161 @@
+"""Import of the EMSS beam models onto the Cartesian grid of a voltage pattern image
+
+The EMSS beams (beam_models/EMSS/with_elevation/SKADCBeamPatterns) are tabulated on a polar grid of offset th and
+position angle ph (deg), one .mat file per band, elevation and frequency, with the Jones terms Jpv, Jqh, Jph and Jqv.
+Each term is interpolated onto an (x, y) grid with x = th cos(ph), y = th sin(ph) by the bicubic interpolating spline
+that scipy.interpolate.interpn(..., method="splinef2d") uses.
+
+That spline is linear in the tabulated values: its coefficients are C = A_th B A_ph^T, where B is the beam and A the
+inverses of the (small) collocation matrices of the B-splines in th and ph, and each output pixel is the sum of 16
+coefficients weighted by products of the B-splines at its (th, ph). All the files of a band share the same polar and
+Cartesian grids, so a PolarBeamInterpolator computes the polar location of every pixel, the collocation inverses and
+the sparse [npixel, nth * nph] stencil once, and then interpolates any number of complex planes (Jones terms,
+elevations and frequencies) by two small matrix products and one sparse matrix product.
+"""
+
+__all__ = ['interpolating_knots', 'PolarBeamInterpolator', 'get_polar_beam_interpolator', 'interpolate_beams']
+
+import logging
+
+import numpy
+import scipy.sparse
+from scipy.interpolate import BSpline
+
+log = logging.getLogger(__name__)
+
+# Order of the splines, as for interpn(..., method="splinef2d")
+SPLINE_ORDER = 3
+
+
+def interpolating_knots(grid, order=SPLINE_ORDER):
+    """ Knots of the interpolating spline of FITPACK (s=0): the ends repeated order + 1 times and the interior data
+    points except the order // 2 nearest each end
+
+    These are shared by the beam import and the voltage pattern sampler (see vp_sampler.py).
+
+    :param grid: Data points, ascending
+    :param order: Order of the spline
+    :return: Knots
+    """
+    grid = numpy.asarray(grid, dtype='float')
+    return numpy.concatenate([numpy.repeat(grid[0], order + 1), grid[order // 2 + 1:-(order // 2 + 1)],
+                              numpy.repeat(grid[-1], order + 1)])
+
+
+class PolarBeamInterpolator:
+    """ Interpolation of beams on a polar (th, ph) grid onto a Cartesian (x, y) grid, with precomputed weights
+
+    Usage::
+
+        interpolator = get_polar_beam_interpolator(th, ph, (1024, 1024), (-4.0, 4.0, -4.0, 4.0))
+        planes = interpolator.interpolate(numpy.array([data[j] for j in ['Jpv', 'Jqh', 'Jph', 'Jqv']]))
+    """
+
+    def __init__(self, th, ph, n, extent):
+        """ Compute the interpolation weights of every pixel
+
+        :param th: Offsets of the polar grid (deg), increasing
+        :param ph: Position angles of the polar grid (deg), increasing
+        :param n: Number of pixels (nx, ny)
+        :param extent: Extent of the Cartesian grid (xmin, xmax, ymin, ymax) in deg
+        """
+        self.th = numpy.asarray(th, dtype='float')
+        self.ph = numpy.asarray(ph, dtype='float')
+        self.n = tuple(n)
+        self.extent = tuple(extent)
+        for name, grid in [('th', self.th), ('ph', self.ph)]:
+            if len(grid) <= SPLINE_ORDER or numpy.any(numpy.diff(grid) <= 0.0):
+                raise ValueError("PolarBeamInterpolator: %s must be increasing with more than %d values" %
+                                 (name, SPLINE_ORDER))
+
+        nx, ny = self.n
+        xmin, xmax, ymin, ymax = self.extent
+        x2, y2 = numpy.meshgrid(numpy.linspace(xmin, xmax, nx), numpy.linspace(ymin, ymax, ny))
+        thi = numpy.sqrt(x2 ** 2 + y2 ** 2).ravel()
+        phi = numpy.mod(numpy.degrees(numpy.arctan2(y2, x2)), 360.0).ravel()
+        for name, grid, values in [('th', self.th, thi), ('ph', self.ph, phi)]:
+            if values.min() < grid[0] or values.max() > grid[-1]:
+                raise ValueError("PolarBeamInterpolator: the Cartesian grid is outside the %s range %s to %s" %
+                                 (name, grid[0], grid[-1]))
+
+        th_knots = interpolating_knots(self.th)
+        ph_knots = interpolating_knots(self.ph)
+        # The coefficients of the spline are th_solve @ beam @ ph_solve.T
+        self.th_solve = numpy.linalg.inv(BSpline.design_matrix(self.th, th_knots, SPLINE_ORDER).toarray())
+        self.ph_solve = numpy.linalg.inv(BSpline.design_matrix(self.ph, ph_knots, SPLINE_ORDER).toarray())
+
+        # Each pixel has order + 1 non-zero B-splines in each of th and ph, so 16 products
+        nterms = SPLINE_ORDER + 1
+        npixel = len(thi)
+        th_basis = BSpline.design_matrix(thi, th_knots, SPLINE_ORDER).tocsr()
+        ph_basis = BSpline.design_matrix(phi, ph_knots, SPLINE_ORDER).tocsr()
+        assert th_basis.nnz == nterms * npixel and ph_basis.nnz == nterms * npixel
+        columns = th_basis.indices.reshape(npixel, nterms, 1) * len(self.ph) + \
+            ph_basis.indices.reshape(npixel, 1, nterms)
+        weights = th_basis.data.reshape(npixel, nterms, 1) * ph_basis.data.reshape(npixel, 1, nterms)
+        self.stencil = scipy.sparse.csr_matrix((weights.ravel(), columns.ravel(),
+                                                numpy.arange(0, nterms ** 2 * npixel + 1, nterms ** 2)),
+                                               shape=(npixel, len(self.th) * len(self.ph)))
+
+    def matches(self, th, ph):
+        """ Is the polar grid that of this interpolator?
+
+        :param th: Offsets of the polar grid (deg)
+        :param ph: Position angles of the polar grid (deg)
+        :return: bool
+        """
+        return numpy.array_equal(self.th, th) and numpy.array_equal(self.ph, ph)
+
+    def interpolate(self, beams):
+        """ Interpolate beams onto the Cartesian grid
+
+        :param beams: Beams on the polar grid, real or complex [..., nth, nph]
+        :return: Beams [..., ny, nx]
+        """
+        beams = numpy.asarray(beams)
+        shape = beams.shape[:-2]
+        if beams.shape[-2:] != (len(self.th), len(self.ph)):
+            raise ValueError("PolarBeamInterpolator: beams of shape %s are not on the polar grid (%d, %d)" %
+                             (str(beams.shape), len(self.th), len(self.ph)))
+        planes = beams.reshape((-1,) + beams.shape[-2:])
+        coefficients = numpy.matmul(numpy.matmul(self.th_solve, planes), self.ph_solve.T)
+        result = self.stencil @ coefficients.reshape(len(planes), -1).T
+        nx, ny = self.n
+        return result.T.reshape(shape + (ny, nx))
+
+
+# Interpolators already made, by polar grid, number of pixels and extent
+_interpolators = dict()
+
+
+def get_polar_beam_interpolator(th, ph, n, extent):
+    """ PolarBeamInterpolator for a polar grid and Cartesian grid, made once per process
+
+    :param th: Offsets of the polar grid (deg)
+    :param ph: Position angles of the polar grid (deg)
+    :param n: Number of pixels (nx, ny)
+    :param extent: Extent of the Cartesian grid (xmin, xmax, ymin, ymax) in deg
+    :return: PolarBeamInterpolator
+    """
+    th = numpy.asarray(th, dtype='float')
+    ph = numpy.asarray(ph, dtype='float')
+    key = (th.tobytes(), ph.tobytes(), tuple(n), tuple(extent))
+    if key not in _interpolators:
+        _interpolators[key] = PolarBeamInterpolator(th, ph, n, extent)
+    return _interpolators[key]
+
+
+def interpolate_beams(th, ph, beams, n, extent):
+    """ Interpolate beams on a polar (th, ph) grid onto a Cartesian (x, y) grid
+
+    The result is that of scipy.interpolate.interpn((th, ph), beam, xi, method="splinef2d") for the real and
+    imaginary parts of each plane, but the weights are computed once per grid and all planes are done together.
+
+    :param th: Offsets of the polar grid (deg)
+    :param ph: Position angles of the polar grid (deg)
+    :param beams: Beams on the polar grid, real or complex [..., nth, nph]
+    :param n: Number of pixels (nx, ny)
+    :param extent: Extent of the Cartesian grid (xmin, xmax, ymin, ymax) in deg
+    :return: Beams [..., ny, nx]
+    """
+    return get_polar_beam_interpolator(th, ph, n, extent).interpolate(beams)
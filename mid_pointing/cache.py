@@ -0,0 +1,164 @@
+"""Persistent on-disk cache for simulation products that do not depend on the pointing errors
+
+The error-free products of a simulation (weighted visibilities, PSF, error-free gaintables and visibilities) depend
+only on the observation and sky definition. They are stored under a key formed by hashing those inputs, so that later
+runs, and other cases sharing the same cache directory, can reload them. The cache is capped in size: when a new
+product would take it over the cap, the least recently used entries are removed.
+"""
+
+__all__ = ['hash_inputs', 'hash_file', 'ProductCache']
+
+import hashlib
+import logging
+import os
+import pickle
+import shutil
+
+import numpy
+
+from mid_pointing.file_support import atomic_dump
+
+log = logging.getLogger(__name__)
+
+
+def _canonical(value):
+    """ Convert a value into a string that is stable across runs and processes
+    """
+    if isinstance(value, dict):
+        return '{%s}' % ','.join('%s:%s' % (key, _canonical(value[key])) for key in sorted(value.keys()))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ','.join(_canonical(v) for v in value)
+    if isinstance(value, numpy.ndarray):
+        return 'ndarray(%s,%s,%s)' % (value.dtype.str, value.shape,
+                                      hashlib.sha256(numpy.ascontiguousarray(value).tobytes()).hexdigest())
+    if isinstance(value, (float, numpy.floating)):
+        return repr(float(value))
+    if isinstance(value, (bool, int, numpy.integer, str)) or value is None:
+        return repr(value)
+    if hasattr(value, 'direction') and hasattr(value, 'flux'):
+        # Skycomponent
+        return 'Skycomponent(%s,%s,%s,%s)' % (_canonical(value.direction), _canonical(numpy.array(value.flux)),
+                                              _canonical(numpy.array(value.frequency)), value.shape)
+    if hasattr(value, 'ra') and hasattr(value, 'dec'):
+        # SkyCoord
+        return 'SkyCoord(%r,%r,%s)' % (float(value.ra.deg), float(value.dec.deg), value.frame.name)
+    raise ValueError("Cannot form a cache key from %s" % type(value))
+
+
+def hash_inputs(**inputs):
+    """ Form a cache key from the inputs that define a product
+
+    Numbers, strings, arrays, lists, dicts, SkyCoords and Skycomponents are supported.
+
+    :param inputs: Named inputs
+    :return: Hexadecimal key
+    """
+    return hashlib.sha256(_canonical(inputs).encode('utf-8')).hexdigest()
+
+
+def hash_file(filename):
+    """ Hash the contents of a file, e.g. an array configuration, so that a key changes when the file is edited
+
+    :param filename: Name of the file
+    :return: Hexadecimal SHA-256 of the contents
+    """
+    sha = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+class ProductCache:
+    """ Content-addressed cache of pickled products with a size cap and least recently used eviction
+
+    Each key is a directory holding one pickle file per named product. Reading an entry marks it as used. Writes go
+    through a temporary file and a rename so that concurrent jobs sharing the directory never see partial files.
+    """
+
+    def __init__(self, directory, max_size=100.0):
+        """ Cache in a directory
+
+        :param directory: Cache directory, created if necessary
+        :param max_size: Maximum size of the cache (GB)
+        """
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = int(max_size * 1024 * 1024 * 1024)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def _filename(self, key, name):
+        return os.path.join(self._entry(key), '%s.pkl' % name)
+
+    def contains(self, key, name):
+        """ Is the named product in the cache?
+        """
+        return os.path.exists(self._filename(key, name))
+
+    def load(self, key, name):
+        """ Load a product
+
+        :param key: Key from hash_inputs
+        :param name: Name of product
+        :return: Product or None if not present
+        """
+        filename = self._filename(key, name)
+        try:
+            with open(filename, 'rb') as f:
+                product = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(self._entry(key))
+        log.info("ProductCache: loaded %s from %s" % (name, self._entry(key)))
+        return product
+
+    def save(self, key, name, product):
+        """ Save a product, evicting least recently used entries if needed
+
+        :param key: Key from hash_inputs
+        :param name: Name of product
+        :param product: Picklable product
+        """
+        entry = self._entry(key)
+        os.makedirs(entry, exist_ok=True)
+        atomic_dump(product, self._filename(key, name))
+        os.utime(entry)
+        log.info("ProductCache: saved %s to %s" % (name, entry))
+        self.evict(keep=key)
+
+    def size(self):
+        """ Total size of the cache (bytes)
+        """
+        return sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        entries = []
+        for key in os.listdir(self.directory):
+            entry = self._entry(key)
+            try:
+                if not os.path.isdir(entry):
+                    continue
+                size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), key, size))
+            except OSError:
+                # Removed by another process (e.g. a worker saving to the same cache) while listing
+                continue
+        return entries
+
+    def evict(self, keep=None):
+        """ Remove least recently used entries until the cache is within its size cap
+
+        :param keep: Key never to be evicted (e.g. the entry just written)
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            log.info("ProductCache: evicting %s (%.3f GB)" % (key, size / 1024 / 1024 / 1024))
+            shutil.rmtree(self._entry(key), ignore_errors=True)
+            total -= size
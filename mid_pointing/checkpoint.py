@@ -0,0 +1,175 @@
+"""Checkpointing of the scenario loop so that a killed simulation can be resumed
+
+The state of a run (the seeds per chunk and the output file names) is written before the loop starts. For each
+scenario the dirty image of each time chunk is written as soon as it is computed, followed by the error gaintables,
+the summed residual image, the QA statistics and the result row when the scenario is finished. On resume, finished
+scenarios are reloaded rather than recomputed and an unfinished scenario restarts from the chunks not yet written.
+"""
+
+__all__ = ['ScenarioCheckpoint', 'compute_chunks_with_checkpoint']
+
+import json
+import logging
+import os
+import pickle
+
+from workflows.rsexecute.execution_support.rsexecute import rsexecute
+
+from mid_pointing.file_support import atomic_dump
+
+log = logging.getLogger(__name__)
+
+
+def _load(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+class ScenarioCheckpoint:
+    """ Checkpoint directory for the scenario loop of a simulation
+
+    The layout is::
+
+        state.json                  seeds, output file names, scenarios
+        <scenario>/chunk_<n>.pkl    (dirty image, sumwt) for time chunk n
+        <scenario>/gaintables.pkl   error gaintables, one list per chunk
+        <scenario>/residual.pkl     (summed residual image, sumwt)
+        <scenario>/qa.pkl           QA of the residual image
+        <scenario>/result.pkl       result row; written last, so marks the scenario as finished
+    """
+
+    def __init__(self, directory):
+        """ Checkpoint in a directory
+
+        :param directory: Checkpoint directory, created if necessary
+        """
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _scenario_directory(self, scenario):
+        directory = os.path.join(self.directory, scenario)
+        os.makedirs(directory, exist_ok=True)
+        return directory
+
+    def _filename(self, scenario, name):
+        return os.path.join(self._scenario_directory(scenario), '%s.pkl' % name)
+
+    def load_state(self):
+        """ Load the state of the run
+
+        :return: dict or None if no state has been saved
+        """
+        try:
+            with open(os.path.join(self.directory, 'state.json'), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_state(self, state):
+        """ Save the state of the run
+
+        :param state: JSON serialisable dict
+        """
+        atomic_dump(state, os.path.join(self.directory, 'state.json'), use_json=True)
+
+    def is_finished(self, scenario):
+        """ Has this scenario been finished?
+        """
+        return os.path.exists(self._filename(scenario, 'result'))
+
+    def save_chunk(self, scenario, ichunk, chunk_result):
+        """ Save the dirty image for one time chunk
+
+        :param scenario: Scenario name
+        :param ichunk: Index of time chunk
+        :param chunk_result: (dirty image, sumwt)
+        """
+        atomic_dump(chunk_result, self._filename(scenario, 'chunk_%d' % ichunk))
+
+    def load_chunks(self, scenario, nchunks):
+        """ Load the dirty images of the time chunks already computed
+
+        :param scenario: Scenario name
+        :param nchunks: Number of time chunks
+        :return: dict from chunk index to (dirty image, sumwt)
+        """
+        chunks = dict()
+        for ichunk in range(nchunks):
+            chunk_result = _load(self._filename(scenario, 'chunk_%d' % ichunk))
+            if chunk_result is not None:
+                chunks[ichunk] = chunk_result
+        return chunks
+
+    def remaining_chunks(self, scenario, nchunks):
+        """ Indices of the time chunks whose dirty images are not yet saved, without loading the others
+
+        :param scenario: Scenario name
+        :param nchunks: Number of time chunks
+        :return: List of chunk indices
+        """
+        return [ichunk for ichunk in range(nchunks)
+                if not os.path.exists(self._filename(scenario, 'chunk_%d' % ichunk))]
+
+    def save_product(self, scenario, name, product):
+        """ Save a named product (e.g. gaintables, residual, qa) for a scenario
+        """
+        atomic_dump(product, self._filename(scenario, name))
+
+    def load_product(self, scenario, name):
+        """ Load a named product for a scenario
+
+        :return: Product or None if not present
+        """
+        return _load(self._filename(scenario, name))
+
+    def save_result(self, scenario, result):
+        """ Save the result row, marking the scenario as finished
+        """
+        self.save_product(scenario, 'result', result)
+        log.info("ScenarioCheckpoint: scenario %s finished" % scenario)
+
+    def load_result(self, scenario):
+        """ Load the result row of a finished scenario
+
+        :return: dict or None if the scenario is not finished
+        """
+        return self.load_product(scenario, 'result')
+
+
+def compute_chunks_with_checkpoint(chunk_dirty_list, checkpoint, scenario):
+    """ Compute the dirty image of each time chunk, writing each to the checkpoint as it completes
+
+    Chunks already in the checkpoint are not recomputed. With Dask, the remaining chunks are computed
+    concurrently and saved in order of completion.
+
+    :param chunk_dirty_list: List of graphs for (dirty image, sumwt), one per time chunk
+    :param checkpoint: ScenarioCheckpoint
+    :param scenario: Scenario name
+    :return: List of (dirty image, sumwt), one per time chunk
+    """
+    nchunks = len(chunk_dirty_list)
+    chunks = checkpoint.load_chunks(scenario, nchunks)
+    todo = [ichunk for ichunk in range(nchunks) if ichunk not in chunks]
+    if len(chunks) > 0:
+        log.info("compute_chunks_with_checkpoint: %s: %d of %d chunks loaded from checkpoint" %
+                 (scenario, len(chunks), nchunks))
+
+    if len(todo) > 0:
+        if rsexecute.using_dask and rsexecute.client is not None:
+            from distributed import as_completed
+            futures = rsexecute.client.compute([chunk_dirty_list[ichunk] for ichunk in todo])
+            future_chunk = {future: ichunk for future, ichunk in zip(futures, todo)}
+            for future, chunk_result in as_completed(futures, with_results=True):
+                ichunk = future_chunk[future]
+                checkpoint.save_chunk(scenario, ichunk, chunk_result)
+                chunks[ichunk] = chunk_result
+        else:
+            for ichunk in todo:
+                chunk_result = rsexecute.compute(chunk_dirty_list[ichunk], sync=True)
+                checkpoint.save_chunk(scenario, ichunk, chunk_result)
+                chunks[ichunk] = chunk_result
+
+    return [chunks[ichunk] for ichunk in range(nchunks)]
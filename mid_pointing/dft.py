@@ -0,0 +1,238 @@
+"""Antenna-factorized DFT of point components with per-antenna gains
+
+The visibility of point components corrupted by direction-dependent antenna gains is
+
+    V_ij = sum_c g_ic conj(g_jc) S_c exp(-2 pi i k u_ij . s_c)
+
+where s_c = (l, m, n - 1) and k = frequency / c. The baseline vector u_ij is the difference of antenna vectors
+p_j - p_i, so the phasor factorizes per antenna and, with A_ic = g_ic exp(2 pi i k p_i . s_c),
+
+    V = A diag(S) A^H
+
+which is one matrix product per time and channel over all components. The difference of two sets of gains (e.g.
+with and without pointing errors) is a single product of the stacked matrices [A_err, A_0] with [S, -S].
+
+The conventions are those of dft_skycomponent_visibility followed by apply_gaintable(..., inverse=True). The DFTs
+need only numpy; RASCIL is imported by the functions that take RASCIL data models.
+
+With full-Jones gains the coherency matrix of the linear polarisations XX, XY, YX, YY of a baseline is
+
+    V_ij = sum_c J_ic B_c J_jc^H exp(-2 pi i k u_ij . s_c)
+
+where J_ic is the 2 x 2 Jones matrix of antenna i towards component c and B_c the brightness matrix of the
+component. This factorizes in the same way: the rows of the left matrix are (feed, antenna) and its columns
+(component, polarisation), so that all four polarisations of all baselines are one [2 nant, 2 ncomp] x
+[2 ncomp, 2 nant] product per time and channel.
+"""
+
+__all__ = ['dft_factorized', 'dft_factorized_jones', 'predict_factorized_visibility',
+           'predict_factorized_jones_visibility', 'gains_from_gaintables']
+
+import logging
+
+import numpy
+from astropy import constants
+
+log = logging.getLogger(__name__)
+
+
+def dft_factorized(antenna_uvw, frequency, direction_cosines, flux, gains=None, no_error_gains=None):
+    """ Calculate visibilities of point components as a matrix product per time and channel
+
+    The antenna vectors may be relative to any origin, e.g. to the first antenna.
+
+    :param antenna_uvw: Antenna uvw (m) [ntimes, nant, 3]
+    :param frequency: Frequencies (Hz) [nchan]
+    :param direction_cosines: (l, m, n - 1) of each component [ncomp, 3]
+    :param flux: Component fluxes [ncomp, nchan, npol]
+    :param gains: Complex voltage gains [ntimes, nant, ncomp] or [ntimes, nant, nchan, ncomp], None for unity
+    :param no_error_gains: If given, the visibility for these gains is subtracted
+    :return: Complex visibility [ntimes, nant, nant, nchan, npol]
+    """
+    antenna_uvw = numpy.asarray(antenna_uvw)
+    frequency = numpy.asarray(frequency)
+    flux = numpy.asarray(flux)
+    ntimes, nant, _ = antenna_uvw.shape
+    ncomp, nchan, npol = flux.shape
+    k = frequency / constants.c.to('m s^-1').value
+
+    def expand(g):
+        if g is None:
+            return None
+        g = numpy.asarray(g)
+        if g.ndim == 3:
+            g = g[:, :, numpy.newaxis, :]
+        return numpy.broadcast_to(g, (ntimes, nant, nchan, ncomp))
+
+    gains = expand(gains)
+    no_error_gains = expand(no_error_gains)
+
+    # The fluxes of the stacked difference are [S, -S]
+    if no_error_gains is not None:
+        flux = numpy.concatenate([flux, -flux], axis=0)
+
+    vis = numpy.zeros([ntimes, nant, nant, nchan, npol], dtype='complex')
+    for itime in range(ntimes):
+        # Geometric phase per antenna and component [nchan, nant, ncomp]
+        delay = numpy.dot(antenna_uvw[itime], direction_cosines.T)
+        a = numpy.exp(2j * numpy.pi * k[:, numpy.newaxis, numpy.newaxis] * delay[numpy.newaxis, ...])
+        if gains is not None:
+            a_err = a * numpy.moveaxis(gains[itime], 1, 0)
+        else:
+            a_err = a
+        if no_error_gains is not None:
+            a_err = numpy.concatenate([a_err, a * numpy.moveaxis(no_error_gains[itime], 1, 0)], axis=-1)
+        a_conj = numpy.conjugate(numpy.swapaxes(a_err, -1, -2))
+        for pol in range(npol):
+            # [nchan, nant, ncomp] x [nchan, ncomp, nant]
+            weighted = a_err * flux[:, :, pol].T[:, numpy.newaxis, :]
+            vis[itime, ..., pol] = numpy.moveaxis(numpy.matmul(weighted, a_conj), 0, -1)
+    return vis
+
+
+def _brightness_matrices(flux):
+    """ Brightness matrices in the linear frame of component fluxes in the stokesI or linear frame
+
+    :param flux: Component fluxes [ncomp, nchan, npol], npol 1 (stokesI) or 4 (linear)
+    :return: Brightness matrices [ncomp, nchan, 2, 2]
+    """
+    flux = numpy.asarray(flux)
+    ncomp, nchan, npol = flux.shape
+    if npol == 1:
+        return flux[..., 0, numpy.newaxis, numpy.newaxis] * numpy.identity(2)
+    assert npol == 4, "Component fluxes must be stokesI or linear, not %d polarisations" % npol
+    return flux.reshape(ncomp, nchan, 2, 2)
+
+
+def dft_factorized_jones(antenna_uvw, frequency, direction_cosines, flux, jones, no_error_jones=None):
+    """ Calculate the linear polarisation visibilities of point components with full-Jones gains
+
+    As dft_factorized, but each antenna has a 2 x 2 Jones matrix towards each component and channel, and all four
+    polarisations are made by one matrix product per time and channel.
+
+    :param antenna_uvw: Antenna uvw (m) [ntimes, nant, 3]
+    :param frequency: Frequencies (Hz) [nchan]
+    :param direction_cosines: (l, m, n - 1) of each component [ncomp, 3]
+    :param flux: Component fluxes [ncomp, nchan, npol], npol 1 (stokesI) or 4 (linear)
+    :param jones: Complex Jones matrices [ntimes, nant, nchan, ncomp, 2, 2]
+    :param no_error_jones: If given, the visibility for these Jones matrices is subtracted
+    :return: Complex visibility [ntimes, nant, nant, nchan, 4], polarisations XX, XY, YX, YY
+    """
+    antenna_uvw = numpy.asarray(antenna_uvw)
+    frequency = numpy.asarray(frequency)
+    ntimes, nant, _ = antenna_uvw.shape
+    nchan = len(frequency)
+    k = frequency / constants.c.to('m s^-1').value
+
+    # Brightness [nchan, ncomp, 2, 2], and [B, -B] for the stacked difference
+    brightness = numpy.moveaxis(_brightness_matrices(flux), 1, 0)
+    if no_error_jones is not None:
+        brightness = numpy.concatenate([brightness, -brightness], axis=1)
+    nstack = brightness.shape[1]
+
+    vis = numpy.zeros([ntimes, nant, nant, nchan, 4], dtype='complex')
+    for itime in range(ntimes):
+        # Geometric phase per antenna and component [nchan, nant, ncomp]
+        delay = numpy.dot(antenna_uvw[itime], direction_cosines.T)
+        a = numpy.exp(2j * numpy.pi * k[:, numpy.newaxis, numpy.newaxis] * delay[numpy.newaxis, ...])
+        # Phase times Jones matrix [nchan, nant, ncomp, 2, 2]
+        a_jones = a[..., numpy.newaxis, numpy.newaxis] * numpy.moveaxis(jones[itime], 1, 0)
+        if no_error_jones is not None:
+            a_jones = numpy.concatenate([a_jones, a[..., numpy.newaxis, numpy.newaxis] *
+                                         numpy.moveaxis(no_error_jones[itime], 1, 0)], axis=2)
+        # Left (J B) [nchan, (feed, antenna), (component, polarisation)] and right J with the same layout
+        left = numpy.einsum('hicpr,hcrs->hpics', a_jones, brightness).reshape(nchan, 2 * nant, 2 * nstack)
+        right = numpy.transpose(a_jones, (0, 3, 1, 2, 4)).reshape(nchan, 2 * nant, 2 * nstack)
+        coherency = numpy.matmul(left, numpy.conjugate(numpy.swapaxes(right, -1, -2)))
+        # [nchan, (p, i), (q, j)] to [i, j, nchan, (p, q)]
+        coherency = coherency.reshape(nchan, 2, nant, 2, nant)
+        vis[itime] = numpy.transpose(coherency, (2, 4, 0, 1, 3)).reshape(nant, nant, nchan, 4)
+    return vis
+
+
+def gains_from_gaintables(gt_list):
+    """ Extract the voltage gains applied by a list of GainTables, one per component
+
+    The GainTables hold the inverse of the voltage gain (zero where it could not be evaluated), as from
+    simulate_gaintable_from_pointingtable, so the gains are those applied by apply_gaintable(..., inverse=True).
+
+    :param gt_list: List of GainTables
+    :return: Complex voltage gains [ntimes, nant, nchan, ncomp]
+    """
+    stored = numpy.stack([gt.gain[..., 0, 0] for gt in gt_list], axis=-1)
+    gains = numpy.zeros_like(stored)
+    nonzero = numpy.abs(stored) > 0.0
+    gains[nonzero] = 1.0 / stored[nonzero]
+    return gains
+
+
+def predict_factorized_visibility(bvis, components, gains=None, no_error_gains=None):
+    """ Predict the visibility of point components with per-antenna gains by the antenna-factorized DFT
+
+    :param bvis: BlockVisibility, used as a template
+    :param components: List of Skycomponents
+    :param gains: Complex voltage gains [ntimes, nant, ncomp] or [ntimes, nant, nchan, ncomp], None for unity
+    :param no_error_gains: If given, the visibility for these gains is subtracted
+    :return: BlockVisibility
+    """
+    # RASCIL is imported here so that the DFTs can be used without it
+    from rascil.processing_components import copy_visibility
+
+    for comp in components:
+        assert comp.polarisation_frame == bvis.polarisation_frame, \
+            "Component polarisation %s does not match visibility %s" % (comp.polarisation_frame,
+                                                                         bvis.polarisation_frame)
+        assert comp.shape == 'Point', "Only point components are supported, not %s" % comp.shape
+
+    newbvis = copy_visibility(bvis, zero=True)
+    if len(components) == 0:
+        return newbvis
+
+    direction_cosines, flux = _component_directions_and_fluxes(bvis, components)
+    # The baseline vectors are differences of these antenna vectors
+    antenna_uvw = bvis.uvw[:, 0, :, :]
+    newbvis.data['vis'][...] = dft_factorized(antenna_uvw, bvis.frequency, direction_cosines, flux, gains=gains,
+                                              no_error_gains=no_error_gains)
+    return newbvis
+
+
+def predict_factorized_jones_visibility(bvis, components, jones, no_error_jones=None):
+    """ Predict the linear polarisation visibility of point components with full-Jones gains
+
+    :param bvis: BlockVisibility in the linear frame, used as a template
+    :param components: List of Skycomponents in the stokesI or linear frame
+    :param jones: Complex Jones matrices [ntimes, nant, nchan, ncomp, 2, 2]
+    :param no_error_jones: If given, the visibility for these Jones matrices is subtracted
+    :return: BlockVisibility
+    """
+    from rascil.processing_components import copy_visibility
+
+    assert bvis.polarisation_frame.type == 'linear', \
+        "Full-Jones prediction needs linear visibilities, not %s" % bvis.polarisation_frame
+    for comp in components:
+        assert comp.polarisation_frame.type in ['stokesI', 'linear'], \
+            "Component polarisation must be stokesI or linear, not %s" % comp.polarisation_frame
+        assert comp.shape == 'Point', "Only point components are supported, not %s" % comp.shape
+
+    newbvis = copy_visibility(bvis, zero=True)
+    if len(components) == 0:
+        return newbvis
+
+    direction_cosines, flux = _component_directions_and_fluxes(bvis, components)
+    antenna_uvw = bvis.uvw[:, 0, :, :]
+    newbvis.data['vis'][...] = dft_factorized_jones(antenna_uvw, bvis.frequency, direction_cosines, flux, jones,
+                                                    no_error_jones=no_error_jones)
+    return newbvis
+
+
+def _component_directions_and_fluxes(bvis, components):
+    """ Direction cosines (l, m, n - 1) [ncomp, 3] about the phasecentre, and fluxes [ncomp, nchan, npol]
+    """
+    from processing_library.util.coordinate_support import skycoord_to_lmn
+
+    direction_cosines = numpy.zeros([len(components), 3])
+    for icomp, comp in enumerate(components):
+        l, m, n = skycoord_to_lmn(comp.direction, bvis.phasecentre)
+        direction_cosines[icomp] = [l, m, n - 1.0]
+    flux = numpy.array([comp.flux for comp in components])
+    return direction_cosines, flux
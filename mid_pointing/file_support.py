@@ -0,0 +1,43 @@
+"""Atomic writing of files shared by the checkpoint, the product cache and the stores of PSDs and time series
+
+A file is written to a temporary file in the same directory and renamed over the target, so a job killed part way,
+or another process reading at the same time, never sees a partial file.
+"""
+
+__all__ = ['atomic_write', 'atomic_dump']
+
+import json
+import os
+import pickle
+import tempfile
+
+
+def atomic_write(filename, write, binary=True):
+    """ Write a file atomically
+
+    :param filename: Name of the file
+    :param write: Function called with the open temporary file to write the contents
+    :param binary: Open the temporary file in binary mode?
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w') as f:
+            write(f)
+        os.replace(tmpname, filename)
+    except BaseException:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+
+def atomic_dump(obj, filename, use_json=False):
+    """ Pickle (or write as JSON) an object to a file atomically
+
+    :param obj: Object to write
+    :param filename: Name of the file
+    :param use_json: Write JSON rather than a pickle?
+    """
+    if use_json:
+        atomic_write(filename, lambda f: json.dump(obj, f, indent=2), binary=False)
+    else:
+        atomic_write(filename, lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
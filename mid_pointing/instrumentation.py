@@ -0,0 +1,253 @@
+"""Per-stage timing and memory instrumentation of the distributed simulation
+
+A StageTimer wraps each stage of the processing. For each stage it records the wall time and, when running with
+Dask, the number of tasks run (from the scheduler's task stream), the bytes transferred between workers (from the
+workers' incoming transfer logs), the peak memory of any worker within the stage (from the workers' system
+monitors) and the peak memory of any worker since it started. Graphs built within a stage are persisted and waited
+for, so that each stage's tasks fall within its time window. The task stream of the whole run can be written as a
+Chrome trace (chrome://tracing or https://ui.perfetto.dev).
+"""
+
+__all__ = ['StageTimer']
+
+import contextlib
+import json
+import logging
+import resource
+import time
+
+from workflows.rsexecute.execution_support.rsexecute import rsexecute
+
+log = logging.getLogger(__name__)
+
+STAGE_FIELDS = ['time', 'ntasks', 'bytes', 'peak_memory', 'cumulative_peak_memory']
+
+
+def _empty_stats():
+    """ Statistics of a stage before it is measured
+    """
+    return {'time': 0.0, 'ntasks': 0, 'bytes': 0, 'peak_memory': float('nan'), 'cumulative_peak_memory': 0.0}
+
+
+def _max_rss():
+    """ Peak resident set size (bytes) of this process since it started
+    """
+    return 1024 * resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _worker_max_rss(dask_worker=None):
+    """ Peak resident set size (bytes) of a worker process since it started, run on the worker
+    """
+    return _max_rss()
+
+
+def _stage_peak_memory(baseline, cumulative):
+    """ Peak memory (bytes) within a stage from the peak resident set size at its start and end
+
+    The peak resident set size cannot be reset, so it only measures the stage if the stage raised it; otherwise the
+    peak within the stage is unknown (nan).
+    """
+    if cumulative > baseline:
+        return float(cumulative)
+    return float('nan')
+
+
+def _worker_peak_memory(start, stop, baseline=0, dask_worker=None):
+    """ Peak memory (bytes) of a worker between start and stop, and its peak since it started, run on the worker
+
+    The system monitor samples are used if available, otherwise the peak resident set size of the process compared
+    with its value at the start of the stage (baseline).
+
+    :return: (peak within the stage, or nan if unknown, cumulative peak)
+    """
+    cumulative = _max_rss()
+    monitor = getattr(dask_worker, 'monitor', None)
+    if monitor is not None:
+        quantities = getattr(monitor, 'quantities', None)
+        if quantities is not None:
+            times, memory = quantities['time'], quantities['memory']
+        else:
+            times, memory = monitor.time, monitor.memory
+        samples = [m for t, m in zip(times, memory) if start <= t <= stop]
+        if len(samples) > 0:
+            return float(max(samples)), cumulative
+    return _stage_peak_memory(baseline, cumulative), cumulative
+
+
+def _nanmax(a, b):
+    """ Maximum of two numbers, ignoring nan
+    """
+    if a != a:
+        return b
+    if b != b:
+        return a
+    return max(a, b)
+
+
+def _worker_transfer_bytes(start, stop, dask_worker=None):
+    """ Bytes received by a worker from other workers between start and stop, run on the worker
+    """
+    transfer_log = getattr(dask_worker, 'incoming_transfer_log', [])
+    return sum(transfer['total'] for transfer in transfer_log if start <= transfer['start'] <= stop)
+
+
+def _startstops(record):
+    """ (action, start, stop) of a task stream record, for old and new versions of distributed
+    """
+    for startstop in record.get('startstops', []):
+        if isinstance(startstop, dict):
+            yield startstop['action'], startstop['start'], startstop['stop']
+        else:
+            yield startstop[0], startstop[1], startstop[2]
+
+
+class StageTimer:
+    """ Collect wall time, task counts, bytes transferred and peak worker memory per stage
+
+    The peak memory within a stage comes from the Dask workers' system monitors. Without them (or without Dask) it
+    falls back to the peak resident set size, which is the peak since the process started: it is only attributed to
+    the stage if the stage raised it, and is nan otherwise. The cumulative peak is always recorded as well.
+
+    Usage::
+
+        timer = StageTimer(enabled=True)
+        with timer.stage('psf'):
+            psf_list = timer.persist(invert_list_rsexecute_workflow(...))
+        result.update(timer.columns())
+
+    If not enabled, stage does nothing and persist returns the graph unchanged so that the processing is unaltered.
+    """
+
+    def __init__(self, enabled=True, trace=False):
+        """ Stage timer
+
+        :param enabled: Collect statistics?
+        :param trace: Keep the task stream records for a Chrome trace?
+        """
+        self.enabled = enabled
+        self.trace = trace
+        self.stages = dict()
+        self.spans = list()
+        self.records = list()
+        self.client = rsexecute.client if enabled and rsexecute.using_dask else None
+        if self.client is not None:
+            # The first request registers the task stream plugin on the scheduler
+            self.client.get_task_stream(start=time.time())
+
+    def wait(self, graph):
+        """ Wait for a persisted graph so that its tasks run within the current stage
+
+        :param graph: Persisted graph or list of graphs
+        :return: graph
+        """
+        if self.client is not None:
+            from distributed import wait, futures_of
+            wait(futures_of(graph))
+        return graph
+
+    def persist(self, graph):
+        """ Persist a graph and wait for it so that its tasks run within the current stage
+
+        :param graph: Graph, list of graphs or list of lists of graphs
+        :return: Persisted graph (or the graph unchanged if not enabled)
+        """
+        if not self.enabled:
+            return graph
+        if isinstance(graph, list) and len(graph) > 0 and isinstance(graph[0], list):
+            return [self.persist(g) for g in graph]
+        return self.wait(rsexecute.persist(graph))
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Context manager for a stage; statistics accumulate over repeated uses of the same name
+
+        :param name: Name of stage
+        """
+        if not self.enabled:
+            yield
+            return
+
+        if self.client is not None:
+            baselines = self.client.run(_worker_max_rss)
+        else:
+            baselines = {None: _max_rss()}
+        start = time.time()
+        yield
+        stop = time.time()
+
+        stats = self.stages.setdefault(name, _empty_stats())
+        stats['time'] += stop - start
+        self.spans.append((name, start, stop))
+
+        if self.client is not None:
+            records = self.client.get_task_stream(start=start, stop=stop)
+            stats['ntasks'] += len(records)
+            stats['bytes'] += sum(self.client.run(_worker_transfer_bytes, start, stop).values())
+            peaks = [self.client.run(_worker_peak_memory, start, stop, baseline, workers=[worker])[worker]
+                     for worker, baseline in baselines.items()]
+            if self.trace:
+                self.records.extend([dict(record, stage=name) for record in records])
+        else:
+            cumulative = _max_rss()
+            peaks = [(_stage_peak_memory(baselines[None], cumulative), cumulative)]
+
+        gb = 1024.0 * 1024.0 * 1024.0
+        for peak, cumulative in peaks:
+            stats['peak_memory'] = _nanmax(stats['peak_memory'], peak / gb)
+            stats['cumulative_peak_memory'] = max(stats['cumulative_peak_memory'], cumulative / gb)
+
+        log.info("StageTimer: %s took %.3f (s)" % (name, stop - start))
+
+    def reset(self, names):
+        """ Clear the statistics of some stages, e.g. those repeated for each scenario
+
+        :param names: Names of stages
+        """
+        for name in names:
+            self.stages.pop(name, None)
+
+    def columns(self, names=None):
+        """ Statistics as a flat dict, suitable for adding to a result row
+
+        :param names: Names of stages (default all)
+        :return: dict with <stage>_time (s), <stage>_ntasks, <stage>_bytes, <stage>_peak_memory (GB, peak within the
+            stage or nan if unknown) and <stage>_cumulative_peak_memory (GB, peak since the process started)
+        """
+        if not self.enabled:
+            return dict()
+        if names is None:
+            names = self.stages.keys()
+        columns = dict()
+        for name in names:
+            stats = self.stages.get(name, _empty_stats())
+            for field in STAGE_FIELDS:
+                columns['%s_%s' % (name, field)] = stats[field]
+        return columns
+
+    def write_chrome_trace(self, filename):
+        """ Write the stages and task stream as a Chrome trace
+
+        The stages appear as spans of the client; the tasks as spans of each worker thread.
+
+        :param filename: Name of JSON file
+        """
+        if len(self.spans) == 0:
+            return
+        origin = min(start for _, start, _ in self.spans)
+
+        def microseconds(t):
+            return 1e6 * (t - origin)
+
+        events = [{'name': name, 'cat': 'stage', 'ph': 'X', 'ts': microseconds(start),
+                   'dur': microseconds(stop) - microseconds(start), 'pid': 'client', 'tid': 'stages'}
+                  for name, start, stop in self.spans]
+        for record in self.records:
+            for action, start, stop in _startstops(record):
+                events.append({'name': '%s %s' % (action, record['key']), 'cat': record['stage'], 'ph': 'X',
+                               'ts': microseconds(start), 'dur': microseconds(stop) - microseconds(start),
+                               'pid': record.get('worker', 'worker'), 'tid': record.get('thread', 0),
+                               'args': {'nbytes': record.get('nbytes', 0)}})
+
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        log.info("StageTimer: Chrome trace written to %s" % filename)
@@ -0,0 +1,221 @@
+"""Planning of the time chunking, component grouping and image size to fit a memory budget
+
+The memory of each stage of the distributed simulation is predicted from the observation and sky parameters. Per
+worker, the peak is the share of the persisted data (visibilities, voltage patterns, gaintables) plus one task of
+the stage for each thread. The planner searches the parameters that are not fixed by the user for the plan with the
+largest images and time chunks that fits the memory per worker.
+"""
+
+__all__ = ['count_chunk_times', 'estimate_memory', 'plan_simulation', 'print_plan']
+
+import logging
+
+import numpy
+
+from processing_library.util.coordinate_support import hadec_to_azel
+
+from mid_pointing.vp_sampler import SAMPLER_CACHE_SIZE
+
+log = logging.getLogger(__name__)
+
+GB = 1024.0 * 1024.0 * 1024.0
+
+# Bytes per time per antenna pair in a BlockVisibility (uvw) and per channel-polarisation (vis, weight,
+# imaging_weight, flags)
+BLOCKVIS_BYTES_PER_ROW = 24
+BLOCKVIS_BYTES_PER_SAMPLE = 16 + 8 + 8 + 4
+# Bytes per row in a Visibility (uvw, time, frequency, channel_bandwidth, integration_time, antennas, index) and
+# per polarisation (vis, weight, imaging_weight, flags)
+VIS_BYTES_PER_ROW = 24 + 8 + 8 + 8 + 8 + 16 + 8
+VIS_BYTES_PER_POL = 16 + 8 + 8 + 4
+# Bytes per element in the construction of the gains: offsets, pixel locations and intermediate angles
+GAIN_BYTES_PER_ELEMENT = 64
+
+
+def count_chunk_times(time_range, time_chunk, integration_time, declination, latitude,
+                      elevation_limit=15.0 * numpy.pi / 180.0):
+    """ Count the chunks and integrations per chunk of an observation
+
+    The chunks follow create_standard_mid_simulation_rsexecute_workflow: chunks are time_chunk long from the start of
+    the time range, and a chunk is kept if the phasecentre is above the elevation limit at its start or end.
+
+    :param time_range: Hour angle range (hours)
+    :param time_chunk: Length of a chunk (s)
+    :param integration_time: Integration time (s)
+    :param declination: Declination of the phasecentre (rad)
+    :param latitude: Latitude of the array (rad)
+    :param elevation_limit: Elevation limit (rad)
+    :return: number of chunks, integrations per chunk
+    """
+    start_times = numpy.arange(time_range[0] * 3600.0, time_range[1] * 3600.0, time_chunk)
+    end_times = start_times + time_chunk
+    s2r = numpy.pi / 43200.0
+    _, start_elevation = hadec_to_azel(s2r * start_times, declination, latitude)
+    _, end_elevation = hadec_to_azel(s2r * end_times, declination, latitude)
+    nchunks = int(numpy.sum((start_elevation > elevation_limit) | (end_elevation > elevation_limit)))
+    ntimes_chunk = int(numpy.ceil(time_chunk / integration_time))
+    return nchunks, ntimes_chunk
+
+
+def estimate_memory(nants, ntimes_chunk, nchunks, ncomps, nscenarios, npixel, pb_npixel, component_group,
+                    nworkers, nthreads=1, nchan=1, npol=1, multi_scenario=False, nvp_gradients=0, padding=2,
+                    full_jones=False, error_free_vis=False):
+    """ Predict the memory of each stage of the simulation
+
+    :param nants: Number of antennas
+    :param ntimes_chunk: Integrations per chunk
+    :param nchunks: Number of chunks
+    :param ncomps: Number of components
+    :param nscenarios: Number of scenarios
+    :param npixel: Number of pixels on a side of the images
+    :param pb_npixel: Number of pixels on a side of the voltage pattern
+    :param component_group: Number of components per residual task
+    :param nworkers: Number of workers
+    :param nthreads: Number of threads per worker
+    :param nchan: Number of channels
+    :param npol: Number of polarisations
+    :param multi_scenario: Are the gains for all scenarios constructed in one pass (and persisted)?
+    :param nvp_gradients: Number of voltage pattern gradient images
+    :param padding: Padding of the imaging grid
+    :param full_jones: Are the gains 2 x 2 Jones matrices from all 4 polarisations of the voltage pattern?
+    :param error_free_vis: Is the error-free visibility of each chunk predicted once (and persisted)?
+    :return: dict of GB per task for each stage, and of persisted GB per worker
+    """
+    # Elements of the gain of each antenna and component, and polarisations sampled from the voltage pattern
+    njones = 4 if full_jones else 1
+    nbaselines = nants * (nants - 1) // 2
+    bvis = ntimes_chunk * nants * nants * (BLOCKVIS_BYTES_PER_ROW + nchan * npol * BLOCKVIS_BYTES_PER_SAMPLE)
+    vis = ntimes_chunk * nbaselines * nchan * (VIS_BYTES_PER_ROW + npol * VIS_BYTES_PER_POL)
+    image = 8 * nchan * npol * npixel * npixel
+    grid = 16 * nchan * npol * (padding * npixel) ** 2
+    vp = 16 * njones * nchan * pb_npixel * pb_npixel
+    # The samplers hold complex spline coefficients of each channel of the voltage pattern and its gradients, and the
+    # most recently used are kept by each worker
+    splines = (1 + nvp_gradients) * 16 * njones * nchan * pb_npixel * pb_npixel
+    gaintable = ntimes_chunk * nants * nchan * (16 + 8 + 8)
+    gain_stack = 16 * njones * (nscenarios + 1) * ntimes_chunk * nants * nchan * ncomps
+
+    stages = dict()
+    stages['bvis'] = bvis + vis
+    stages['weighting'] = 2 * vis + grid
+    stages['psf'] = vis + grid + 2 * image
+    # The voltage pattern is reprojected from the beam model
+    stages['vp'] = 4 * vp + nvp_gradients * vp
+    stages['gaintable'] = (vp * (1 + nvp_gradients) + splines + 2 * ncomps * gaintable +
+                           GAIN_BYTES_PER_ELEMENT * njones * (nscenarios + 1 if multi_scenario else 1) *
+                           ntimes_chunk * nants * nchan * ncomps)
+    # Residual visibilities, the gains of a group of components and, per integration, the stacked antenna matrices of
+    # the factorized DFT
+    stages['residual'] = (2 * bvis + 2 * component_group * gaintable +
+                          3 * 2 * 16 * njones * nchan * nants * component_group)
+    # The groups of a chunk are summed pairwise, each task holding two residual visibility sets and their sum
+    stages['sum'] = 3 * bvis + vis
+    stages['invert'] = vis + grid + 2 * image
+
+    chunks_per_worker = int(numpy.ceil(nchunks / nworkers))
+    persisted = chunks_per_worker * (bvis + vis + vp * (1 + nvp_gradients) + 2 * ncomps * gaintable) + image + \
+        min(SAMPLER_CACHE_SIZE, chunks_per_worker * (1 + nvp_gradients)) * 16 * njones * nchan * pb_npixel * pb_npixel
+    if multi_scenario:
+        persisted += chunks_per_worker * gain_stack
+    if error_free_vis:
+        persisted += chunks_per_worker * bvis
+
+    memory = {stage: stages[stage] / GB for stage in stages}
+    memory['persisted'] = persisted / GB
+    memory['peak'] = memory['persisted'] + nthreads * max(stages.values()) / GB
+    return memory
+
+
+def plan_simulation(memory, nworkers, nthreads, nants, ncomps, nscenarios, time_range, integration_time,
+                    declination, latitude, time_chunk=None, component_group=None, npixel=None, pb_npixel=1024,
+                    multi_scenario=False, nvp_gradients=0, nchan=1, full_jones=False, error_free_vis=False,
+                    time_chunks=(1800.0, 900.0, 600.0, 300.0, 120.0, 60.0),
+                    npixels=(512, 256)):
+    """ Choose the time chunk, component grouping and image size to fit the memory per worker
+
+    Parameters given as None are chosen by the planner; others are fixed. Larger images are preferred, then longer
+    time chunks (fewer tasks). The component grouping gives about one residual task per thread, reduced if the
+    residual tasks do not fit.
+
+    :param memory: Memory per worker (GB)
+    :param nworkers: Number of workers
+    :param nthreads: Number of threads per worker
+    :param nants: Number of antennas
+    :param ncomps: Number of components
+    :param nscenarios: Number of scenarios
+    :param time_range: Hour angle range (hours)
+    :param integration_time: Integration time (s)
+    :param declination: Declination of the phasecentre (rad)
+    :param latitude: Latitude of the array (rad)
+    :param time_chunk: Length of a chunk (s), None to plan
+    :param component_group: Number of components per residual task, None to plan
+    :param npixel: Number of pixels on a side of the images, None to plan
+    :param pb_npixel: Number of pixels on a side of the voltage pattern
+    :param multi_scenario: Are the gains for all scenarios constructed in one pass?
+    :param nvp_gradients: Number of voltage pattern gradient images
+    :param nchan: Number of frequency channels
+    :param full_jones: Are the gains 2 x 2 Jones matrices, and the visibilities and images polarised?
+    :param error_free_vis: Is the error-free visibility of each chunk predicted once (and persisted)?
+    :param time_chunks: Candidate time chunks (s); those shorter than the integration time are skipped
+    :param npixels: Candidate image sizes
+    :return: plan dict, with 'fits' False if no plan fits (in which case the smallest plan is returned)
+    """
+    if time_chunk is not None:
+        time_chunks = [time_chunk]
+    else:
+        time_chunks = [tc for tc in time_chunks if tc >= integration_time] or [integration_time]
+    if npixel is not None:
+        npixels = [npixel]
+
+    def groupings(nchunks):
+        if component_group is not None:
+            return [component_group]
+        # Enough residual tasks to occupy all the threads, then smaller groups
+        group = min(ncomps, max(1, int(numpy.ceil(ncomps * nchunks / (nworkers * nthreads)))))
+        candidates = [group]
+        while group > 1:
+            group = max(1, group // 2)
+            candidates.append(group)
+        return candidates
+
+    plan = None
+    for npix in npixels:
+        for tc in time_chunks:
+            nchunks, ntimes_chunk = count_chunk_times(time_range, tc, integration_time, declination, latitude)
+            for group in groupings(nchunks):
+                estimate = estimate_memory(nants, ntimes_chunk, nchunks, ncomps, nscenarios, npix, pb_npixel,
+                                           group, nworkers, nthreads=nthreads, nchan=nchan,
+                                           npol=4 if full_jones else 1, multi_scenario=multi_scenario,
+                                           nvp_gradients=nvp_gradients, full_jones=full_jones,
+                                           error_free_vis=error_free_vis)
+                plan = {'time_chunk': tc, 'nchunks': nchunks, 'ntimes_chunk': ntimes_chunk,
+                        'component_group': group, 'npixel': npix, 'pb_npixel': pb_npixel, 'memory': memory,
+                        'multi_scenario': multi_scenario, 'error_free_vis': error_free_vis, 'estimate': estimate,
+                        'fits': estimate['peak'] <= memory}
+                if plan['fits']:
+                    return plan
+
+    log.warning("plan_simulation: no plan fits in %.1f GB per worker" % memory)
+    return plan
+
+
+def print_plan(plan):
+    """ Print a plan from plan_simulation
+    """
+    print("Plan for %.1f GB per worker:" % plan['memory'])
+    print("    Time chunk %.1f (s): %d chunks of %d integrations" % (plan['time_chunk'], plan['nchunks'],
+                                                                     plan['ntimes_chunk']))
+    print("    Residual visibilities accumulated in groups of %d components" % plan['component_group'])
+    if plan['multi_scenario']:
+        print("    Gains of all scenarios constructed in one pass and persisted")
+    if plan['error_free_vis']:
+        print("    Error-free visibilities predicted once and persisted")
+    print("    Images %d pixels, voltage patterns %d pixels" % (plan['npixel'], plan['pb_npixel']))
+    print("    Predicted memory per task (GB):")
+    for stage, size in plan['estimate'].items():
+        if stage not in ['persisted', 'peak']:
+            print("        %-10s %.3f" % (stage, size))
+    print("    Persisted data per worker = %.3f GB" % plan['estimate']['persisted'])
+    print("    Predicted peak per worker = %.3f GB" % plan['estimate']['peak'])
+    if not plan['fits']:
+        print("    This plan does not fit")
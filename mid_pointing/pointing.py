@@ -0,0 +1,342 @@
+"""Vectorised evaluation of voltage pattern gains at pointing offsets
+
+RASCIL's simulate_gaintable_from_pointingtable evaluates the voltage pattern one antenna at a time, with a WCS copy
+and a pair of spline evaluations per time, antenna and component. The functions here calculate the same gains using
+array operations. The pointing offsets may carry any number of leading axes (e.g. one per scenario) so that a whole
+stack of scenarios is sampled in one interpolation call. The spline coefficients of a voltage pattern are solved for
+once per worker process (see vp_sampler.py) and shared by every call that samples it. A voltage pattern with several
+channels (e.g. from a beam cube, see voltage_pattern.py) gives gains with a channel axis before the component axis.
+
+For small offsets the gains can instead be linearized: the voltage pattern and its gradients are sampled once at the
+error-free locations and each mispointed gain is g0 + dx.dg/dx + dy.dg/dy (optionally with second order terms).
+
+For a full-Jones simulation all four polarisations of a voltage pattern made from the EMSS beams are sampled in the
+same pass and arranged as a 2 x 2 Jones matrix per antenna and component.
+
+A Zernike fit of the beam (see beam_fit.py) can stand in for the voltage pattern image: its gains are evaluated
+directly at the offsets, so the cost does not depend on the resolution of an image.
+"""
+
+__all__ = ['vp_pixel_locations', 'sample_vp_channels', 'sample_vp_jones',
+           'simulate_gains_from_pointing_offsets', 'simulate_gains_from_beam_fit', 'create_vp_gradients',
+           'simulate_linearized_gains_from_pointing_offsets', 'create_gaintables_from_gains']
+
+import logging
+
+import numpy
+
+from processing_library.image.operations import create_empty_image_like
+from processing_library.util.coordinate_support import hadec_to_azel
+from rascil.processing_components import create_gaintable_from_blockvisibility
+
+from mid_pointing.vp_sampler import get_vp_sampler
+
+log = logging.getLogger(__name__)
+
+# Polarisations of a voltage pattern made from the EMSS terms Jpv, Jqh, Jph, Jqv (see beam_import.py) in each element
+# of the Jones matrix, whose rows are the feeds p and q and columns the v and h fields: [[Jpv, Jph], [Jqv, Jqh]]
+JONES_MATRIX_POLARISATIONS = ((0, 2), (3, 1))
+
+
+def _sin_projection(lon, lat, lon0, lat0):
+    """ Direction cosines of (lon, lat) in a SIN projection about (lon0, lat0). All angles in radians.
+    """
+    l = numpy.cos(lat) * numpy.sin(lon - lon0)
+    m = numpy.sin(lat) * numpy.cos(lat0) - numpy.cos(lat) * numpy.sin(lat0) * numpy.cos(lon - lon0)
+    return l, m
+
+
+def _component_direction_cosines(bvis, components, offsets, use_radec=False,
+                                 elevation_limit=15.0 * numpy.pi / 180.0):
+    """ Direction cosines of each component about the pointing of each mispointed antenna
+
+    :return: l, m [..., ntimes, nant, ncomp], boolean mask of times above elevation limit [ntimes]
+    """
+    if not use_radec:
+        assert bvis.configuration.mount[0] == 'azel', "Mount %s not supported yet" % bvis.configuration.mount[0]
+
+    offsets = numpy.asarray(offsets)
+    ntimes = len(bvis.time)
+    assert offsets.shape[-3] == ntimes, "Offsets have %d times, visibility has %d" % (offsets.shape[-3], ntimes)
+
+    # The time in the BlockVisibility is hour angle in seconds!
+    s2r = numpy.pi / 43200.0
+    har = s2r * bvis.time
+    latitude = bvis.configuration.location.lat.rad
+    ra0 = bvis.phasecentre.ra.rad
+    dec0 = bvis.phasecentre.dec.rad
+
+    comp_ra = numpy.array([comp.direction.ra.rad for comp in components])
+    comp_dec = numpy.array([comp.direction.dec.rad for comp in components])
+
+    azimuth_centre, elevation_centre = hadec_to_azel(har, dec0, latitude)
+    above_limit = elevation_centre >= elevation_limit
+
+    if not use_radec:
+        # Component locations [ntimes, ncomp] and antenna pointings [..., ntimes, nant] in AZELGEO
+        lon_comp, lat_comp = hadec_to_azel(comp_ra[numpy.newaxis, :] - ra0 + har[:, numpy.newaxis],
+                                           comp_dec[numpy.newaxis, :], latitude)
+        lon_point = azimuth_centre[:, numpy.newaxis] + offsets[..., 0] / numpy.cos(elevation_centre)[:, numpy.newaxis]
+        lat_point = elevation_centre[:, numpy.newaxis] + offsets[..., 1]
+        lon_comp = lon_comp[:, numpy.newaxis, :]
+        lat_comp = lat_comp[:, numpy.newaxis, :]
+    else:
+        lon_comp = comp_ra[numpy.newaxis, numpy.newaxis, :]
+        lat_comp = comp_dec[numpy.newaxis, numpy.newaxis, :]
+        lon_point = ra0 + offsets[..., 0] / numpy.cos(dec0)
+        lat_point = dec0 + offsets[..., 1]
+
+    l, m = _sin_projection(lon_comp, lat_comp, lon_point[..., numpy.newaxis], lat_point[..., numpy.newaxis])
+    return l, m, above_limit
+
+
+def vp_pixel_locations(bvis, components, vp, offsets, use_radec=False,
+                       elevation_limit=15.0 * numpy.pi / 180.0):
+    """ Calculate the pixel locations in a voltage pattern of each component as seen by each mispointed antenna
+
+    The geometry follows simulate_gaintable_from_pointingtable: in the local (AZELGEO) frame the antenna points
+    at the azimuth and elevation of the phasecentre displaced by the offsets, with the first offset axis being
+    cross-elevation. In the RADEC frame the pointing centre is the phasecentre displaced in the same way.
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param vp: Voltage pattern image
+    :param offsets: Pointing offsets (rad) [..., ntimes, nant, 2]
+    :param use_radec: Calculate in RADEC rather than AZELGEO?
+    :param elevation_limit: Times with the phasecentre below this elevation (rad) are not sampled
+    :return: x pixel, y pixel [..., ntimes, nant, ncomp], boolean mask of times above elevation limit [ntimes]
+    """
+    if not use_radec:
+        assert vp.wcs.wcs.ctype[0] == 'AZELGEO long', vp.wcs.wcs.ctype[0]
+        assert vp.wcs.wcs.ctype[1] == 'AZELGEO lati', vp.wcs.wcs.ctype[1]
+    l, m, above_limit = _component_direction_cosines(bvis, components, offsets, use_radec=use_radec,
+                                                     elevation_limit=elevation_limit)
+
+    # As in world2pix with origin 1, these are one-relative pixel locations
+    r2d = 180.0 / numpy.pi
+    cdelt = vp.wcs.wcs.cdelt
+    crpix = vp.wcs.wcs.crpix
+    x = crpix[0] + r2d * l / cdelt[0]
+    y = crpix[1] + r2d * m / cdelt[1]
+
+    return x, y, above_limit
+
+
+def sample_vp_channels(vp, x, y, order=3):
+    """ Sample the first polarisation of every channel of a voltage pattern at arrays of pixel locations
+
+    The channels share the pixel grid, so the locations are the same for all and every channel is sampled in one
+    pass by the VoltagePatternSampler of the voltage pattern. Locations within three pixels of the edge of the
+    voltage pattern give a gain of zero.
+
+    :param vp: Voltage pattern image
+    :param x: x pixel locations [..., ncomp]
+    :param y: y pixel locations [..., ncomp]
+    :param order: Order of spline (default is 3)
+    :return: Complex gains [..., ncomp] for one channel, else [..., nchan, ncomp]
+    """
+    gains = get_vp_sampler(vp, order=order, polarisations=[0]).sample(numpy.stack([x, y], axis=-1))[..., 0]
+    if vp.data.shape[0] == 1:
+        return gains[..., 0]
+    return numpy.moveaxis(gains, -1, -2)
+
+
+def sample_vp_jones(vp, x, y, order=3):
+    """ Sample the Jones matrix of every channel of a voltage pattern at arrays of pixel locations
+
+    All four polarisations of all channels are sampled in one pass by the VoltagePatternSampler of the voltage
+    pattern, and arranged as JONES_MATRIX_POLARISATIONS.
+
+    :param vp: Voltage pattern image with 4 polarisations
+    :param x: x pixel locations [..., ncomp]
+    :param y: y pixel locations [..., ncomp]
+    :param order: Order of spline (default is 3)
+    :return: Complex Jones matrices [..., nchan, ncomp, 2, 2]
+    """
+    npol = vp.data.shape[1]
+    assert npol == 4, "Full-Jones gains need a voltage pattern with 4 polarisations, not %d" % npol
+    values = get_vp_sampler(vp, order=order).sample(numpy.stack([x, y], axis=-1))
+    return numpy.moveaxis(values[..., numpy.array(JONES_MATRIX_POLARISATIONS)], -3, -4)
+
+
+def _set_identity_below_limit(jones, above_limit):
+    """ Set the Jones matrices of the times below the elevation limit to the identity, the time axis being the sixth
+    from the end
+    """
+    index = [slice(None)] * jones.ndim
+    index[jones.ndim - 6] = ~above_limit
+    jones[tuple(index)] = numpy.identity(2)
+    return jones
+
+
+def _set_unit_gain_below_limit(gains, above_limit, nchan):
+    """ Set the gains of the times below the elevation limit to one, the time axis being the third from the end
+    (fourth if there is a channel axis)
+    """
+    index = [slice(None)] * gains.ndim
+    index[gains.ndim - (3 if nchan == 1 else 4)] = ~above_limit
+    gains[tuple(index)] = 1.0
+    return gains
+
+
+def simulate_gains_from_pointing_offsets(bvis, components, offsets, vp, use_radec=False,
+                                         elevation_limit=15.0 * numpy.pi / 180.0, order=3, full_jones=False):
+    """ Calculate the voltage pattern gain for each component for a stack of pointing offsets
+
+    All leading axes of offsets (e.g. scenarios) are sampled in one call. Times below the elevation limit have
+    unit gain. A voltage pattern with several channels gives gains per channel. With full_jones the gains are the
+    Jones matrices of a voltage pattern with 4 polarisations, per channel.
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param offsets: Pointing offsets (rad) [..., ntimes, nant, 2]
+    :param vp: Voltage pattern image
+    :param use_radec: Calculate in RADEC rather than AZELGEO?
+    :param elevation_limit: Elevation limit (rad)
+    :param order: Order of spline (default is 3)
+    :param full_jones: Calculate the Jones matrices rather than the gain of the first polarisation?
+    :return: Complex voltage gains [..., ntimes, nant, ncomp], or [..., ntimes, nant, nchan, ncomp] for nchan > 1,
+        or Jones matrices [..., ntimes, nant, nchan, ncomp, 2, 2] for full_jones
+    """
+    x, y, above_limit = vp_pixel_locations(bvis, components, vp, offsets, use_radec=use_radec,
+                                           elevation_limit=elevation_limit)
+    if full_jones:
+        return _set_identity_below_limit(sample_vp_jones(vp, x, y, order=order), above_limit)
+    gains = sample_vp_channels(vp, x, y, order=order)
+    return _set_unit_gain_below_limit(gains, above_limit, vp.data.shape[0])
+
+
+def simulate_gains_from_beam_fit(bvis, components, offsets, beam_fit, use_radec=False,
+                                 elevation_limit=15.0 * numpy.pi / 180.0, full_jones=False):
+    """ Calculate the voltage pattern gain for each component for a stack of pointing offsets from beam fits
+
+    As simulate_gains_from_pointing_offsets, with a beam fit per channel in place of the channels of a voltage
+    pattern image. The fits have the orientation of the voltage pattern of import_beam, whose longitude axis decreases
+    along its columns.
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param offsets: Pointing offsets (rad) [..., ntimes, nant, 2]
+    :param beam_fit: ZernikeBeamFit, e.g. from read_beam_fit, or a list of fits, one per channel, e.g. from
+        create_beam_fits_from_file
+    :param use_radec: Calculate in RADEC rather than AZELGEO?
+    :param elevation_limit: Elevation limit (rad)
+    :param full_jones: Calculate the Jones matrices rather than the gain of the first Jones term?
+    :return: Complex voltage gains [..., ntimes, nant, ncomp], or [..., ntimes, nant, nchan, ncomp] for nchan > 1,
+        or Jones matrices [..., ntimes, nant, nchan, ncomp, 2, 2] for full_jones
+    """
+    fits = beam_fit if isinstance(beam_fit, (list, tuple)) else [beam_fit]
+    l, m, above_limit = _component_direction_cosines(bvis, components, offsets, use_radec=use_radec,
+                                                     elevation_limit=elevation_limit)
+    r2d = 180.0 / numpy.pi
+    if full_jones:
+        assert fits[0].njones == 4, "Full-Jones gains need a beam fit with 4 Jones terms, not %d" % fits[0].njones
+        values = numpy.stack([fit.evaluate(-r2d * l, r2d * m) for fit in fits], axis=-3)
+        return _set_identity_below_limit(values[..., numpy.array(JONES_MATRIX_POLARISATIONS)], above_limit)
+    gains = numpy.stack([fit.evaluate(-r2d * l, r2d * m)[..., 0] for fit in fits], axis=-2)
+    if len(fits) == 1:
+        gains = gains[..., 0, :]
+    return _set_unit_gain_below_limit(gains, above_limit, len(fits))
+
+
+def create_vp_gradients(vp, second_order=False):
+    """ Calculate the gradient images of a voltage pattern
+
+    The gradients are per pixel, calculated by central differences.
+
+    :param vp: Voltage pattern image
+    :param second_order: Also calculate the second derivatives?
+    :return: List of images: [gradx, grady] or [gradx, grady, gradxx, gradxy, gradyy]
+    """
+    def gradient(data, axis):
+        im = create_empty_image_like(vp)
+        im.data = numpy.gradient(data, axis=axis)
+        return im
+
+    gradx = gradient(vp.data, -1)
+    grady = gradient(vp.data, -2)
+    if not second_order:
+        return [gradx, grady]
+
+    gradxx = gradient(gradx.data, -1)
+    gradxy = gradient(gradx.data, -2)
+    gradyy = gradient(grady.data, -2)
+    return [gradx, grady, gradxx, gradxy, gradyy]
+
+
+def simulate_linearized_gains_from_pointing_offsets(bvis, components, offsets, vp, vp_gradients,
+                                                    use_radec=False, elevation_limit=15.0 * numpy.pi / 180.0,
+                                                    order=3, full_jones=False):
+    """ Calculate the voltage pattern gain for each component using a Taylor expansion about the error-free pointing
+
+    The voltage pattern and its gradients are sampled only at the error-free locations, which do not depend on
+    antenna or scenario. Each gain is then g0 + dx.gradx + dy.grady, where (dx, dy) is the pixel displacement caused
+    by the pointing offset. If second derivatives are supplied, the second order terms are added. For offsets of a
+    few arcsec the linear form is accurate to well below a percent of the gain error.
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param offsets: Pointing offsets (rad) [..., ntimes, nant, 2]
+    :param vp: Voltage pattern image
+    :param vp_gradients: Gradient images from create_vp_gradients
+    :param use_radec: Calculate in RADEC rather than AZELGEO?
+    :param elevation_limit: Elevation limit (rad)
+    :param order: Order of spline (default is 3)
+    :param full_jones: Calculate the Jones matrices rather than the gain of the first polarisation?
+    :return: Complex voltage gains [..., ntimes, nant, ncomp], or [..., ntimes, nant, nchan, ncomp] for nchan > 1,
+        or Jones matrices [..., ntimes, nant, nchan, ncomp, 2, 2] for full_jones
+    """
+    offsets = numpy.asarray(offsets)
+    ntimes = len(bvis.time)
+    nchan = vp.data.shape[0]
+
+    x0, y0, above_limit = vp_pixel_locations(bvis, components, vp, numpy.zeros([ntimes, 1, 2]),
+                                             use_radec=use_radec, elevation_limit=elevation_limit)
+    x, y, _ = vp_pixel_locations(bvis, components, vp, offsets, use_radec=use_radec,
+                                 elevation_limit=elevation_limit)
+    dx = x - x0
+    dy = y - y0
+    if full_jones:
+        dx = dx[..., numpy.newaxis, :, numpy.newaxis, numpy.newaxis]
+        dy = dy[..., numpy.newaxis, :, numpy.newaxis, numpy.newaxis]
+    elif nchan > 1:
+        dx = dx[..., numpy.newaxis, :]
+        dy = dy[..., numpy.newaxis, :]
+
+    # The expansion coefficients [ntimes, 1, (nchan,) ncomp (, 2, 2)] are broadcast over scenarios and antennas
+    sample = sample_vp_jones if full_jones else sample_vp_channels
+    coeffs = [sample(im, x0, y0, order=order) for im in [vp] + list(vp_gradients)]
+    gains = coeffs[0] + dx * coeffs[1] + dy * coeffs[2]
+    if len(coeffs) > 3:
+        gains += 0.5 * (dx * dx * coeffs[3] + 2.0 * dx * dy * coeffs[4] + dy * dy * coeffs[5])
+
+    if full_jones:
+        gains = numpy.where(numpy.all(coeffs[0] == 0.0, axis=(-2, -1), keepdims=True), 0.0, gains)
+        return _set_identity_below_limit(gains, above_limit)
+    gains = numpy.where(coeffs[0] == 0.0, 0.0, gains)
+    return _set_unit_gain_below_limit(gains, above_limit, nchan)
+
+
+def create_gaintables_from_gains(bvis, components, gains):
+    """ Convert voltage gains into one GainTable per component
+
+    As for simulate_gaintable_from_pointingtable, the gaintable holds the inverse of the voltage gain (zero
+    where the gain could not be evaluated), suitable for predict with docal=True.
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param gains: Complex voltage gains [ntimes, nant, ncomp] or [ntimes, nant, nchan, ncomp]
+    :return: List of GainTables, one per component
+    """
+    gains = numpy.asarray(gains)
+    if gains.ndim == 3:
+        gains = gains[:, :, numpy.newaxis, :]
+    antgain = numpy.zeros_like(gains)
+    nonzero = numpy.abs(gains) > 0.0
+    antgain[nonzero] = 1.0 / gains[nonzero]
+
+    gaintables = [create_gaintable_from_blockvisibility(bvis) for comp in components]
+    for icomp, comp in enumerate(components):
+        gaintables[icomp].gain[...] = antgain[..., icomp][..., numpy.newaxis, numpy.newaxis]
+        gaintables[icomp].phasecentre = comp.direction
+    return gaintables
@@ -0,0 +1,45 @@
+"""Process pool shared by the parallel import and fitting of the beam models
+
+Each job is a tuple of arguments of a function run in a worker process; the results are passed back to the parent as
+they finish, so that it alone writes the shared output files.
+"""
+
+__all__ = ['run_jobs']
+
+import concurrent.futures
+import time
+
+
+def run_jobs(function, jobs, nprocesses, description, consume=None):
+    """ Run function(*job) for each job over a process pool, printing progress as each finishes
+
+    The progress lines name the job by its first three arguments, e.g. band, elevation and frequency.
+
+    :param function: Function of the arguments of a job, defined at module level so that it can be pickled
+    :param jobs: List of tuples of arguments
+    :param nprocesses: Number of processes (default the number of CPUs, 1 to run in this process)
+    :param description: Description of the jobs in the progress lines, e.g. 'Import'
+    :param consume: Function called in this process with each job and its result as they finish
+    :return: List of results in the order of the jobs
+    """
+    results = [None for _ in jobs]
+    done = [False for _ in jobs]
+    start = time.time()
+
+    def report(ijob, result):
+        if consume is not None:
+            consume(jobs[ijob], result)
+        results[ijob] = result
+        done[ijob] = True
+        print("%s %s: done (%d/%d, %.1f s)" % (description, ' '.join(str(arg) for arg in jobs[ijob][:3]),
+                                               sum(done), len(jobs), time.time() - start), flush=True)
+
+    if nprocesses is not None and nprocesses <= 1:
+        for ijob, job in enumerate(jobs):
+            report(ijob, function(*job))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nprocesses) as executor:
+            futures = {executor.submit(function, *job): ijob for ijob, job in enumerate(jobs)}
+            for future in concurrent.futures.as_completed(futures):
+                report(futures[future], future.result())
+    return results
@@ -0,0 +1,560 @@
+"""Synthesis of pointing error time series from the pointing error PSDs
+
+The PSDs in pointing_error_models/PSD_data/<condition>/El<el>Az<az>.dat have columns: frequency (Hz), then the PSD
+(arcsec^2/Hz) of the AZ and EL position errors (tracking) and of the XEL and EL pointing errors (wind). A time
+series with a given PSD is synthesised by an inverse real FFT of complex Gaussian noise scaled by the square root of
+the PSD, for all antennas at once, at any integration time and duration. The power of the PSD above the Nyquist
+frequency of the sampling is folded (aliased) back, as it would be for point samples of the pointing.
+
+The PSDs are given on a coarse grid of elevation and azimuth. Rather than use the nearest file for a whole chunk,
+the log-PSD can be interpolated bilinearly in elevation and azimuth at the start and end of the chunk. The PSDs of
+each condition are read once into a PSDGrid, which is cached. The series for the two PSDs are made from the same
+noise and blended linearly over the chunk, so the series follows the track.
+
+By default each antenna has an independent series. The wind-induced errors may instead be correlated across the
+array using the PSD in PSD_data/spatial: by Taylor's frozen flow hypothesis the correlation of two antennas a distance
+d apart is the autocorrelation of that PSD at a lag d / wind speed. The covariance is taken as separable in time and
+space, so the independent series of all antennas are mixed by a factor of the nant x nant spatial correlation matrix
+and the (ntimes nant) x (ntimes nant) covariance is never formed.
+
+A series synthesised per chunk is independent of, and discontinuous with, that of the neighbouring chunks. For long
+finely sampled tracks the series can instead be streamed: it is defined for all time as the overlap-add of
+independent segments of two blocks, each seeded by its block number and tapered by a sine window whose squares sum
+to one, so the variance is constant and the series continuous. Any slice of samples, e.g. that of one chunk, is made
+from the two or three segments that overlap it, so each chunk task makes only its own slice.
+"""
+
+__all__ = ['psd_cache_directory', 'read_psd', 'list_psd_files', 'select_psd_file', 'PSDGrid', 'get_psd_grid',
+           'alias_psd', 'synthesize_time_series', 'synthesize_time_series_slice', 'stream_time_series',
+           'spatial_correlation', 'correlate_antennas', 'simulate_pointingtable_from_psd']
+
+import glob
+import hashlib
+import logging
+import os
+import re
+
+import numpy
+
+from mid_pointing.file_support import atomic_write
+from mid_pointing.seeding import create_generator
+
+log = logging.getLogger(__name__)
+
+# Columns of the PSD files
+PSD_COLUMNS = {'az': 1, 'el': 2, 'pxel': 3, 'pel': 4}
+# Axes of the pointing table (xel, el) for each type of time series
+TIME_SERIES_AXES = {'tracking': ('az', 'el'), 'wind': ('pxel', 'pel')}
+# Lags of the spatial correlation evaluated at a time
+LAG_BLOCK_SIZE = 1024
+# Fewest samples in a block of a streamed series, so that coarsely sampled series keep their low frequency power
+MIN_BLOCK_LENGTH = 64
+
+
+# Parsed PSD files, by (filename, size, modification time)
+_psd_tables = dict()
+
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def psd_cache_directory():
+    """ Directory of the binary forms of the PSD files
+
+    This is $MID_POINTING_PSD_CACHE if set, else mid_pointing/psd in the user's cache directory ($XDG_CACHE_HOME or
+    ~/.cache), so that nothing is written into the source tree. It must be visible to the Dask workers to be shared.
+
+    :return: Directory name
+    """
+    directory = os.environ.get('MID_POINTING_PSD_CACHE')
+    if directory:
+        return directory
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'mid_pointing', 'psd')
+
+
+def _binary_psd_name(filename):
+    # The conditions have files of the same name, so those of each directory are kept apart
+    directory = _sha256(os.path.dirname(filename).encode())[:16]
+    return os.path.join(psd_cache_directory(), directory, os.path.basename(filename) + '.npz')
+
+
+def _load_psd_table(filename):
+    """ Load the table of a PSD file, from its binary form if that is valid, otherwise by parsing the text
+
+    The binary form holds the table and the SHA-256 of both the text file it was made from and the table itself. It
+    is used only if both match, so a changed text file or a damaged binary file is parsed again.
+    """
+    with open(filename, 'rb') as f:
+        source_sha = _sha256(f.read())
+    binary_name = _binary_psd_name(filename)
+    try:
+        with numpy.load(binary_name) as binary:
+            table = binary['table']
+            if str(binary['source_sha']) == source_sha and str(binary['table_sha']) == _sha256(table.tobytes()):
+                return table
+            log.debug("read_psd: binary form of %s is stale, parsing the text" % filename)
+    except (OSError, KeyError, ValueError):
+        pass
+
+    table = numpy.loadtxt(filename)
+    try:
+        os.makedirs(os.path.dirname(binary_name), exist_ok=True)
+        atomic_write(binary_name, lambda f: numpy.savez(f, table=table, source_sha=source_sha,
+                                                        table_sha=_sha256(table.tobytes())))
+    except OSError as err:
+        log.debug("read_psd: cannot write binary form of %s: %s" % (filename, err))
+    return table
+
+
+def read_psd(filename):
+    """ Read a PSD file
+
+    Each file is parsed at most once per process; the parsed tables are also kept in a binary form (in
+    psd_cache_directory()) so that other processes, e.g. Dask workers, need not parse the text. The arrays returned
+    are shared and read-only.
+
+    :param filename: Name of the file
+    :return: frequency (Hz), dict of PSD (arcsec^2/Hz) for 'az', 'el', 'pxel', 'pel'
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    key = (filename, stat.st_size, stat.st_mtime)
+    if key not in _psd_tables:
+        table = _load_psd_table(filename)
+        table.flags.writeable = False
+        _psd_tables[key] = table
+    table = _psd_tables[key]
+    return table[:, 0], {axis: table[:, column] for axis, column in PSD_COLUMNS.items()}
+
+
+def list_psd_files(directory):
+    """ List the PSD files of a directory, keyed by their (elevation, azimuth) in degrees
+
+    :param directory: Directory holding El<el>Az<az>.dat files
+    :return: dict {(elevation, azimuth): filename}
+    """
+    files = dict()
+    for filename in glob.glob(os.path.join(directory, 'El*Az*.dat')):
+        match = re.match(r'El(\d+)Az(\d+)\.dat$', os.path.basename(filename))
+        if match is not None:
+            files[(float(match.group(1)), float(match.group(2)))] = filename
+    return files
+
+
+def select_psd_file(directory, elevation, azimuth):
+    """ Select the PSD file nearest in elevation and azimuth
+
+    The PSDs are given for azimuth 0 to 180 deg so the azimuth is folded into that range. The elevation is matched
+    first and then the azimuth, since not every condition has the same elevations.
+
+    :param directory: Directory holding El<el>Az<az>.dat files
+    :param elevation: Elevation (deg)
+    :param azimuth: Azimuth (deg)
+    :return: filename
+    """
+    files = list_psd_files(directory)
+    if len(files) == 0:
+        raise ValueError("select_psd_file: no PSD files in %s" % directory)
+    azimuth = _fold_azimuth(azimuth)
+    elevations = numpy.array(sorted(set(el for el, _ in files)))
+    nearest_el = elevations[numpy.argmin(numpy.abs(elevations - elevation))]
+    azimuths = numpy.array(sorted(az for el, az in files if el == nearest_el))
+    nearest_az = azimuths[numpy.argmin(numpy.abs(azimuths - azimuth))]
+    return files[(nearest_el, nearest_az)]
+
+
+def _fold_azimuth(azimuth):
+    """ Fold an azimuth (deg) into 0 to 180 deg, the range of the PSD files
+    """
+    return numpy.abs((azimuth + 180.0) % 360.0 - 180.0)
+
+
+class PSDGrid:
+    """ The PSDs of one condition on their grid of elevation and azimuth, interpolated bilinearly in log-PSD
+
+    Usage::
+
+        grid = get_psd_grid('pointing_error_models/PSD_data/standard')
+        frequency, psd = grid.frequency, grid.psd(62.0, 110.0, 'pel')
+    """
+
+    def __init__(self, directory):
+        """ Read all the PSD files of a directory
+
+        :param directory: Directory holding El<el>Az<az>.dat files for a complete grid of elevation and azimuth
+        """
+        files = list_psd_files(directory)
+        if len(files) == 0:
+            raise ValueError("PSDGrid: no PSD files in %s" % directory)
+        self.elevations = numpy.array(sorted(set(el for el, _ in files)))
+        self.azimuths = numpy.array(sorted(set(az for _, az in files)))
+        self.axes = list(PSD_COLUMNS.keys())
+        self.frequency = None
+        self.log_psd = None
+        for iel, el in enumerate(self.elevations):
+            for iaz, az in enumerate(self.azimuths):
+                if (el, az) not in files:
+                    raise ValueError("PSDGrid: no PSD for El%dAz%d in %s" % (el, az, directory))
+                frequency, psds = read_psd(files[(el, az)])
+                if self.frequency is None:
+                    self.frequency = frequency
+                    self.log_psd = numpy.zeros([len(self.elevations), len(self.azimuths), len(self.axes),
+                                                len(frequency)])
+                elif not numpy.allclose(frequency, self.frequency):
+                    raise ValueError("PSDGrid: frequencies of %s differ" % files[(el, az)])
+                for iaxis, axis in enumerate(self.axes):
+                    self.log_psd[iel, iaz, iaxis] = numpy.log(numpy.maximum(psds[axis], numpy.finfo('float').tiny))
+
+    @staticmethod
+    def _weights(grid, value):
+        """ Indices and weights of linear interpolation on a grid, clamped at the ends
+        """
+        if len(grid) == 1:
+            return 0, 0, 0.0
+        value = numpy.clip(value, grid[0], grid[-1])
+        upper = min(int(numpy.searchsorted(grid, value, side='right')), len(grid) - 1)
+        lower = upper - 1
+        return lower, upper, (value - grid[lower]) / (grid[upper] - grid[lower])
+
+    def psd(self, elevation, azimuth, axis):
+        """ PSD interpolated bilinearly in log-PSD at an elevation and azimuth
+
+        Outside the grid the PSD of the nearest edge is used.
+
+        :param elevation: Elevation (deg)
+        :param azimuth: Azimuth (deg)
+        :param axis: 'az', 'el', 'pxel' or 'pel'
+        :return: PSD (arcsec^2/Hz) at self.frequency
+        """
+        el0, el1, wel = self._weights(self.elevations, elevation)
+        az0, az1, waz = self._weights(self.azimuths, _fold_azimuth(azimuth))
+        log_psd = self.log_psd[:, :, self.axes.index(axis)]
+        return numpy.exp((1.0 - wel) * (1.0 - waz) * log_psd[el0, az0] + (1.0 - wel) * waz * log_psd[el0, az1] +
+                         wel * (1.0 - waz) * log_psd[el1, az0] + wel * waz * log_psd[el1, az1])
+
+
+# PSD grids already read, by directory
+_psd_grids = dict()
+
+
+def get_psd_grid(directory):
+    """ PSDGrid of a directory, read once per process
+
+    :param directory: Directory holding El<el>Az<az>.dat files
+    :return: PSDGrid
+    """
+    directory = os.path.abspath(directory)
+    if directory not in _psd_grids:
+        _psd_grids[directory] = PSDGrid(directory)
+    return _psd_grids[directory]
+
+
+def _interpolate_psd(frequency, psd, f):
+    """ Interpolate a PSD in log-log, zero outside the tabulated frequencies
+    """
+    positive = psd > 0.0
+    result = numpy.zeros_like(f)
+    inside = (f >= frequency[0]) & (f <= frequency[-1])
+    result[inside] = numpy.exp(numpy.interp(numpy.log(f[inside]), numpy.log(frequency[positive]),
+                                            numpy.log(psd[positive])))
+    return result
+
+
+def alias_psd(frequency, psd, f, integration_time):
+    """ Evaluate a PSD at frequencies up to the Nyquist frequency, folding in the power above it
+
+    :param frequency: Frequencies of the tabulated PSD (Hz)
+    :param psd: Tabulated one-sided PSD
+    :param f: Frequencies at which to evaluate, 0 to 1 / (2 integration_time) (Hz)
+    :param integration_time: Sampling interval (s)
+    :return: One-sided PSD of the sampled process at f
+    """
+    fs = 1.0 / integration_time
+    nfold = int(numpy.ceil(frequency[-1] / fs)) + 1
+    m = numpy.arange(nfold)[:, numpy.newaxis] * fs
+    folded = numpy.concatenate([m + f[numpy.newaxis, :], m + fs - f[numpy.newaxis, :]])
+    aliased = numpy.sum(_interpolate_psd(frequency, psd, folded.flatten()).reshape(folded.shape), axis=0)
+    # The Nyquist frequency folds onto itself
+    aliased[f >= 0.5 * fs] = numpy.sum(_interpolate_psd(frequency, psd, (m + 0.5 * fs).flatten()))
+    return aliased
+
+
+def _fft_length(frequency, ntimes, integration_time):
+    """ Even FFT length of at least ntimes samples that resolves the lowest tabulated frequency
+    """
+    nfft = max(ntimes, int(numpy.ceil(1.0 / (frequency[0] * integration_time))))
+    return nfft + nfft % 2
+
+
+def _harmonic_amplitude(frequency, psd, nfft, integration_time):
+    """ Amplitude of each harmonic of an inverse real FFT of nfft samples, for the noise of _harmonic_noise
+    """
+    df = 1.0 / (nfft * integration_time)
+    power = alias_psd(frequency, psd, df * numpy.arange(nfft // 2 + 1), integration_time) * df
+    # The variance of each harmonic is power: the complex amplitude of the irfft is N sqrt(power) / 2. The zero and
+    # Nyquist frequencies are real. The power at zero frequency, folded from the multiples of the sampling
+    # frequency, is one-sided, of which the real harmonic has half; that at the Nyquist frequency is two-sided.
+    amplitude = 0.5 * nfft * numpy.sqrt(power)
+    amplitude[-1] *= numpy.sqrt(2.0)
+    return amplitude
+
+
+def _harmonic_noise(rng, nseries, nfft):
+    """ Complex Gaussian noise of the harmonics of nseries series, real at the zero and Nyquist frequencies
+    """
+    if isinstance(rng, (list, tuple)):
+        assert len(rng) == nseries, "Need one random number generator per series"
+        noise = numpy.array([r.standard_normal(nfft // 2 + 1) + 1j * r.standard_normal(nfft // 2 + 1) for r in rng])
+    else:
+        noise = rng.standard_normal((nseries, nfft // 2 + 1)) + 1j * rng.standard_normal((nseries, nfft // 2 + 1))
+    noise[:, [0, -1]] = noise[:, [0, -1]].real * numpy.sqrt(2.0)
+    return noise
+
+
+def synthesize_time_series(frequency, psd, ntimes, integration_time, nseries=1, rng=None, psd_end=None):
+    """ Synthesise Gaussian time series with a given one-sided PSD
+
+    The series are made by one batched inverse real FFT. The FFT is long enough to resolve the lowest tabulated
+    frequency so that the series is not periodic over its duration, and the first ntimes samples are returned. The
+    power folded onto zero frequency is kept, so a short or coarsely sampled series has the variance of the PSD.
+
+    If psd_end is given, a second set of series is made from the same noise with that PSD, and the result is blended
+    linearly from the first at the start to the second at the end, giving series whose PSD changes over time.
+
+    :param frequency: Frequencies of the tabulated PSD (Hz)
+    :param psd: Tabulated one-sided PSD, in units^2/Hz
+    :param ntimes: Number of samples
+    :param integration_time: Sampling interval (s)
+    :param nseries: Number of independent series (e.g. antennas)
+    :param rng: numpy random Generator, or a list of one per series (default a new unseeded one)
+    :param psd_end: Tabulated one-sided PSD at the end of the series
+    :return: Time series in units [nseries, ntimes], zero mean over realisations
+    """
+    if rng is None:
+        rng = numpy.random.default_rng()
+    nfft = _fft_length(frequency, ntimes, integration_time)
+    noise = _harmonic_noise(rng, nseries, nfft)
+
+    def series(p):
+        amplitude = _harmonic_amplitude(frequency, p, nfft, integration_time)
+        return numpy.fft.irfft(amplitude * noise, n=nfft, axis=-1)[:, :ntimes]
+
+    if psd_end is None:
+        return series(psd)
+    weight = numpy.linspace(0.0, 1.0, ntimes) if ntimes > 1 else numpy.zeros(1)
+    return (1.0 - weight) * series(psd) + weight * series(psd_end)
+
+
+def synthesize_time_series_slice(frequency, psd, first, ntimes, integration_time, seed, nseries=1, key=(),
+                                 block_length=None, psd_end=None):
+    """ Synthesise samples first to first + ntimes of a continuous streamed series with a given one-sided PSD
+
+    The series is the sum over blocks b of sin(pi u / (2 L)) s_b(u), u = n - b L, where L is the block length and
+    s_b is an independent series of 2 L samples as from synthesize_time_series, the noise of each series i coming
+    from the stream (key, b, i) of the seed. The same samples are returned whichever slices they are requested in, so
+    chunks made separately join continuously. The spectrum is computed once per slice and shared by its blocks.
+
+    :param frequency: Frequencies of the tabulated PSD (Hz)
+    :param psd: Tabulated one-sided PSD, in units^2/Hz
+    :param first: Index of the first sample from the origin of the series (>= 0)
+    :param ntimes: Number of samples
+    :param integration_time: Sampling interval (s)
+    :param seed: Random number seed of the whole series (an int, required)
+    :param nseries: Number of independent series (e.g. antennas)
+    :param key: Integers distinguishing independent series with the same seed (e.g. scenario and axis)
+    :param block_length: Samples per block (default four periods of the lowest tabulated frequency, and at least
+        MIN_BLOCK_LENGTH)
+    :param psd_end: Tabulated one-sided PSD at the end of the slice, to blend as in synthesize_time_series
+    :return: Time series in units [nseries, ntimes]
+    """
+    if seed is None:
+        raise ValueError("synthesize_time_series_slice: a seed is needed for a reproducible stream")
+    assert first >= 0, "The first sample must be at or after the origin of the series"
+    if block_length is None:
+        block_length = max(MIN_BLOCK_LENGTH, int(numpy.ceil(4.0 / (frequency[0] * integration_time))))
+    n = first + numpy.arange(ntimes)
+    nfft = _fft_length(frequency, 2 * block_length, integration_time)
+
+    def slice_for(p):
+        amplitude = _harmonic_amplitude(frequency, p, nfft, integration_time)
+        result = numpy.zeros([nseries, ntimes])
+        for block in range(n[0] // block_length - 1, n[-1] // block_length + 1):
+            u = n - block * block_length
+            inside = (u >= 0) & (u < 2 * block_length)
+            if not numpy.any(inside):
+                continue
+            rng = [create_generator(seed, *key, block + 1, iseries) for iseries in range(nseries)]
+            segment = numpy.fft.irfft(amplitude * _harmonic_noise(rng, nseries, nfft), n=nfft, axis=-1)
+            result[:, inside] += numpy.sin(0.5 * numpy.pi * u[inside] / block_length) * segment[:, u[inside]]
+        return result
+
+    if psd_end is None:
+        return slice_for(psd)
+    weight = numpy.linspace(0.0, 1.0, ntimes) if ntimes > 1 else numpy.zeros(1)
+    return (1.0 - weight) * slice_for(psd) + weight * slice_for(psd_end)
+
+
+def stream_time_series(frequency, psd, ntimes, integration_time, chunk_ntimes, seed, nseries=1, key=(),
+                       block_length=None, first=0):
+    """ Generate a streamed series chunk by chunk, never holding more than one chunk
+
+    :param frequency: Frequencies of the tabulated PSD (Hz)
+    :param psd: Tabulated one-sided PSD, in units^2/Hz
+    :param ntimes: Total number of samples
+    :param integration_time: Sampling interval (s)
+    :param chunk_ntimes: Samples per chunk
+    :param seed: Random number seed of the whole series
+    :param nseries: Number of independent series (e.g. antennas)
+    :param key: Integers distinguishing independent series with the same seed (e.g. scenario and axis)
+    :param block_length: Samples per block (default four periods of the lowest tabulated frequency, and at least
+        MIN_BLOCK_LENGTH)
+    :param first: Index of the first sample from the origin of the series
+    :return: Generator of time series [nseries, chunk_ntimes] (the last may be shorter)
+    """
+    for start in range(first, first + ntimes, chunk_ntimes):
+        yield synthesize_time_series_slice(frequency, psd, start, min(chunk_ntimes, first + ntimes - start),
+                                           integration_time, seed, nseries=nseries, key=key,
+                                           block_length=block_length)
+
+
+def spatial_correlation(separation, frequency, psd, wind_speed=10.0):
+    """ Correlation of the pointing errors of antennas as a function of separation, by frozen flow
+
+    The correlation is the normalised autocorrelation of the temporal PSD at a lag separation / wind_speed. The PSD
+    is taken as linear between the tabulated frequencies and integrated exactly, so the finite sampling of the
+    frequencies does not alias into spurious correlation at long lags. The tabulated band stops at its lowest
+    frequency f_min, which does not determine the correlation at lags beyond about 1 / f_min, so the correlation is
+    tapered by a cosine from 1 at a lag 1 / (2 f_min) to 0 at 1 / f_min, and is zero beyond.
+
+    :param separation: Separations (m), any shape
+    :param frequency: Frequencies of the tabulated PSD (Hz)
+    :param psd: Tabulated one-sided PSD of the wind-induced error
+    :param wind_speed: Wind speed (m/s)
+    :return: Correlation, same shape as separation
+    """
+    separation = numpy.asarray(separation, dtype='float')
+    frequency = numpy.asarray(frequency, dtype='float')
+    psd = numpy.asarray(psd, dtype='float')
+    lag = separation.flatten() / wind_speed
+
+    # Wiener-Khinchin: R(lag) = integral of psd(f) cos(2 pi f lag) df. Over a segment on which the PSD is p0 + s f,
+    # this is [p sin(w f) / w + s cos(w f) / w^2] with w = 2 pi lag.
+    variance = numpy.sum(0.5 * (psd[1:] + psd[:-1]) * numpy.diff(frequency))
+    slope = numpy.diff(psd) / numpy.diff(frequency)
+    correlation = numpy.ones_like(lag)
+    nonzero = numpy.nonzero(lag > 0.0)[0]
+    # A block of lags at a time, bounding the memory of the [nlags, nfrequencies] phases
+    for start in range(0, len(nonzero), LAG_BLOCK_SIZE):
+        block = nonzero[start:start + LAG_BLOCK_SIZE]
+        omega = 2.0 * numpy.pi * lag[block, numpy.newaxis]
+        phase = omega * frequency
+        integral = numpy.diff(psd * numpy.sin(phase), axis=-1) / omega + \
+            slope * numpy.diff(numpy.cos(phase), axis=-1) / omega ** 2
+        correlation[block] = numpy.sum(integral, axis=-1) / variance
+
+    # Taper the lags that the band does not determine
+    fmin = frequency[frequency > 0.0][0]
+    taper = numpy.clip(2.0 * fmin * lag - 1.0, 0.0, 1.0)
+    correlation *= 0.5 * (1.0 + numpy.cos(numpy.pi * taper))
+    return correlation.reshape(separation.shape)
+
+
+def correlate_antennas(series, antenna_positions, frequency, psd, wind_speed=10.0):
+    """ Mix independent series of each antenna so that they have the frozen flow spatial correlation
+
+    The spatial correlation matrix C (tapered at long lags, see spatial_correlation) is factored as C = L L^T by its
+    eigendecomposition (negative eigenvalues, which can arise for an isotropic model of a one-dimensional
+    correlation, are set to zero) and the series are L x series.
+    The rows of L are normalised so that the variance of each antenna is unchanged.
+
+    :param series: Independent series [nant, ntimes]
+    :param antenna_positions: Antenna positions (m) [nant, 3]
+    :param frequency: Frequencies of the tabulated spatial PSD (Hz)
+    :param psd: Tabulated one-sided spatial PSD
+    :param wind_speed: Wind speed (m/s)
+    :return: Correlated series [nant, ntimes]
+    """
+    antenna_positions = numpy.asarray(antenna_positions)
+    separation = numpy.sqrt(numpy.sum((antenna_positions[:, numpy.newaxis, :] -
+                                       antenna_positions[numpy.newaxis, :, :]) ** 2, axis=-1))
+    correlation = spatial_correlation(separation, frequency, psd, wind_speed=wind_speed)
+    eigenvalues, eigenvectors = numpy.linalg.eigh(correlation)
+    factor = eigenvectors * numpy.sqrt(numpy.maximum(eigenvalues, 0.0))
+    factor /= numpy.sqrt(numpy.sum(factor ** 2, axis=1))[:, numpy.newaxis]
+    return numpy.dot(factor, series)
+
+
+def simulate_pointingtable_from_psd(pt, pointing_directory, time_series='wind', time_series_type='precision',
+                                    seed=None, interpolate=False, spatial=False, wind_speed=10.0, stream=False,
+                                    scenario=0, stream_origin=0.0):
+    """ Fill a pointing table with time series synthesised from the pointing error PSDs
+
+    This is an alternative to simulate_pointingtable_from_timeseries that follows the sampling of the pointing table.
+    By default the PSD file nearest the nominal pointing at the start of the table is used. If interpolate is True,
+    the PSD is interpolated at the nominal pointing at the start and end of the table, and the series follows the
+    change in between. If spatial is True, the wind errors are correlated across the array using the PSD in the
+    'spatial' subdirectory of pointing_directory; the frozen flow model applies only to the wind, so the tracking
+    errors stay independent. If stream is True, the samples are those of a continuous series
+    whose origin is stream_origin (see synthesize_time_series_slice), so that tables for successive times join
+    continuously when made with the same seed and origin. The times of a pointing table are hour angles, negative
+    before transit, so the origin is the start of the observation rather than zero.
+
+    The noise of each scenario, axis and antenna comes from its own stream of the seed (see seeding.py), so the
+    errors of an antenna do not depend on the number of antennas or scenarios.
+
+    :param pt: PointingTable
+    :param pointing_directory: Directory holding a subdirectory of PSD files per condition
+    :param time_series: Type of time series: 'wind' or 'tracking'
+    :param time_series_type: Condition, e.g. 'precision', 'standard', 'degraded'
+    :param seed: Random number seed
+    :param interpolate: Interpolate the PSD along the track?
+    :param spatial: Correlate the wind errors of the antennas?
+    :param wind_speed: Wind speed for the spatial correlation (m/s)
+    :param stream: Make the samples of a streamed series for the times of the table?
+    :param scenario: Index of the scenario, to give each scenario independent errors
+    :param stream_origin: Time of the first sample of the streamed series (s), at or before the table's first time
+    :return: PointingTable
+    """
+    if time_series not in TIME_SERIES_AXES:
+        raise ValueError("simulate_pointingtable_from_psd: time series %s not known" % time_series)
+    if seed is None:
+        seed = numpy.random.SeedSequence().entropy
+
+    ntimes, nant, nchan, nrec, _ = pt.pointing.shape
+    directory = os.path.join(pointing_directory, time_series_type)
+    azimuth, elevation = numpy.rad2deg(pt.nominal[0, 0, 0, 0, :])
+    if interpolate:
+        grid = get_psd_grid(directory)
+        end_azimuth, end_elevation = numpy.rad2deg(pt.nominal[-1, 0, 0, 0, :])
+        frequency = grid.frequency
+        psds = {axis: grid.psd(elevation, azimuth, axis) for axis in TIME_SERIES_AXES[time_series]}
+        end_psds = {axis: grid.psd(end_elevation, end_azimuth, axis) for axis in TIME_SERIES_AXES[time_series]}
+    else:
+        filename = select_psd_file(directory, elevation, azimuth)
+        log.debug("simulate_pointingtable_from_psd: using PSD file %s" % filename)
+        frequency, psds = read_psd(filename)
+        end_psds = {axis: None for axis in TIME_SERIES_AXES[time_series]}
+
+    spatial = spatial and time_series == 'wind'
+    if spatial:
+        spatial_frequency, spatial_psds = read_psd(select_psd_file(os.path.join(pointing_directory, 'spatial'),
+                                                                   elevation, azimuth))
+
+    a2r = numpy.pi / (180.0 * 3600.0)
+    pt.data['pointing'][...] = 0.0
+    for iaxis, axis in enumerate(TIME_SERIES_AXES[time_series]):
+        if stream:
+            first = int(numpy.round((pt.time[0] - stream_origin) / pt.interval[0]))
+            series = synthesize_time_series_slice(frequency, psds[axis], first, ntimes, pt.interval[0], seed,
+                                                  nseries=nant, key=(scenario, iaxis), psd_end=end_psds[axis])
+        else:
+            rng = [create_generator(seed, scenario, iaxis, ant) for ant in range(nant)]
+            series = synthesize_time_series(frequency, psds[axis], ntimes, pt.interval[0], nseries=nant, rng=rng,
+                                            psd_end=end_psds[axis])
+        if spatial:
+            series = correlate_antennas(series, pt.configuration.xyz, spatial_frequency, spatial_psds[axis],
+                                        wind_speed=wind_speed)
+        pt.data['pointing'][..., iaxis] = a2r * series.T[:, :, numpy.newaxis, numpy.newaxis]
+    return pt
@@ -0,0 +1,230 @@
+"""Residual images from error and error-free gaintables without per-component images
+
+calculate_residual_from_gaintables_rsexecute_workflow keeps a visibility set and a model image per component and
+adds the component dirty images at the end, so memory grows with the number of components. Here the residual
+(error minus error-free) visibilities of all components are accumulated into one visibility set per chunk, which
+is inverted once with a single template image. Since imaging is linear the residual image is the same.
+
+The residual visibilities are predicted by the antenna-factorized DFT (see dft.py), from the gaintables or directly
+from a gain stack. A stack of full-Jones gains gives the four linear polarisations of each baseline. The error-free
+visibility is the same for every scenario, so it can be predicted once per chunk (and cached) by
+predict_error_free_visibility_rsexecute_workflow and passed to the residual workflows, which then predict only the
+error visibility of each scenario.
+"""
+
+__all__ = ['calculate_residual_visibility', 'calculate_residual_visibility_from_gain_stack', 'sum_visibility_list',
+           'subtract_visibility', 'sum_visibility_rsexecute_workflow',
+           'predict_error_free_visibility_rsexecute_workflow',
+           'calculate_residual_visibility_rsexecute_workflow',
+           'calculate_residual_visibility_from_gain_stack_rsexecute_workflow']
+
+import logging
+
+from rascil.processing_components import copy_visibility, convert_blockvisibility_to_visibility
+from workflows.rsexecute.execution_support.rsexecute import rsexecute
+
+from .dft import predict_factorized_visibility, predict_factorized_jones_visibility, gains_from_gaintables
+
+log = logging.getLogger(__name__)
+
+
+def calculate_residual_visibility(bvis, components, no_error_gt_list, error_gt_list):
+    """ Accumulate the error minus error-free visibility of a number of components
+
+    The result is that of predicting each component by DFT and corrupting it by its error and error-free gaintables,
+    as in predict_skymodel_list_compsonly_rsexecute_workflow with docal=True, but all components are predicted
+    together by the antenna-factorized DFT.
+
+    :param bvis: BlockVisibility, used as a template
+    :param components: List of Skycomponents
+    :param no_error_gt_list: List of error-free GainTables, one per component, or None to predict only the error
+        visibility
+    :param error_gt_list: List of error GainTables, one per component
+    :return: BlockVisibility holding the summed residual visibilities
+    """
+    assert len(components) == len(error_gt_list)
+    if no_error_gt_list is None:
+        return predict_factorized_visibility(bvis, components, gains=gains_from_gaintables(error_gt_list))
+    assert len(components) == len(no_error_gt_list)
+    return predict_factorized_visibility(bvis, components, gains=gains_from_gaintables(error_gt_list),
+                                         no_error_gains=gains_from_gaintables(no_error_gt_list))
+
+
+def calculate_residual_visibility_from_gain_stack(bvis, components, gain_stack, iscenario, start=0, end=None,
+                                                  full_jones=False, subtract_error_free=True):
+    """ Accumulate the error minus error-free visibility of a number of components from a gain stack
+
+    No gaintables are constructed: the voltage gains are used directly by the antenna-factorized DFT.
+
+    :param bvis: BlockVisibility, used as a template
+    :param components: List of Skycomponents, those of the gain stack from start to end
+    :param gain_stack: Complex voltage gains [nscenarios + 1, ntimes, nant, (nchan,) ncomp], or Jones matrices
+        [nscenarios + 1, ntimes, nant, nchan, ncomp, 2, 2] for full_jones
+    :param iscenario: Index into the stack, 0 is error-free
+    :param start: First component of the gain stack
+    :param end: Last component of the gain stack (exclusive), default all
+    :param full_jones: Is the gain stack of Jones matrices? The BlockVisibility must then be linear
+    :param subtract_error_free: Subtract the error-free visibility? If False only the visibility of the scenario
+        is predicted
+    :return: BlockVisibility holding the summed residual visibilities
+    """
+    if full_jones:
+        if end is None:
+            end = gain_stack.shape[-3]
+        assert len(components) == end - start
+        no_error_jones = gain_stack[0, ..., start:end, :, :] if subtract_error_free else None
+        return predict_factorized_jones_visibility(bvis, components, gain_stack[iscenario, ..., start:end, :, :],
+                                                   no_error_jones=no_error_jones)
+    if end is None:
+        end = gain_stack.shape[-1]
+    assert len(components) == end - start
+    no_error_gains = gain_stack[0, ..., start:end] if subtract_error_free else None
+    return predict_factorized_visibility(bvis, components, gains=gain_stack[iscenario, ..., start:end],
+                                         no_error_gains=no_error_gains)
+
+
+def sum_visibility_list(bvis_list):
+    """ Sum the visibilities of a list of BlockVisibility's with the same sampling
+
+    :param bvis_list: List of BlockVisibility
+    :return: BlockVisibility
+    """
+    result = copy_visibility(bvis_list[0])
+    for bvis in bvis_list[1:]:
+        result.data['vis'] += bvis.data['vis']
+    return result
+
+
+def subtract_visibility(bvis, other_bvis):
+    """ Subtract the visibilities of one BlockVisibility from those of another with the same sampling
+
+    :param bvis: BlockVisibility
+    :param other_bvis: BlockVisibility to subtract
+    :return: BlockVisibility
+    """
+    result = copy_visibility(bvis)
+    result.data['vis'] -= other_bvis.data['vis']
+    return result
+
+
+def sum_visibility_rsexecute_workflow(bvis_list):
+    """ Sum a list of BlockVisibility graphs pairwise in a binary tree
+
+    Each task adds two visibility sets, so no task holds more than two inputs however many there are, and a group's
+    visibilities can be released as soon as they are added.
+
+    :param bvis_list: List of BlockVisibility graphs with the same sampling
+    :return: BlockVisibility graph
+    """
+    while len(bvis_list) > 1:
+        bvis_list = [rsexecute.execute(sum_visibility_list)(bvis_list[i:i + 2]) if i + 1 < len(bvis_list)
+                     else bvis_list[i] for i in range(0, len(bvis_list), 2)]
+    return bvis_list[0]
+
+
+def predict_error_free_visibility_rsexecute_workflow(sub_bvis_list, sub_components, no_error_gt_list=None,
+                                                     gain_stack_list=None, component_group=None, full_jones=False):
+    """ Predict the error-free visibility of each visibility chunk, accumulated over components
+
+    The error-free gains are taken from the error-free gaintables or, if those are not given, from the first
+    scenario of the gain stacks. The result can be passed as no_error_vis_list to the residual workflows.
+
+    :param sub_bvis_list: List of BlockVisibility graphs
+    :param sub_components: List of Skycomponents
+    :param no_error_gt_list: List (one per BlockVisibility) of lists of error-free GainTables
+    :param gain_stack_list: List of gain stack graphs, one per BlockVisibility
+    :param component_group: Number of components per task (default all)
+    :param full_jones: Are the gain stacks of Jones matrices?
+    :return: List (one per BlockVisibility) of graphs for the error-free BlockVisibility
+    """
+    ncomps = len(sub_components)
+    if component_group is None or component_group < 1:
+        component_group = ncomps
+    groups = [(start, min(start + component_group, ncomps)) for start in range(0, ncomps, component_group)]
+
+    no_error_vis_list = list()
+    for ibv, bvis in enumerate(sub_bvis_list):
+        if no_error_gt_list is not None:
+            group_list = [rsexecute.execute(calculate_residual_visibility)(bvis, sub_components[start:end], None,
+                                                                           no_error_gt_list[ibv][start:end])
+                          for start, end in groups]
+        else:
+            group_list = [rsexecute.execute(calculate_residual_visibility_from_gain_stack)(
+                bvis, sub_components[start:end], gain_stack_list[ibv], 0, start, end, full_jones, False)
+                for start, end in groups]
+        no_error_vis_list.append(sum_visibility_rsexecute_workflow(group_list))
+    return no_error_vis_list
+
+
+def calculate_residual_visibility_rsexecute_workflow(sub_bvis_list, sub_components, no_error_gt_list,
+                                                      error_gt_list, component_group=None, no_error_vis_list=None):
+    """ Calculate the residual visibility of each visibility chunk, accumulated over components
+
+    The components are processed in groups of component_group per task; the residual visibilities of the groups
+    are summed pairwise per chunk, so the peak memory per task is that of a few visibility sets regardless of the
+    number of components.
+
+    :param sub_bvis_list: List of BlockVisibility graphs
+    :param sub_components: List of Skycomponents
+    :param no_error_gt_list: List (one per BlockVisibility) of lists of error-free GainTables
+    :param error_gt_list: List (one per BlockVisibility) of lists of error GainTables
+    :param component_group: Number of components per task (default all)
+    :param no_error_vis_list: List (one per BlockVisibility) of error-free BlockVisibility's from
+        predict_error_free_visibility_rsexecute_workflow, to subtract instead of predicting them again
+    :return: List (one per BlockVisibility) of graphs for the residual Visibility
+    """
+    ncomps = len(sub_components)
+    if component_group is None or component_group < 1:
+        component_group = ncomps
+    groups = [(start, min(start + component_group, ncomps)) for start in range(0, ncomps, component_group)]
+
+    residual_vis_list = list()
+    for ibv, bvis in enumerate(sub_bvis_list):
+        group_list = [rsexecute.execute(calculate_residual_visibility)(bvis, sub_components[start:end],
+                                                                       no_error_gt_list[ibv][start:end]
+                                                                       if no_error_vis_list is None else None,
+                                                                       error_gt_list[ibv][start:end])
+                      for start, end in groups]
+        residual_bvis = sum_visibility_rsexecute_workflow(group_list)
+        if no_error_vis_list is not None:
+            residual_bvis = rsexecute.execute(subtract_visibility)(residual_bvis, no_error_vis_list[ibv])
+        residual_vis_list.append(rsexecute.execute(convert_blockvisibility_to_visibility)(residual_bvis))
+    return residual_vis_list
+
+
+def calculate_residual_visibility_from_gain_stack_rsexecute_workflow(sub_bvis_list, sub_components, gain_stack_list,
+                                                                     iscenario, component_group=None,
+                                                                     full_jones=False, no_error_vis_list=None):
+    """ Calculate the residual visibility of each visibility chunk directly from the gain stacks
+
+    The result has the same structure as calculate_residual_visibility_rsexecute_workflow.
+
+    :param sub_bvis_list: List of BlockVisibility graphs
+    :param sub_components: List of Skycomponents
+    :param gain_stack_list: List of gain stack graphs, one per BlockVisibility
+    :param iscenario: Index into the stacks, 0 is error-free
+    :param component_group: Number of components per task (default all)
+    :param full_jones: Are the gain stacks of Jones matrices?
+    :param no_error_vis_list: List (one per BlockVisibility) of error-free BlockVisibility's from
+        predict_error_free_visibility_rsexecute_workflow, to subtract instead of predicting them again
+    :return: List (one per BlockVisibility) of graphs for the residual Visibility
+    """
+    ncomps = len(sub_components)
+    if component_group is None or component_group < 1:
+        component_group = ncomps
+    groups = [(start, min(start + component_group, ncomps)) for start in range(0, ncomps, component_group)]
+
+    residual_vis_list = list()
+    for ibv, bvis in enumerate(sub_bvis_list):
+        group_list = [rsexecute.execute(calculate_residual_visibility_from_gain_stack)(bvis,
+                                                                                       sub_components[start:end],
+                                                                                       gain_stack_list[ibv],
+                                                                                       iscenario, start, end,
+                                                                                       full_jones,
+                                                                                       no_error_vis_list is None)
+                      for start, end in groups]
+        residual_bvis = sum_visibility_rsexecute_workflow(group_list)
+        if no_error_vis_list is not None:
+            residual_bvis = rsexecute.execute(subtract_visibility)(residual_bvis, no_error_vis_list[ibv])
+        residual_vis_list.append(rsexecute.execute(convert_blockvisibility_to_visibility)(residual_bvis))
+    return residual_vis_list
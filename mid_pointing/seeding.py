@@ -0,0 +1,59 @@
+"""Reproducible random number streams derived from the run's seed
+
+Every random stream of a simulation is identified by a key of integers, e.g. (chunk,) for the seed of a time chunk
+or (scenario, axis, antenna) within a chunk, and its generator is made from numpy.random.SeedSequence(seed,
+spawn_key=key). This is the sequence that SeedSequence.spawn would give at that position in the spawn tree, but any
+stream can be made directly, on any worker and in any order, without making the others. The streams are statistically
+independent and do not depend on the global random state or on how many other streams there are.
+
+The RASCIL simulation functions take an integer seed, so create_legacy_seed gives an integer drawn from the stream
+instead.
+"""
+
+__all__ = ['seed_sequence', 'create_generator', 'create_legacy_seed', 'create_chunk_seeds']
+
+import logging
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+
+def seed_sequence(seed, *key):
+    """ SeedSequence of a stream
+
+    :param seed: Seed of the run (an int)
+    :param key: Integers identifying the stream
+    :return: numpy.random.SeedSequence
+    """
+    return numpy.random.SeedSequence(int(seed), spawn_key=tuple(int(k) for k in key))
+
+
+def create_generator(seed, *key):
+    """ Random number generator of a stream
+
+    :param seed: Seed of the run (an int)
+    :param key: Integers identifying the stream
+    :return: numpy.random.Generator
+    """
+    return numpy.random.default_rng(seed_sequence(seed, *key))
+
+
+def create_legacy_seed(seed, *key):
+    """ Integer seed of a stream, for functions that take an integer seed (1 to 2**31 - 1)
+
+    :param seed: Seed of the run (an int)
+    :param key: Integers identifying the stream
+    :return: int
+    """
+    return int(seed_sequence(seed, *key).generate_state(1)[0] % (2 ** 31 - 1)) + 1
+
+
+def create_chunk_seeds(seed, nchunks):
+    """ Integer seed for each time chunk, the seed of chunk i depending only on the run's seed and i
+
+    :param seed: Seed of the run (an int)
+    :param nchunks: Number of chunks
+    :return: List of int
+    """
+    return [create_legacy_seed(seed, ichunk) for ichunk in range(nchunks)]
@@ -0,0 +1,266 @@
+"""Packed, memory-mapped store of the precomputed pointing error time series
+
+Each condition directory of pointing_error_models/out holds one El<el>Az<az>_time_series_<axis>.npy file per
+elevation, azimuth and axis, each a [2, ntimes] array of time (s) and pointing error (arcsec). pack_time_series
+consolidates a directory into one array indexed by (elevation, azimuth, axis, time), written as time_series.npy,
+with an index header time_series.json. The axes may be sampled differently (the tracking axes are sampled more
+finely than the wind axes), so each axis has its own start, interval and number of times, and shorter axes are
+padded with NaN. PackedTimeSeries memory-maps the array and returns views, so reading the time slice of a chunk
+reads only that part of the file. simulate_pointingtable_from_packed_time_series fills a pointing table from the
+store in this way.
+"""
+
+__all__ = ['pack_time_series', 'PackedTimeSeries', 'get_packed_time_series',
+           'simulate_pointingtable_from_packed_time_series']
+
+import glob
+import json
+import logging
+import os
+import re
+
+import numpy
+
+from mid_pointing.file_support import atomic_dump
+from mid_pointing.psd import TIME_SERIES_AXES
+from mid_pointing.seeding import create_generator
+
+log = logging.getLogger(__name__)
+
+AXES = ('az', 'el', 'pxel', 'pel')
+
+
+def _parse_time_series_files(directory):
+    """ Find the time series files of a directory
+
+    :return: dict {(elevation, azimuth, axis): filename}
+    """
+    files = dict()
+    for filename in glob.glob(os.path.join(directory, 'El*Az*_time_series_*.npy')):
+        match = re.match(r'El(\d+)Az(\d+)_time_series_(\w+)\.npy$', os.path.basename(filename))
+        if match is not None and match.group(3) in AXES:
+            files[(float(match.group(1)), float(match.group(2)), match.group(3))] = filename
+    return files
+
+
+def pack_time_series(directory, name='time_series'):
+    """ Pack the time series files of a directory into one memory-mappable array and an index header
+
+    Files that are not [2, ntimes] arrays of time and value are skipped.
+
+    :param directory: Directory holding El<el>Az<az>_time_series_<axis>.npy files
+    :param name: Base name of the packed array (<name>.npy) and header (<name>.json)
+    :return: Name of the packed array
+    """
+    series = dict()
+    for key, filename in _parse_time_series_files(directory).items():
+        data = numpy.load(filename)
+        if data.ndim != 2 or data.shape[0] != 2:
+            log.warning("pack_time_series: skipping %s of shape %s" % (filename, str(data.shape)))
+            continue
+        series[key] = data
+    if len(series) == 0:
+        raise ValueError("pack_time_series: no time series in %s" % directory)
+
+    elevations = sorted(set(key[0] for key in series))
+    azimuths = sorted(set(key[1] for key in series))
+    axes = [axis for axis in AXES if any(key[2] == axis for key in series)]
+
+    # The sampling must be the same for all files of an axis
+    sampling = dict()
+    for (el, az, axis), data in series.items():
+        times = data[0]
+        interval = float(times[-1] - times[0]) / (len(times) - 1) if len(times) > 1 else 0.0
+        this = {'start': float(times[0]), 'interval': interval, 'ntimes': len(times)}
+        if axis in sampling:
+            if sampling[axis]['ntimes'] != this['ntimes'] or \
+                    not numpy.isclose(sampling[axis]['interval'], this['interval']) or \
+                    not numpy.isclose(sampling[axis]['start'], this['start']):
+                raise ValueError("pack_time_series: sampling of El%dAz%d %s differs from other files of that axis" %
+                                 (el, az, axis))
+        else:
+            sampling[axis] = this
+
+    ntimes = max(sampling[axis]['ntimes'] for axis in axes)
+    packed_name = os.path.join(directory, '%s.npy' % name)
+    tmpname = packed_name + '.tmp'
+    packed = numpy.lib.format.open_memmap(tmpname, mode='w+', dtype='float64',
+                                          shape=(len(elevations), len(azimuths), len(axes), ntimes))
+    packed[...] = numpy.nan
+    for (el, az, axis), data in series.items():
+        packed[elevations.index(el), azimuths.index(az), axes.index(axis), :data.shape[1]] = data[1]
+    packed.flush()
+    del packed
+    os.replace(tmpname, packed_name)
+
+    header = {'elevations': elevations, 'azimuths': azimuths, 'axes': axes, 'sampling': sampling,
+              'shape': [len(elevations), len(azimuths), len(axes), ntimes]}
+    atomic_dump(header, os.path.join(directory, '%s.json' % name), use_json=True)
+    log.info("pack_time_series: packed %d files of %s into %s" % (len(series), directory, packed_name))
+    return packed_name
+
+
+class PackedTimeSeries:
+    """ Read access to a packed store of time series
+
+    Usage::
+
+        store = PackedTimeSeries('pointing_error_models/out/standard')
+        pel = store.series(45.0, 90.0, 'pel', start_time=600.0, stop_time=1200.0)
+    """
+
+    def __init__(self, directory, name='time_series'):
+        """ Open a packed store written by pack_time_series
+
+        :param directory: Directory holding <name>.npy and <name>.json
+        :param name: Base name of the packed array and header
+        """
+        with open(os.path.join(directory, '%s.json' % name)) as f:
+            self.header = json.load(f)
+        self.data = numpy.load(os.path.join(directory, '%s.npy' % name), mmap_mode='r')
+        assert list(self.data.shape) == self.header['shape'], "Packed time series and header do not match"
+        self.elevations = numpy.array(self.header['elevations'])
+        self.azimuths = numpy.array(self.header['azimuths'])
+        self.axes = self.header['axes']
+
+    def nearest(self, elevation, azimuth):
+        """ Indices of the elevation and azimuth nearest those given
+
+        The azimuth is folded into 0 to 180 deg, as for the PSD files.
+
+        :param elevation: Elevation (deg)
+        :param azimuth: Azimuth (deg)
+        :return: elevation index, azimuth index
+        """
+        azimuth = numpy.abs((azimuth + 180.0) % 360.0 - 180.0)
+        return int(numpy.argmin(numpy.abs(self.elevations - elevation))), \
+            int(numpy.argmin(numpy.abs(self.azimuths - azimuth)))
+
+    def times(self, axis):
+        """ Sample times (s) of an axis
+
+        :param axis: 'az', 'el', 'pxel' or 'pel'
+        :return: times
+        """
+        sampling = self.header['sampling'][axis]
+        return sampling['start'] + sampling['interval'] * numpy.arange(sampling['ntimes'])
+
+    def period(self, axis):
+        """ Period (s) of an axis, when its series is repeated
+
+        :param axis: 'az', 'el', 'pxel' or 'pel'
+        :return: period
+        """
+        sampling = self.header['sampling'][axis]
+        return sampling['interval'] * sampling['ntimes']
+
+    def series(self, elevation, azimuth, axis, start_time=None, stop_time=None):
+        """ View of the time series nearest an elevation and azimuth, optionally between two times
+
+        No data are copied: the result is a view of the memory map.
+
+        :param elevation: Elevation (deg)
+        :param azimuth: Azimuth (deg)
+        :param axis: 'az', 'el', 'pxel' or 'pel'
+        :param start_time: First time (s), default the start
+        :param stop_time: Last time (s, inclusive), default the end
+        :return: Pointing error (arcsec) [ntimes]
+        """
+        iel, iaz = self.nearest(elevation, azimuth)
+        sampling = self.header['sampling'][axis]
+        first, last = 0, sampling['ntimes']
+        if sampling['interval'] > 0.0:
+            if start_time is not None:
+                first = int(numpy.ceil((start_time - sampling['start']) / sampling['interval'] - 1e-9))
+            if stop_time is not None:
+                last = int(numpy.floor((stop_time - sampling['start']) / sampling['interval'] + 1e-9)) + 1
+        first, last = max(0, first), min(sampling['ntimes'], last)
+        return self.data[iel, iaz, self.axes.index(axis), first:max(first, last)]
+
+    def sample(self, elevation, azimuth, axis, times):
+        """ Time series nearest an elevation and azimuth, interpolated linearly at some times
+
+        The series is repeated with period self.period(axis), so any times can be sampled. Only the samples
+        spanning the times are read, one slice of the series per period covered.
+
+        :param elevation: Elevation (deg)
+        :param azimuth: Azimuth (deg)
+        :param axis: 'az', 'el', 'pxel' or 'pel'
+        :param times: Times (s) on the time axis of the series
+        :return: Pointing error (arcsec) [ntimes]
+        """
+        sampling = self.header['sampling'][axis]
+        start, interval, ntimes = sampling['start'], sampling['interval'], sampling['ntimes']
+        if interval <= 0.0:
+            raise ValueError("PackedTimeSeries.sample: the %s series has a single sample" % axis)
+        position = (numpy.asarray(times) - start) / interval
+        first, last = int(numpy.floor(numpy.min(position))), int(numpy.floor(numpy.max(position))) + 1
+        slices = list()
+        index = first
+        while index <= last:
+            wrapped = index % ntimes
+            count = min(ntimes - wrapped, last - index + 1)
+            slices.append(self.series(elevation, azimuth, axis, start_time=start + wrapped * interval,
+                                      stop_time=start + (wrapped + count - 1) * interval))
+            index += count
+        values = numpy.concatenate(slices)
+        return numpy.interp(position - first, numpy.arange(len(values)), values)
+
+
+# Packed stores already opened, by directory and name
+_packed_stores = dict()
+
+
+def get_packed_time_series(directory, name='time_series'):
+    """ PackedTimeSeries of a directory, opened once per process
+
+    :param directory: Directory holding <name>.npy and <name>.json
+    :param name: Base name of the packed array and header
+    :return: PackedTimeSeries
+    """
+    key = (os.path.abspath(directory), name)
+    if key not in _packed_stores:
+        _packed_stores[key] = PackedTimeSeries(*key)
+    return _packed_stores[key]
+
+
+def simulate_pointingtable_from_packed_time_series(pt, time_series_directory, time_series='wind',
+                                                   time_series_type='precision', seed=None, scenario=0,
+                                                   time_origin=0.0):
+    """ Fill a pointing table from the packed time series of a condition
+
+    This is an alternative to simulate_pointingtable_from_timeseries that reads the store written by
+    pack_time_series rather than loading every file, and reads only the samples for the times of the table. The
+    series nearest the nominal pointing at the start of the table is used, repeated periodically. Each antenna
+    starts at its own random time in the series, drawn from the stream (scenario, antenna) of the seed (see
+    seeding.py), and the times of the table are counted from time_origin, so that tables for successive times join
+    continuously when made with the same seed and origin.
+
+    :param pt: PointingTable
+    :param time_series_directory: Directory holding a packed store per condition
+    :param time_series: Type of time series: 'wind' or 'tracking'
+    :param time_series_type: Condition, e.g. 'precision', 'standard', 'degraded'
+    :param seed: Random number seed
+    :param scenario: Index of the scenario, to give each scenario independent errors
+    :param time_origin: Time of the start of the series (s), at or before the table's first time
+    :return: PointingTable
+    """
+    if time_series not in TIME_SERIES_AXES:
+        raise ValueError("simulate_pointingtable_from_packed_time_series: time series %s not known" % time_series)
+    if seed is None:
+        seed = numpy.random.SeedSequence().entropy
+
+    store = get_packed_time_series(os.path.join(time_series_directory, time_series_type))
+    ntimes, nant = pt.pointing.shape[:2]
+    azimuth, elevation = numpy.rad2deg(pt.nominal[0, 0, 0, 0, :])
+    times = pt.time - time_origin
+
+    a2r = numpy.pi / (180.0 * 3600.0)
+    pt.data['pointing'][...] = 0.0
+    for ant in range(nant):
+        phase = create_generator(seed, scenario, ant).uniform()
+        for iaxis, axis in enumerate(TIME_SERIES_AXES[time_series]):
+            series_times = store.header['sampling'][axis]['start'] + phase * store.period(axis) + times
+            series = store.sample(elevation, azimuth, axis, series_times)
+            pt.data['pointing'][:, ant, ..., iaxis] = a2r * series[:, numpy.newaxis, numpy.newaxis]
+    return pt
@@ -0,0 +1,225 @@
+"""Voltage patterns at any elevation and frequency, interpolated on demand from a beam cube
+
+The EMSS beams are tabulated at a few elevations (15, 45 and 90 deg) and frequencies. Rather than precompute the
+voltage pattern at every degree, a VoltagePatternProvider reads the tabulated (anchor) planes of a frequency from the
+beam cube once, and forms the plane for a requested elevation as the weighted sum of the anchors given by quadratic
+interpolation in elevation (as interp1d(kind='quadratic')). The weights are found by interpolating the identity, so
+only the requested plane is computed. The most recently used planes are kept in a bounded LRU cache, keyed by the
+tabulated frequency and the elevation rounded to elevation_step.
+
+At a frequency between two tabulated frequencies, the planes of both at the requested elevation are scaled to the
+frequency (the pattern of an aperture scales with wavelength, so the plane at f_k is resampled at offsets f / f_k
+times larger) and interpolated linearly in frequency. Outside the tabulated range the nearest plane is scaled. A
+multi-channel voltage pattern for a time chunk is made from the cached planes of the tabulated frequencies that
+bracket its channels, so all channels share one anchor set.
+
+get_voltage_pattern_provider keeps one provider per cube in each process, so all the chunks handled by a Dask worker
+share the anchors and the cache. create_vp_from_beam_cube makes the voltage pattern of a BlockVisibility at the
+elevation of the phasecentre at the middle of its times.
+"""
+
+__all__ = ['scale_voltage_pattern', 'VoltagePatternProvider', 'get_voltage_pattern_provider',
+           'create_vp_from_beam_cube']
+
+import collections
+import logging
+import os
+
+import numpy
+from scipy.interpolate import interp1d
+from scipy.ndimage import affine_transform
+
+from processing_library.image.operations import create_image_from_array
+from processing_library.util.coordinate_support import hadec_to_azel
+from rascil.data_models.polarisation import PolarisationFrame
+
+from mid_pointing.beam_cube import BeamCube
+
+log = logging.getLogger(__name__)
+
+
+def scale_voltage_pattern(plane, factor, order=3):
+    """ Resample voltage pattern planes so that the pixel at offset r from the centre takes the value at factor * r
+
+    The centre is the reference pixel of the beam cube (ny // 2, nx // 2 one-relative). Values from outside the
+    plane are zero.
+
+    :param plane: Voltage pattern [..., ny, nx]
+    :param factor: Scale factor, e.g. f / f_k to make the pattern tabulated at f_k that at f
+    :param order: Order of the spline interpolation
+    :return: Voltage pattern [..., ny, nx]
+    """
+    plane = numpy.asarray(plane)
+    if factor == 1.0:
+        return plane.copy()
+    ny, nx = plane.shape[-2:]
+    centre = numpy.array([ny // 2 - 1, nx // 2 - 1], dtype='float')
+    result = numpy.zeros_like(plane)
+    for index in numpy.ndindex(*plane.shape[:-2]):
+        for part in [numpy.real, numpy.imag]:
+            scaled = affine_transform(part(plane[index]).astype('float'), [factor, factor],
+                                      offset=centre - factor * centre, order=order, cval=0.0)
+            if part is numpy.real:
+                result[index] += scaled
+            else:
+                result[index] += 1j * scaled
+    return result
+
+
+class VoltagePatternProvider:
+    """ Voltage pattern of a beam cube at any elevation and frequency
+
+    Usage::
+
+        provider = get_voltage_pattern_provider('B2_beams.h5')
+        vp = provider.image(62.3, numpy.linspace(1.3e9, 1.4e9, 8))
+    """
+
+    def __init__(self, filename, frequency=None, cache_size=8, elevation_step=0.1):
+        """ Open a beam cube; the anchor planes are read when first needed
+
+        :param filename: Name of the beam cube
+        :param frequency: Default frequency (Hz)
+        :param cache_size: Number of planes at tabulated frequencies to keep
+        :param elevation_step: Elevations are rounded to this (deg) before interpolation
+        """
+        self.cube = BeamCube(filename)
+        self.frequency = frequency
+        self.cache_size = cache_size
+        self.elevation_step = elevation_step
+        # The tabulated frequencies with at least one elevation, and the tabulated elevations of each
+        self.elevations = dict()
+        for ifreq, freq in enumerate(self.cube.frequencies):
+            elevations = self.cube.elevations[self.cube.written[ifreq]]
+            if len(elevations) > 0:
+                self.elevations[ifreq] = elevations
+        if len(self.elevations) == 0:
+            raise ValueError("VoltagePatternProvider: no planes in %s" % filename)
+        # Indices into the cube of the tabulated frequencies, in increasing frequency
+        self._ifreqs = sorted(self.elevations, key=lambda ifreq: self.cube.frequencies[ifreq])
+        self.frequencies = self.cube.frequencies[self._ifreqs]
+        self._interpolators = dict()
+        self._anchors = dict()
+        self._cache = collections.OrderedDict()
+
+    def weights(self, elevation, ifreq):
+        """ Weights of the anchor planes of a tabulated frequency for an elevation
+
+        Elevations outside the tabulated range are clamped to it.
+
+        :param elevation: Elevation (deg)
+        :param ifreq: Index of the frequency in the cube
+        :return: Weights [nanchors]
+        """
+        elevations = self.elevations[ifreq]
+        if len(elevations) == 1:
+            return numpy.ones(1)
+        if ifreq not in self._interpolators:
+            self._interpolators[ifreq] = interp1d(elevations, numpy.identity(len(elevations)), axis=0,
+                                                  kind='linear' if len(elevations) == 2 else 'quadratic')
+        return self._interpolators[ifreq](numpy.clip(elevation, elevations[0], elevations[-1]))
+
+    def _tabulated_plane(self, elevation, ifreq):
+        """ Voltage pattern at a tabulated frequency, from the LRU cache if there
+        """
+        key = (ifreq, int(numpy.round(elevation / self.elevation_step)))
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        if ifreq not in self._anchors:
+            self._anchors[ifreq] = numpy.array([self.cube.plane(self.cube.frequencies[ifreq], el)
+                                                for el in self.elevations[ifreq]])
+        weights = self.weights(key[1] * self.elevation_step, ifreq).astype('float32')
+        plane = numpy.tensordot(weights, self._anchors[ifreq], axes=1)
+        plane.flags.writeable = False
+        self._cache[key] = plane
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return plane
+
+    def plane(self, elevation, frequency=None):
+        """ Voltage pattern at an elevation and frequency
+
+        :param elevation: Elevation (deg)
+        :param frequency: Frequency (Hz), default that of the provider
+        :return: Voltage pattern, complex64 [4, ny, nx], read-only as it may be shared through the cache
+        """
+        if frequency is None:
+            frequency = self.frequency
+        assert frequency is not None, "VoltagePatternProvider: no frequency given"
+        ifreqs = self._ifreqs
+        tabulated = numpy.nonzero(numpy.isclose(self.frequencies, frequency, rtol=1e-9, atol=1e-6))[0]
+        if len(tabulated) > 0:
+            return self._tabulated_plane(elevation, ifreqs[tabulated[0]])
+
+        upper = int(numpy.searchsorted(self.frequencies, frequency))
+        if upper == 0 or upper == len(self.frequencies):
+            nearest = 0 if upper == 0 else len(self.frequencies) - 1
+            return scale_voltage_pattern(self._tabulated_plane(elevation, ifreqs[nearest]),
+                                         frequency / self.frequencies[nearest])
+        lower = upper - 1
+        weight = (frequency - self.frequencies[lower]) / (self.frequencies[upper] - self.frequencies[lower])
+        return (1.0 - weight) * scale_voltage_pattern(self._tabulated_plane(elevation, ifreqs[lower]),
+                                                      frequency / self.frequencies[lower]) + \
+            weight * scale_voltage_pattern(self._tabulated_plane(elevation, ifreqs[upper]),
+                                           frequency / self.frequencies[upper])
+
+    def image(self, elevation, frequency=None, use_local=True, pointingcentre=None):
+        """ Voltage pattern image at an elevation, for one or more frequencies
+
+        :param elevation: Elevation (deg)
+        :param frequency: Frequency (Hz), or a list of equally spaced channel frequencies, default that of the provider
+        :param use_local: Keep the AZELGEO frame of the cube, else centre the image on pointingcentre in RA, DEC
+        :param pointingcentre: SkyCoord of the pointing centre, needed if not use_local
+        :return: Image [nchan, 4, ny, nx], complex, linear polarisation
+        """
+        if frequency is None:
+            frequency = self.frequency
+        frequencies = numpy.atleast_1d(numpy.asarray(frequency, dtype='float'))
+        wcs = self.cube.wcs(frequencies[0])
+        if len(frequencies) > 1:
+            wcs.wcs.cdelt[3] = frequencies[1] - frequencies[0]
+        if not use_local:
+            assert pointingcentre is not None, "Need the pointing centre for a voltage pattern in RA, DEC"
+            wcs.wcs.ctype[0] = 'RA---SIN'
+            wcs.wcs.ctype[1] = 'DEC--SIN'
+            wcs.wcs.crval[0] = pointingcentre.ra.deg
+            wcs.wcs.crval[1] = pointingcentre.dec.deg
+        data = numpy.array([self.plane(elevation, freq) for freq in frequencies], dtype='complex')
+        return create_image_from_array(data, wcs, polarisation_frame=PolarisationFrame("linear"))
+
+
+# Providers already made, by cube
+_providers = dict()
+
+
+def get_voltage_pattern_provider(filename):
+    """ VoltagePatternProvider of a cube, made once per process
+
+    :param filename: Name of the beam cube
+    :return: VoltagePatternProvider
+    """
+    key = os.path.abspath(filename)
+    if key not in _providers:
+        _providers[key] = VoltagePatternProvider(filename)
+    return _providers[key]
+
+
+def create_vp_from_beam_cube(bvis, filename, frequency, use_local=True, pointingcentre=None):
+    """ Voltage pattern for a BlockVisibility, at the elevation of its phasecentre at the middle of its times
+
+    This replaces create_vp when the beam is to follow the elevation of each time chunk.
+
+    :param bvis: BlockVisibility
+    :param filename: Name of the beam cube
+    :param frequency: Frequency (Hz), or a list of equally spaced channel frequencies
+    :param use_local: Use the local (AZELGEO) frame?
+    :param pointingcentre: SkyCoord of the pointing centre, needed if not use_local
+    :return: Image [nchan, 4, ny, nx]
+    """
+    # The time in the BlockVisibility is hour angle in seconds!
+    har = numpy.pi / 43200.0 * numpy.median(numpy.unique(bvis.time))
+    _, elevation = hadec_to_azel(har, bvis.phasecentre.dec.rad, bvis.configuration.location.lat.rad)
+    return get_voltage_pattern_provider(filename).image(numpy.rad2deg(elevation), frequency, use_local=use_local,
+                                                        pointingcentre=pointingcentre)
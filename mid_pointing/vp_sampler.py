@@ -0,0 +1,178 @@
+"""Sampling of voltage pattern images by precomputed spline coefficients
+
+Each gain evaluation fitted a RectBivariateSpline to the real and to the imaginary part of one plane of the voltage
+pattern, and then evaluated the pair. A VoltagePatternSampler instead solves for the complex coefficients of the
+interpolating spline of every channel and polarisation once, by banded solves along each axis with the knots FITPACK
+chooses for s=0 (see beams.py), so that its values are those of RectBivariateSpline.ev. A lookup finds the order + 1
+non-zero B-splines along each axis of every location, by the Cox-de Boor recursion over whole arrays, and sums the
+(order + 1)^2 coefficients of each for all planes at once.
+
+get_vp_sampler keeps the samplers of the most recently used voltage patterns in each process, keyed by their
+contents, so the tasks of a Dask worker that sample the same voltage pattern (e.g. every chunk and scenario when the
+voltage pattern does not change with the chunk) solve for the coefficients once.
+"""
+
+__all__ = ['VoltagePatternSampler', 'get_vp_sampler']
+
+import collections
+import hashlib
+import logging
+import threading
+
+import numpy
+from scipy.interpolate import BSpline
+from scipy.linalg import solve_banded
+
+from mid_pointing.beams import interpolating_knots
+
+log = logging.getLogger(__name__)
+
+# Locations sampled at a time, so that the intermediate arrays stay in cache
+BLOCK_SIZE = 16384
+
+
+def _solve_interpolating_spline(values, knots, order, axis):
+    """ Coefficients along one axis of the interpolating spline of values given at 0, 1, 2, ...
+    """
+    n = values.shape[axis]
+    collocation = BSpline.design_matrix(numpy.arange(n, dtype='float'), knots, order).tocoo()
+    offsets = collocation.row - collocation.col
+    lower = int(max(offsets.max(), 0))
+    upper = int(max(-offsets.min(), 0))
+    banded = numpy.zeros([lower + upper + 1, n])
+    banded[upper + collocation.row - collocation.col, collocation.col] = collocation.data
+    rhs = numpy.moveaxis(values, axis, 0)
+    solution = solve_banded((lower, upper), banded, rhs.reshape(n, -1), check_finite=False)
+    return numpy.moveaxis(solution.reshape(rhs.shape), 0, axis)
+
+
+def _bspline_basis(knots, order, ncoeffs, locations):
+    """ Index of the first non-zero B-spline and the values of the order + 1 non-zero B-splines at each location
+
+    :return: first index [npoints], values [npoints, order + 1]
+    """
+    interval = numpy.clip(numpy.searchsorted(knots, locations, side='right') - 1, order, ncoeffs - 1)
+    basis = numpy.zeros([len(locations), order + 1])
+    basis[:, 0] = 1.0
+    left = numpy.zeros([len(locations), order + 1])
+    right = numpy.zeros([len(locations), order + 1])
+    for j in range(1, order + 1):
+        left[:, j] = locations - knots[interval + 1 - j]
+        right[:, j] = knots[interval + j] - locations
+        saved = numpy.zeros(len(locations))
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+    return interval - order, basis
+
+
+class VoltagePatternSampler:
+    """ Interpolation of all channels and polarisations of a voltage pattern at arrays of pixel locations
+
+    Usage::
+
+        sampler = get_vp_sampler(vp)
+        gains = sampler.sample(numpy.stack([x, y], axis=-1))[..., 0]
+    """
+
+    def __init__(self, vp, order=3, polarisations=None):
+        """ Solve for the spline coefficients of every plane
+
+        :param vp: Voltage pattern image
+        :param order: Order of spline (default is 3)
+        :param polarisations: Indices of the polarisations to sample, default all
+        """
+        nchan, npol, ny, nx = vp.data.shape
+        if polarisations is None:
+            polarisations = range(npol)
+        self.polarisations = tuple(polarisations)
+        npol = len(self.polarisations)
+        self.order = order
+        self.shape = (ny, nx)
+        self.nchan = nchan
+        self.npol = npol
+        self.y_knots = interpolating_knots(numpy.arange(ny), order)
+        self.x_knots = interpolating_knots(numpy.arange(nx), order)
+        # Coefficients [ny, nx, nchan * npol], so that all the planes of a coefficient are gathered together
+        planes = numpy.asarray(vp.data[:, list(self.polarisations)], dtype='complex').reshape(nchan * npol, ny, nx)
+        planes = numpy.moveaxis(planes, 0, -1)
+        coefficients = _solve_interpolating_spline(planes, self.y_knots, order, 0)
+        self.coefficients = _solve_interpolating_spline(coefficients, self.x_knots, order, 1)
+
+    @property
+    def nbytes(self):
+        """ Size of the coefficients (bytes)
+        """
+        return self.coefficients.nbytes
+
+    def sample(self, locations, block_size=BLOCK_SIZE):
+        """ Sample every channel and polarisation of the sampler at arrays of pixel locations
+
+        Locations within three pixels of the edge of the voltage pattern give zero.
+
+        :param locations: x, y pixel locations [..., 2]
+        :param block_size: Number of locations sampled at a time
+        :return: Complex values [..., nchan, npol]
+        """
+        locations = numpy.asarray(locations, dtype='float')
+        shape = locations.shape[:-1]
+        x = locations[..., 0].ravel()
+        y = locations[..., 1].ravel()
+        ny, nx = self.shape
+        valid = numpy.nonzero((x > 2) & (x < nx - 3) & (y > 2) & (y < ny - 3))[0]
+        number_bad = x.size - len(valid)
+        if number_bad > 0:
+            log.debug("VoltagePatternSampler: %d of %d locations are outside the voltage pattern" %
+                      (number_bad, x.size))
+
+        nplanes = self.coefficients.shape[-1]
+        coefficients = self.coefficients.reshape(-1, nplanes)
+        values = numpy.zeros([x.size, nplanes], dtype='complex')
+        for start in range(0, len(valid), block_size):
+            block = valid[start:start + block_size]
+            y_first, y_basis = _bspline_basis(self.y_knots, self.order, ny, y[block])
+            x_first, x_basis = _bspline_basis(self.x_knots, self.order, nx, x[block])
+            first = y_first * nx + x_first
+            sampled = numpy.zeros([len(block), nplanes], dtype='complex')
+            for a in range(self.order + 1):
+                row = numpy.zeros_like(sampled)
+                for b in range(self.order + 1):
+                    row += x_basis[:, b, numpy.newaxis] * coefficients[first + (a * nx + b)]
+                sampled += y_basis[:, a, numpy.newaxis] * row
+            values[block] = sampled
+        return values.reshape(shape + (self.nchan, self.npol))
+
+
+# Samplers of the most recently used voltage patterns, by contents, order and polarisations
+_samplers = collections.OrderedDict()
+_samplers_lock = threading.Lock()
+
+# Number of samplers kept in each process
+SAMPLER_CACHE_SIZE = 8
+
+
+def get_vp_sampler(vp, order=3, polarisations=None):
+    """ VoltagePatternSampler of a voltage pattern, made once per process for the same contents
+
+    :param vp: Voltage pattern image
+    :param order: Order of spline (default is 3)
+    :param polarisations: Indices of the polarisations to sample, default all
+    :return: VoltagePatternSampler
+    """
+    data = numpy.ascontiguousarray(vp.data)
+    if polarisations is not None:
+        polarisations = tuple(polarisations)
+    key = (hashlib.blake2b(data.view('uint8'), digest_size=16).hexdigest(), data.shape, str(data.dtype), order,
+           polarisations)
+    with _samplers_lock:
+        if key in _samplers:
+            _samplers.move_to_end(key)
+            return _samplers[key]
+    sampler = VoltagePatternSampler(vp, order=order, polarisations=polarisations)
+    with _samplers_lock:
+        _samplers[key] = sampler
+        while len(_samplers) > SAMPLER_CACHE_SIZE:
+            _samplers.popitem(last=False)
+    return sampler
@@ -0,0 +1,323 @@
+"""Workflows for pointing error simulations using rsexecute
+
+These complement the RASCIL simulation workflows. The gaintables for all scenarios are constructed in one pass per
+visibility chunk: the pointing offsets of every scenario are stacked and the voltage pattern is sampled once for the
+whole stack.
+"""
+
+__all__ = ['create_mid_simulation_rsexecute_workflow', 'create_pointing_offsets_stack',
+           'create_pointing_errors_gain_stack_rsexecute_workflow',
+           'create_gaintables_from_gain_stack', 'gaintables_from_gain_stack_rsexecute_workflow',
+           'scatter_gaintable_lists', 'summarise_visibility', 'summarise_dirty_image']
+
+import logging
+
+import numpy
+
+from astropy.coordinates import EarthLocation
+
+from processing_library.util.coordinate_support import hadec_to_azel
+from rascil.data_models.polarisation import PolarisationFrame
+from rascil.processing_components import create_pointingtable_from_blockvisibility, simulate_pointingtable, \
+    simulate_pointingtable_from_timeseries, qa_image, create_blockvisibility, create_configuration_from_MIDfile
+from workflows.rsexecute.execution_support.rsexecute import rsexecute
+
+from mid_pointing.beam_fit import create_beam_fits_from_file
+from mid_pointing.pointing import simulate_gains_from_pointing_offsets, create_gaintables_from_gains, \
+    simulate_linearized_gains_from_pointing_offsets, simulate_gains_from_beam_fit
+from mid_pointing.psd import simulate_pointingtable_from_psd
+from mid_pointing.seeding import create_legacy_seed
+from mid_pointing.timeseries import simulate_pointingtable_from_packed_time_series
+
+log = logging.getLogger(__name__)
+
+
+def create_mid_simulation_rsexecute_workflow(frequency, channel_bandwidth, rmax, phasecentre, time_range, time_chunk,
+                                             integration_time, shared_directory, elevation_limit=15.0,
+                                             polarisation_frame=None):
+    """ Construct the BlockVisibility graphs of a MID observation, one per time chunk, for any channels
+
+    The chunks are those of create_standard_mid_simulation_rsexecute_workflow (see count_chunk_times), which makes
+    one channel at the centre of the band.
+
+    :param frequency: Channel frequencies (Hz)
+    :param channel_bandwidth: Channel bandwidths (Hz)
+    :param rmax: Maximum distance of station from centre (m)
+    :param phasecentre: SkyCoord of the phasecentre
+    :param time_range: Hour angle range (hours)
+    :param time_chunk: Length of a chunk (s)
+    :param integration_time: Integration time (s)
+    :param shared_directory: Directory holding ska1mid_local.cfg
+    :param elevation_limit: Chunks with the phasecentre below this at start and end are dropped (deg)
+    :param polarisation_frame: PolarisationFrame of the visibilities, default stokesI
+    :return: List of BlockVisibility graphs
+    """
+    if polarisation_frame is None:
+        polarisation_frame = PolarisationFrame('stokesI')
+    mid_location = EarthLocation(lon="21.443803", lat="-30.712925", height=0.0)
+    start_times = numpy.arange(time_range[0] * 3600.0, time_range[1] * 3600.0, time_chunk)
+    end_times = start_times + time_chunk
+    s2r = numpy.pi / 43200.0
+    _, start_elevation = hadec_to_azel(s2r * start_times, phasecentre.dec.rad, mid_location.lat.rad)
+    _, end_elevation = hadec_to_azel(s2r * end_times, phasecentre.dec.rad, mid_location.lat.rad)
+    above = (start_elevation > numpy.deg2rad(elevation_limit)) | (end_elevation > numpy.deg2rad(elevation_limit))
+    assert numpy.any(above), "No data above elevation limit"
+
+    mid = create_configuration_from_MIDfile('%s/ska1mid_local.cfg' % shared_directory, rmax=rmax,
+                                            location=mid_location)
+    return [rsexecute.execute(create_blockvisibility)(mid, s2r * numpy.arange(start, end, integration_time),
+                                                      frequency=numpy.array(frequency),
+                                                      channel_bandwidth=numpy.array(channel_bandwidth),
+                                                      weight=1.0, phasecentre=phasecentre,
+                                                      polarisation_frame=polarisation_frame)
+            for start, end in zip(start_times[above], end_times[above])]
+
+
+def create_pointing_offsets_stack(bvis, scenarios, pointing_error=0.0, static_pointing_error=None,
+                                  global_pointing_error=None, time_series='', seed=None, pointing_directory=None,
+                                  interpolate_psd=False, correlate_wind=False, wind_speed=10.0, stream=False,
+                                  stream_origin=0.0, time_series_directory=None):
+    """ Construct the pointing offsets for all scenarios of one visibility chunk
+
+    The first entry of the stack is the error-free pointing. For time_series == '' the scenarios are multipliers
+    of the dynamic and static errors: the errors are drawn once with the given seed and then scaled, which gives the
+    same offsets as calling simulate_pointingtable once per multiplier. Otherwise each scenario is a time series
+    type (e.g. 'standard') passed to simulate_pointingtable_from_timeseries or, if pointing_directory is given, to
+    simulate_pointingtable_from_psd or, if time_series_directory is given, to
+    simulate_pointingtable_from_packed_time_series. Each scenario has its own random stream of the seed, as does
+    each antenna except with simulate_pointingtable_from_timeseries.
+
+    :param bvis: BlockVisibility
+    :param scenarios: List of multipliers or time series types
+    :param pointing_error: Dynamic pointing error (rad) for unit multiplier
+    :param static_pointing_error: Static pointing error (rad) for unit multiplier
+    :param global_pointing_error: Global pointing error (rad), not scaled
+    :param time_series: Type of time series: '', 'wind' or 'tracking'
+    :param seed: Random number seed
+    :param pointing_directory: Directory of PSD files per condition, to synthesise the time series from the PSDs
+    :param interpolate_psd: Interpolate the PSDs along the track of the chunk rather than use the nearest file?
+    :param correlate_wind: Correlate the synthesised errors across the array using the spatial PSD?
+    :param wind_speed: Wind speed for the spatial correlation (m/s)
+    :param stream: Make the synthesised errors a slice of a series continuous across chunks with the same seed?
+    :param stream_origin: Time of the first sample of the streamed series (s), e.g. the start of the observation.
+        This is also the time origin of the packed time series.
+    :param time_series_directory: Directory of packed time series per condition, to read the time series from
+    :return: Offsets (rad) [nscenarios + 1, ntimes, nant, 2]
+    """
+    pt = create_pointingtable_from_blockvisibility(bvis)
+    ntimes, nant = pt.pointing.shape[:2]
+    offsets = numpy.zeros([len(scenarios) + 1, ntimes, nant, 2])
+
+    if time_series == '':
+        if global_pointing_error is None:
+            global_pointing_error = [0.0, 0.0]
+        unit_pt = simulate_pointingtable(pt, pointing_error=pointing_error,
+                                         static_pointing_error=static_pointing_error, seed=seed)
+        unit_offsets = unit_pt.pointing[:, :, 0, 0, :]
+        for iscenario, scenario in enumerate(scenarios):
+            offsets[iscenario + 1] = scenario * unit_offsets + numpy.array(global_pointing_error)
+    else:
+        for iscenario, scenario in enumerate(scenarios):
+            if pointing_directory is not None:
+                error_pt = simulate_pointingtable_from_psd(create_pointingtable_from_blockvisibility(bvis),
+                                                           pointing_directory, time_series=time_series,
+                                                           time_series_type=scenario, seed=seed,
+                                                           interpolate=interpolate_psd, spatial=correlate_wind,
+                                                           wind_speed=wind_speed, stream=stream,
+                                                           scenario=iscenario, stream_origin=stream_origin)
+                offsets[iscenario + 1] = error_pt.pointing[:, :, 0, 0, :]
+            elif time_series_directory is not None:
+                error_pt = simulate_pointingtable_from_packed_time_series(
+                    create_pointingtable_from_blockvisibility(bvis), time_series_directory, time_series=time_series,
+                    time_series_type=scenario, seed=seed, scenario=iscenario, time_origin=stream_origin)
+                offsets[iscenario + 1] = error_pt.pointing[:, :, 0, 0, :]
+            else:
+                offsets[iscenario + 1] = _timeseries_offsets(bvis, time_series, scenario, seed, iscenario)
+
+    return offsets
+
+
+def _timeseries_offsets(bvis, time_series, time_series_type, seed, scenario):
+    """ Pointing offsets from simulate_pointingtable_from_timeseries, each scenario from its own stream of the seed
+
+    RASCIL draws the errors of all antennas in turn from one integer seed, here the legacy seed of the stream of the
+    scenario, so the table is simulated once per chunk and scenario. The errors of an antenna then depend on the
+    antennas before it; the PSD synthesis and the packed time series instead give each antenna its own stream.
+
+    :return: Offsets (rad) [ntimes, nant, 2]
+    """
+    if seed is not None:
+        seed = create_legacy_seed(seed, scenario)
+    error_pt = simulate_pointingtable_from_timeseries(create_pointingtable_from_blockvisibility(bvis),
+                                                      type=time_series, time_series_type=time_series_type,
+                                                      seed=seed)
+    return error_pt.pointing[:, :, 0, 0, :]
+
+
+def create_pointing_errors_gain_stack_rsexecute_workflow(sub_bvis_list, sub_components, sub_vp_list, scenarios,
+                                                         use_radec=False, pointing_error=0.0,
+                                                         static_pointing_error=None, global_pointing_error=None,
+                                                         time_series='', seeds=None, sub_vp_gradient_list=None,
+                                                         pointing_directory=None, interpolate_psd=False,
+                                                         correlate_wind=False, wind_speed=10.0, stream=False,
+                                                         stream_origin=0.0, full_jones=False, beam_fit=None,
+                                                         time_series_directory=None):
+    """ Construct the stacked voltage gains for all scenarios, one graph per visibility chunk
+
+    Each element evaluates to complex voltage gains [nscenarios + 1, ntimes, nant, ncomp], or
+    [nscenarios + 1, ntimes, nant, nchan, ncomp] for a multi-channel voltage pattern, where the first scenario is
+    error-free. Persist the result and use gaintables_from_gain_stack_rsexecute_workflow to extract the
+    gaintables for one scenario. Note that the stack holds nscenarios + 1 gaintables' worth of gains per chunk.
+    With full_jones each element is instead the Jones matrices [nscenarios + 1, ntimes, nant, nchan, ncomp, 2, 2]
+    of a voltage pattern with 4 polarisations, for calculate_residual_visibility_from_gain_stack_rsexecute_workflow.
+
+    If sub_vp_gradient_list is given, the gains are linearized about the error-free pointing using the gradient
+    images (see simulate_linearized_gains_from_pointing_offsets) instead of interpolating the voltage pattern at
+    every offset. If beam_fit is given, the gains are evaluated from the beam fits of each chunk's elevation and
+    channels (see simulate_gains_from_beam_fit) and sub_vp_list is not used.
+
+    :param sub_bvis_list: List of BlockVisibility graphs
+    :param sub_components: List of Skycomponents
+    :param sub_vp_list: List of voltage pattern graphs, one per BlockVisibility
+    :param scenarios: List of multipliers or time series types
+    :param use_radec: Calculate in RADEC rather than AZELGEO?
+    :param pointing_error: Dynamic pointing error (rad) for unit multiplier
+    :param static_pointing_error: Static pointing error (rad) for unit multiplier
+    :param global_pointing_error: Global pointing error (rad)
+    :param time_series: Type of time series: '', 'wind' or 'tracking'
+    :param seeds: Random number seeds, one per BlockVisibility
+    :param sub_vp_gradient_list: List of graphs for gradient images from create_vp_gradients, one per BlockVisibility
+    :param pointing_directory: Directory of PSD files per condition, to synthesise the time series from the PSDs
+    :param interpolate_psd: Interpolate the PSDs along the track of each chunk rather than use the nearest file?
+    :param correlate_wind: Correlate the synthesised errors across the array using the spatial PSD?
+    :param wind_speed: Wind speed for the spatial correlation (m/s)
+    :param stream: Make the synthesised errors of each chunk a slice of one continuous series? The seeds of all
+        chunks must then be the same.
+    :param stream_origin: Time of the first sample of the continuous series (s), at or before the first chunk. This
+        is also the time origin of the packed time series.
+    :param full_jones: Stack the Jones matrices rather than the gains of the first polarisation?
+    :param beam_fit: Name of a beam fits file from fit_beams, to evaluate instead of the voltage patterns
+    :param time_series_directory: Directory of packed time series per condition, to read the time series from. The
+        seeds of all chunks must then be the same, for the series of each antenna to continue across chunks.
+    :return: List of gain stack graphs
+    """
+    if seeds is None:
+        seeds = [None for bvis in sub_bvis_list]
+
+    offsets_list = [rsexecute.execute(create_pointing_offsets_stack)(bvis, scenarios, pointing_error=pointing_error,
+                                                                     static_pointing_error=static_pointing_error,
+                                                                     global_pointing_error=global_pointing_error,
+                                                                     time_series=time_series, seed=seeds[ibv],
+                                                                     pointing_directory=pointing_directory,
+                                                                     interpolate_psd=interpolate_psd,
+                                                                     correlate_wind=correlate_wind,
+                                                                     wind_speed=wind_speed, stream=stream,
+                                                                     stream_origin=stream_origin,
+                                                                     time_series_directory=time_series_directory)
+                    for ibv, bvis in enumerate(sub_bvis_list)]
+
+    if beam_fit is not None:
+        fits_list = [rsexecute.execute(create_beam_fits_from_file)(bvis, beam_fit) for bvis in sub_bvis_list]
+        return [rsexecute.execute(simulate_gains_from_beam_fit)(bvis, sub_components, offsets_list[ibv],
+                                                                fits_list[ibv], use_radec=use_radec,
+                                                                full_jones=full_jones)
+                for ibv, bvis in enumerate(sub_bvis_list)]
+
+    if sub_vp_gradient_list is not None:
+        return [rsexecute.execute(simulate_linearized_gains_from_pointing_offsets)(bvis, sub_components,
+                                                                                   offsets_list[ibv],
+                                                                                   sub_vp_list[ibv],
+                                                                                   sub_vp_gradient_list[ibv],
+                                                                                   use_radec=use_radec,
+                                                                                   full_jones=full_jones)
+                for ibv, bvis in enumerate(sub_bvis_list)]
+
+    return [rsexecute.execute(simulate_gains_from_pointing_offsets)(bvis, sub_components, offsets_list[ibv],
+                                                                    sub_vp_list[ibv], use_radec=use_radec,
+                                                                    full_jones=full_jones)
+            for ibv, bvis in enumerate(sub_bvis_list)]
+
+
+def create_gaintables_from_gain_stack(bvis, components, gain_stack, iscenario):
+    """ Extract the gaintables for one scenario from a gain stack
+
+    :param bvis: BlockVisibility
+    :param components: List of Skycomponents
+    :param gain_stack: Complex voltage gains [nscenarios + 1, ntimes, nant, (nchan,) ncomp]
+    :param iscenario: Index into the stack, 0 is error-free
+    :return: List of GainTables, one per component
+    """
+    return create_gaintables_from_gains(bvis, components, gain_stack[iscenario])
+
+
+def gaintables_from_gain_stack_rsexecute_workflow(sub_bvis_list, sub_components, gain_stack_list, iscenario):
+    """ Extract the gaintables for one scenario from each chunk's gain stack
+
+    The result has the same structure as the lists returned by create_pointing_errors_gaintable_rsexecute_workflow
+    and so can be passed to calculate_residual_from_gaintables_rsexecute_workflow.
+
+    :param sub_bvis_list: List of BlockVisibility graphs
+    :param sub_components: List of Skycomponents
+    :param gain_stack_list: List of gain stack graphs
+    :param iscenario: Index into the stack, 0 is error-free
+    :return: List (one per BlockVisibility) of lists of GainTables
+    """
+    return [rsexecute.execute(create_gaintables_from_gain_stack, nout=len(sub_components))
+            (bvis, sub_components, gain_stack_list[ibv], iscenario)
+            for ibv, bvis in enumerate(sub_bvis_list)]
+
+
+def scatter_gaintable_lists(gt_lists):
+    """ Scatter computed gaintables, keeping the nesting of one list per BlockVisibility
+
+    Each gaintable is scattered separately: scattering the nested list would give one future per BlockVisibility,
+    which cannot be indexed by component in the workflows.
+
+    :param gt_lists: List (one per BlockVisibility) of lists of GainTables
+    :return: List (one per BlockVisibility) of lists of futures
+    """
+    nchunks = len(gt_lists)
+    ncomps = len(gt_lists[0])
+    future_gts = rsexecute.scatter([gt for gt_list in gt_lists for gt in gt_list])
+    return [future_gts[ichunk * ncomps:(ichunk + 1) * ncomps] for ichunk in range(nchunks)]
+
+
+def summarise_visibility(vis):
+    """ Summarise a Visibility or BlockVisibility
+
+    Run this on the workers to avoid bringing the visibility back to the client.
+
+    :param vis: Visibility or BlockVisibility
+    :return: dict with nants, ntimes and size (GB)
+    """
+    return {'nants': len(vis.configuration.names), 'ntimes': len(numpy.unique(vis.time)), 'size': vis.size()}
+
+
+def summarise_dirty_image(dirty):
+    """ Summarise a dirty image by the statistics recorded in the simulation results
+
+    Run this on the workers so that only the statistics come back to the client.
+
+    A polarised image (e.g. stokesIQUV) is summarised by its first polarisation, and the statistics of each other
+    polarisation are added with its name as suffix, e.g. maxabs_Q.
+
+    :param dirty: (Image, sumwt) as returned by sum_invert_results
+    :return: dict with maxabs, rms, medianabs, abscentral (value at the central pixel) and sumwt
+    """
+    im, sumwt = dirty
+    _, npol, ny, nx = im.shape
+    if npol == 1:
+        qa = qa_image(im)
+        summary = {field: qa.data[field] for field in ['maxabs', 'rms', 'medianabs']}
+    else:
+        names = sorted(im.polarisation_frame.translations, key=im.polarisation_frame.translations.get)
+        summary = dict()
+        for pol, name in enumerate(names):
+            data = im.data[:, pol]
+            suffix = '' if pol == 0 else '_%s' % name
+            summary['maxabs' + suffix] = numpy.max(numpy.abs(data))
+            summary['rms' + suffix] = numpy.std(data)
+            summary['medianabs' + suffix] = numpy.median(numpy.abs(data))
+    summary['abscentral'] = numpy.abs(im.data[0, 0, ny // 2, nx // 2])
+    summary['sumwt'] = sumwt
+    return summary
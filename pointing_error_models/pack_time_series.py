@@ -0,0 +1,37 @@
+"""Pack the precomputed time series of each condition into one memory-mapped array, for --time_series_method packed
+
+Run from this directory::
+
+    python pack_time_series.py out/precision out/standard out/degraded
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from mid_pointing.timeseries import pack_time_series, PackedTimeSeries
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pack pointing error time series')
+    parser.add_argument('directories', type=str, nargs='*', help='Condition directories (default all of out/)')
+    args = parser.parse_args()
+
+    directories = args.directories
+    if len(directories) == 0:
+        out = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'out')
+        directories = [os.path.join(out, d) for d in sorted(os.listdir(out))
+                       if os.path.isdir(os.path.join(out, d))]
+
+    for directory in directories:
+        print("Packing %s" % directory)
+        try:
+            pack_time_series(directory)
+        except ValueError as err:
+            print("    %s" % err)
+            continue
+        store = PackedTimeSeries(directory)
+        print("    elevations %s, azimuths %s, axes %s, shape %s" % (store.header['elevations'],
+                                                                    store.header['azimuths'], store.axes,
+                                                                    str(store.data.shape)))
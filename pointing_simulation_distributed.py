@@ -23,7 +23,7 @@ results_dir = rascil_path('test_results')
 
 import numpy
 
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, EarthLocation
 from astropy import units as u
 
 from rascil.data_models.polarisation import PolarisationFrame
@@ -31,16 +31,22 @@ from rascil.data_models.polarisation import PolarisationFrame
 from rascil.processing_components import plot_azel, \
     plot_uvcoverage, find_pb_width_null, create_simulation_components, convert_blockvisibility_to_visibility, \
     convert_visibility_to_blockvisibility, show_image, qa_image, export_image_to_fits, create_vp, \
-    create_image_from_visibility, advise_wide_field
+    create_image_from_visibility, advise_wide_field, create_configuration_from_MIDfile
 
 from rascil.workflows import invert_list_rsexecute_workflow, \
     sum_invert_results_rsexecute, weight_list_rsexecute_workflow, \
-    calculate_residual_from_gaintables_rsexecute_workflow, \
     create_pointing_errors_gaintable_rsexecute_workflow, \
     create_standard_mid_simulation_rsexecute_workflow, sum_invert_results
 
 from workflows.rsexecute.execution_support.rsexecute import rsexecute, get_dask_client
 
+from mid_pointing import create_pointing_errors_gain_stack_rsexecute_workflow, create_vp_gradients, ProductCache, \
+    hash_inputs, hash_file, scatter_gaintable_lists, ScenarioCheckpoint, compute_chunks_with_checkpoint, \
+    summarise_visibility, summarise_dirty_image, calculate_residual_visibility_rsexecute_workflow, \
+    calculate_residual_visibility_from_gain_stack_rsexecute_workflow, plan_simulation, print_plan, StageTimer, \
+    predict_error_free_visibility_rsexecute_workflow, create_chunk_seeds, create_vp_from_beam_cube, \
+    create_mid_simulation_rsexecute_workflow
+
 import logging
 
 log = logging.getLogger()
@@ -60,8 +66,6 @@ if __name__ == '__main__':
     print("--------------------------------------------")
     print(" ")
     
-    memory_use = dict()
-    
     # Get command line inputs
     import argparse
     
@@ -76,10 +80,12 @@ if __name__ == '__main__':
     parser.add_argument('--rmax', type=float, default=1e5,
                         help='Maximum distance of station from centre (m)')
     parser.add_argument('--band', type=str, default='B2', help="Band")
+    parser.add_argument('--nfreqwin', type=int, default=1, help='Number of frequency channels')
+    parser.add_argument('--bandwidth', type=float, default=1e7, help='Total bandwidth of the channels (Hz)')
     parser.add_argument('--integration_time', type=float, default=600, help='Integration time (s)')
     parser.add_argument('--time_range', type=float, nargs=2, default=[-6.0, 6.0], help='Time range in hours')
     
-    parser.add_argument('--npixel', type=int, default=512, help='Number of pixels in image')
+    parser.add_argument('--npixel', type=int, default=None, help='Number of pixels in image (planned if not given)')
     parser.add_argument('--use_natural', type=str, default='False', help='Use natural weighting?')
     
     parser.add_argument('--snapshot', type=str, default='False', help='Do snapshot only?')
@@ -88,6 +94,10 @@ if __name__ == '__main__':
     parser.add_argument('--offset_dir', type=float, nargs=2, default=[1.0, 0.0], help='Multipliers for null offset')
     parser.add_argument('--pbradius', type=float, default=2.0, help='Radius of sources to include (in HWHM)')
     parser.add_argument('--pbtype', type=str, default='MID', help='Primary beam model: MID or MID_GAUSS')
+    parser.add_argument('--vp_cube', type=str, default='',
+                        help='Beam cube giving the voltage pattern at the elevation of each chunk (pbtype if empty)')
+    parser.add_argument('--beam_fit', type=str, default='',
+                        help='Beam fits giving the gains at the elevation of each chunk, instead of a voltage pattern')
     parser.add_argument('--seed', type=int, default=18051955, help='Random number seed')
     parser.add_argument('--flux_limit', type=float, default=1.0, help='Flux limit (Jy)')
     
@@ -106,7 +116,7 @@ if __name__ == '__main__':
     parser.add_argument('--serial', type=str, default='False', help='Use serial processing?')
     
     # Simulation parameters
-    parser.add_argument('--time_chunk', type=float, default=1800.0, help="Time for a chunk (s)")
+    parser.add_argument('--time_chunk', type=float, default=None, help="Time for a chunk (s) (planned if not given)")
     parser.add_argument('--time_series', type=str, default='wind', help="Type of time series")
     parser.add_argument('--global_pe', type=float, nargs=2, default=[0.0, 0.0], help='Global pointing error')
     parser.add_argument('--static_pe', type=float, nargs=2, default=[0.0, 0.0], help='Multipliers for static errors')
@@ -114,6 +124,37 @@ if __name__ == '__main__':
     parser.add_argument('--pointing_file', type=str, default=None, help="Pointing file")
     parser.add_argument('--pointing_directory', type=str, default='../../pointing_error_models/PSD_data/',
                         help='Location of pointing files')
+    parser.add_argument('--multi_scenario', type=str, default=None,
+                        help='Construct the gaintables for all scenarios in one pass? (default False, unless implied)')
+    parser.add_argument('--gain_method', type=str, default='interpolate',
+                        help='Gains from VP: interpolate, linear or quadratic (in VP gradients)')
+    parser.add_argument('--full_jones', type=str, default='False',
+                        help='Use the full Jones matrices of the vp_cube, giving polarised residuals?')
+    parser.add_argument('--time_series_method', type=str, default='rascil',
+                        help='Pointing time series: rascil, synthesis (from the PSDs in pointing_directory) or '
+                             'packed (from the packed time series in time_series_directory)')
+    parser.add_argument('--time_series_directory', type=str, default='../../pointing_error_models/out/',
+                        help='Location of the packed time series per condition (packed only)')
+    parser.add_argument('--interpolate_psd', type=str, default='False',
+                        help='Interpolate the PSDs in elevation and azimuth along the track (synthesis only)?')
+    parser.add_argument('--correlate_wind', type=str, default='False',
+                        help='Correlate the wind errors across the array using the spatial PSD (synthesis only)?')
+    parser.add_argument('--wind_speed', type=float, default=10.0, help='Wind speed for the spatial correlation (m/s)')
+    parser.add_argument('--stream_time_series', type=str, default='False',
+                        help='Make the synthesised errors continuous across time chunks (synthesis only)?')
+    parser.add_argument('--cache_directory', type=str, default='',
+                        help='Directory for cache of error-free products (none if empty)')
+    parser.add_argument('--cache_size', type=float, default=100.0, help='Maximum size of cache (GB)')
+    parser.add_argument('--checkpoint_directory', type=str, default='',
+                        help='Directory for checkpoints of the scenario loop (none if empty)')
+    parser.add_argument('--resume', type=str, default='False', help='Resume from the checkpoint directory?')
+    parser.add_argument('--single_graph', type=str, default='False',
+                        help='Keep all processing on the workers, returning only the QA?')
+    parser.add_argument('--component_group', type=int, default=None,
+                        help='Number of components per residual task (planned if not given)')
+    parser.add_argument('--instrument', type=str, default='False',
+                        help='Record time, tasks, transfers and memory per stage?')
+    parser.add_argument('--trace_file', type=str, default='', help='Chrome trace of stages and tasks (none if empty)')
     
     args = parser.parse_args()
     pp.pprint(vars(args))
@@ -126,6 +167,8 @@ if __name__ == '__main__':
     from matplotlib import pyplot as plt
     
     band = args.band
+    nfreqwin = args.nfreqwin
+    bandwidth = args.bandwidth
     ra = args.ra
     declination = args.declination
     use_radec = args.use_radec == "True"
@@ -138,6 +181,8 @@ if __name__ == '__main__':
     opposite = args.opposite == 'True'
     offset_dir = args.offset_dir
     pbtype = args.pbtype
+    vp_cube = args.vp_cube
+    beam_fit = args.beam_fit
     pbradius = args.pbradius
     rmax = args.rmax
     flux_limit = args.flux_limit
@@ -151,6 +196,61 @@ if __name__ == '__main__':
     global_pe = numpy.array(args.global_pe)
     static_pe = numpy.array(args.static_pe)
     dynamic_pe = args.dynamic_pe
+    multi_scenario = args.multi_scenario == 'True'
+    # The options that need the multi-scenario pass
+    needs_multi_scenario = []
+    gain_method = args.gain_method
+    if gain_method not in ['interpolate', 'linear', 'quadratic']:
+        raise ValueError("Unknown gain method %s" % gain_method)
+    if gain_method != 'interpolate':
+        needs_multi_scenario.append('--gain_method %s' % gain_method)
+    if beam_fit != '' and gain_method != 'interpolate':
+        raise ValueError("Gains from beam fits are evaluated at every offset, so gain method %s cannot be used" %
+                         gain_method)
+    if beam_fit != '':
+        needs_multi_scenario.append('--beam_fit')
+    full_jones = args.full_jones == 'True'
+    if full_jones and vp_cube == '' and beam_fit == '':
+        raise ValueError("Full-Jones gains need the polarised voltage patterns of a vp_cube or beam_fit")
+    if full_jones:
+        needs_multi_scenario.append('--full_jones True')
+    # Full-Jones gains give linear visibilities, imaged in all Stokes parameters
+    image_polarisation_frame = PolarisationFrame("stokesIQUV") if full_jones else PolarisationFrame("stokesI")
+    time_series_method = args.time_series_method
+    if time_series_method not in ['rascil', 'synthesis', 'packed']:
+        raise ValueError("Unknown time series method %s" % time_series_method)
+    time_series_directory = args.time_series_directory
+    interpolate_psd = args.interpolate_psd == 'True'
+    correlate_wind = args.correlate_wind == 'True'
+    stream_time_series = args.stream_time_series == 'True'
+    if time_series_method == 'packed' and (interpolate_psd or correlate_wind or stream_time_series):
+        raise ValueError("--interpolate_psd, --correlate_wind and --stream_time_series need the synthesis of the "
+                         "time series, not --time_series_method packed")
+    if interpolate_psd and time_series_method != 'synthesis':
+        log.warning("PSD interpolation requires the synthesis of the time series: using --time_series_method "
+                    "synthesis")
+        time_series_method = 'synthesis'
+    wind_speed = args.wind_speed
+    if correlate_wind and time_series != 'wind':
+        print("Only the wind errors are correlated across the array, so the %s errors are independent" % time_series)
+    if correlate_wind and time_series_method != 'synthesis':
+        log.warning("Spatially correlated wind errors require the synthesis of the time series: using "
+                    "--time_series_method synthesis")
+        time_series_method = 'synthesis'
+    if stream_time_series and time_series_method != 'synthesis':
+        log.warning("Streamed time series require the synthesis of the time series: using --time_series_method "
+                    "synthesis")
+        time_series_method = 'synthesis'
+    if time_series_method in ['synthesis', 'packed']:
+        needs_multi_scenario.append('--time_series_method %s' % time_series_method)
+    # The multi-scenario pass changes the memory needed, so it is not turned on silently, and is planned for below
+    if len(needs_multi_scenario) > 0 and not multi_scenario:
+        if args.multi_scenario == 'False':
+            raise ValueError("--multi_scenario False cannot be used with %s, which need the multi-scenario pass" %
+                             ', '.join(needs_multi_scenario))
+        log.warning("Using the multi-scenario pass (--multi_scenario True), as needed by %s" %
+                    ', '.join(needs_multi_scenario))
+        multi_scenario = True
     
     seed = args.seed
     print("Random number seed is", seed)
@@ -161,6 +261,16 @@ if __name__ == '__main__':
     threads_per_worker = args.nthreads
     memory = args.memory
     serial = args.serial == "True"
+    cache_directory = args.cache_directory
+    cache_size = args.cache_size
+    checkpoint_directory = args.checkpoint_directory
+    resume = args.resume == 'True'
+    if resume and checkpoint_directory == '':
+        raise ValueError("Resume requires a checkpoint directory")
+    single_graph = args.single_graph == 'True'
+    component_group = args.component_group
+    instrument = args.instrument == 'True' or args.trace_file != ''
+    trace_file = args.trace_file
     
     basename = os.path.basename(os.getcwd())
     
@@ -182,40 +292,35 @@ if __name__ == '__main__':
             rsexecute.set_client(client=client)
     
         print(rsexecute.client)
-    actualnworkers = len(rsexecute.client.scheduler_info()['workers'])
-    nworkers = actualnworkers
-    print("Using %s Dask workers" % nworkers)
+    workers = rsexecute.client.scheduler_info()['workers']
+    nworkers = len(workers)
+    # The workers may not have --nthreads threads (e.g. from the default client), so plan for those they have
+    threads_per_worker = max(worker['nthreads'] for worker in workers.values())
+    print("Using %s Dask workers with %d threads each" % (nworkers, threads_per_worker))
+    
+    # Stages repeated for each scenario are reset at the start of each scenario
+    stages = ['bvis', 'weighting', 'psf', 'vp', 'gain_stack', 'error_free', 'gaintable', 'residual', 'invert', 'sum']
+    scenario_stages = ['gaintable', 'residual', 'invert', 'sum']
+    timer = StageTimer(enabled=instrument, trace=trace_file != '')
     
     time_started = time.time()
     
     # Set up details of simulated observation
-    nfreqwin = 1
     diameter = 15.0
     if band == 'B1':
-        frequency = [0.765e9]
+        centre_frequency = 0.765e9
     elif band == 'B2':
-        frequency = [1.36e9]
+        centre_frequency = 1.36e9
     elif band == 'Ku':
-        frequency = [12.179e9]
+        centre_frequency = 12.179e9
     else:
         raise ValueError("Unknown band %s" % band)
     
-    channel_bandwidth = [1e7]
+    # Equal channels spanning the bandwidth about the centre of the band
+    frequency = list(centre_frequency + (numpy.arange(nfreqwin) - (nfreqwin - 1) / 2.0) * bandwidth / nfreqwin)
+    channel_bandwidth = [bandwidth / nfreqwin for _ in range(nfreqwin)]
     phasecentre = SkyCoord(ra=ra * u.deg, dec=declination * u.deg, frame='icrs', equinox='J2000')
     
-    bvis_graph = create_standard_mid_simulation_rsexecute_workflow(band, rmax, phasecentre, time_range, time_chunk, integration_time,
-                                                                    shared_directory)
-    future_bvis_list = rsexecute.persist(bvis_graph)
-    bvis_list0 = rsexecute.compute(bvis_graph[0], sync=True)
-    nchunks = len(bvis_graph)
-    memory_use['bvis_list'] = nchunks * bvis_list0.size()
-    
-    vis_graph = [rsexecute.execute(convert_blockvisibility_to_visibility)(bv) for bv in future_bvis_list]
-    future_vis_list = rsexecute.persist(vis_graph, sync=True)
-    
-    vis_list0 = rsexecute.compute(vis_graph[0], sync=True)
-    memory_use['vis_list'] = nchunks * vis_list0.size()
-    
     # We need the HWHM of the primary beam, and the location of the nulls
     HWHM_deg, null_az_deg, null_el_deg = find_pb_width_null(pbtype, frequency)
     
@@ -224,21 +329,11 @@ if __name__ == '__main__':
     FOV_deg = 8.0 * 1.36e9 / frequency[0]
     print('%s: HWHM beam = %g deg' % (pbtype, HWHM_deg))
     
-    advice_list = rsexecute.execute(advise_wide_field)(future_vis_list[0], guard_band_image=1.0, delA=0.02)
-    advice = rsexecute.compute(advice_list, sync=True)
     pb_npixel = 1024
     d2r = numpy.pi / 180.0
     pb_cellsize = d2r * FOV_deg / pb_npixel
-    cellsize = advice['cellsize']
-    
-    if show:
-        vis_list = rsexecute.compute(vis_graph, sync=True)
-        plot_uvcoverage(vis_list, title=basename)
-        
-        bvis_list = rsexecute.compute(bvis_graph, sync=True)
-        plot_azel(bvis_list, title=basename)
     
-    # Now construct the components
+    # Now construct the components. These are needed first to plan the processing.
     original_components, offset_direction = create_simulation_components(context, phasecentre, frequency,
                                                                          pbtype, offset_dir, flux_limit,
                                                                          pbradius * HWHM, pb_npixel, pb_cellsize)
@@ -247,17 +342,102 @@ if __name__ == '__main__':
         scenarios = [1.0, 2.0, 4.0, 8.0, 16.0, 32.0, 64.0, 128.0, 256.0]
     else:
         scenarios = ['precision', 'standard', 'degraded']
+        if time_series_method == 'packed':
+            for scenario in scenarios:
+                if not os.path.exists(os.path.join(time_series_directory, scenario, 'time_series.json')):
+                    raise ValueError("No packed time series in %s: run pointing_error_models/pack_time_series.py" %
+                                     os.path.join(time_series_directory, scenario))
     
-    # Estimate resource usage
-    nants = len(bvis_list0.configuration.names)
-    ntimes = len(bvis_list0.time)
-    nbaselines = nants * (nants - 1) // 2
+    # Choose the time chunk, component grouping and image size that fit in the memory of the workers. Values
+    # given on the command line are not changed.
+    mid_location = EarthLocation(lon="21.443803", lat="-30.712925", height=0.0)
+    mid = create_configuration_from_MIDfile('%s/ska1mid_local.cfg' % shared_directory, rmax=rmax,
+                                            location=mid_location)
+    nvp_gradients = {'interpolate': 0, 'linear': 2, 'quadratic': 5}[gain_method]
+    plan = plan_simulation(memory, nworkers, threads_per_worker, len(mid.names), len(original_components),
+                           len(scenarios), time_range, integration_time, phasecentre.dec.rad, mid_location.lat.rad,
+                           time_chunk=time_chunk, component_group=component_group, npixel=npixel,
+                           pb_npixel=pb_npixel, multi_scenario=multi_scenario, nvp_gradients=nvp_gradients,
+                           nchan=nfreqwin, full_jones=full_jones, error_free_vis=cache_directory != '')
+    print_plan(plan)
+    if not plan['fits']:
+        if args.time_chunk is None or args.component_group is None:
+            raise ValueError("No plan fits in %.1f GB per worker: use more workers or memory" % memory)
+        log.warning("No plan fits in %.1f GB per worker: running with the given time chunk and component group" %
+                    memory)
+    time_chunk = plan['time_chunk']
+    component_group = plan['component_group']
+    npixel = plan['npixel']
+    
+    # The weighted visibilities and the PSF depend only on the observation so they can be cached across runs. The
+    # visibilities of each chunk are a separate product, saved and loaded by the workers, so they never pass through
+    # the client; the 'baseline' product (PSF and number of chunks) is saved last and marks the entry as complete.
+    if cache_directory != '':
+        cache = ProductCache(cache_directory, max_size=cache_size)
+        baseline_key = hash_inputs(band=band, rmax=rmax, phasecentre=phasecentre, time_range=time_range,
+                                   time_chunk=time_chunk, integration_time=integration_time,
+                                   configuration=hash_file('%s/ska1mid_local.cfg' % shared_directory), npixel=npixel,
+                                   use_natural=use_natural, nfreqwin=nfreqwin, bandwidth=bandwidth,
+                                   full_jones=full_jones)
+        cached_baseline = cache.load(baseline_key, 'baseline')
+        if cached_baseline is not None and not all(cache.contains(baseline_key, '%s_%d' % (name, ichunk))
+                                                   for ichunk in range(cached_baseline['nchunks'])
+                                                   for name in ['bvis', 'vis']):
+            print("Cached visibilities are incomplete, remaking them")
+            cached_baseline = None
+    else:
+        cache = None
+        cached_baseline = None
+    
+    with timer.stage('bvis'):
+        if cached_baseline is None:
+            if nfreqwin > 1 or full_jones:
+                vis_polarisation_frame = PolarisationFrame("linear") if full_jones else None
+                bvis_graph = create_mid_simulation_rsexecute_workflow(frequency, channel_bandwidth, rmax, phasecentre,
+                                                                      time_range, time_chunk, integration_time,
+                                                                      shared_directory,
+                                                                      polarisation_frame=vis_polarisation_frame)
+            else:
+                bvis_graph = create_standard_mid_simulation_rsexecute_workflow(band, rmax, phasecentre, time_range,
+                                                                                time_chunk, integration_time,
+                                                                                shared_directory)
+            future_bvis_list = rsexecute.persist(bvis_graph)
+            
+            vis_graph = [rsexecute.execute(convert_blockvisibility_to_visibility)(bv) for bv in future_bvis_list]
+            future_vis_list = timer.wait(rsexecute.persist(vis_graph, sync=True))
+            
+            # Only a summary of the first chunk is needed here
+            bvis_summary0, vis_summary0 = \
+                rsexecute.compute([rsexecute.execute(summarise_visibility)(future_bvis_list[0]),
+                                   rsexecute.execute(summarise_visibility)(future_vis_list[0])], sync=True)
+        else:
+            print("Using weighted visibilities and PSF from cache")
+            bvis_graph = [rsexecute.execute(cache.load)(baseline_key, 'bvis_%d' % ichunk)
+                          for ichunk in range(cached_baseline['nchunks'])]
+            vis_graph = [rsexecute.execute(cache.load)(baseline_key, 'vis_%d' % ichunk)
+                         for ichunk in range(cached_baseline['nchunks'])]
+            future_bvis_list = rsexecute.persist(bvis_graph)
+            future_vis_list = timer.wait(rsexecute.persist(vis_graph, sync=True))
+            bvis_summary0, vis_summary0 = \
+                rsexecute.compute([rsexecute.execute(summarise_visibility)(future_bvis_list[0]),
+                                   rsexecute.execute(summarise_visibility)(future_vis_list[0])], sync=True)
+    
+    nchunks = len(future_bvis_list)
     
-    memory_use['model_list'] = 8 * npixel * npixel * len(frequency) * len(original_components) / 1024 / 1024 / 1024
-    memory_use['vp_list'] = 16 * npixel * npixel * len(frequency) * nchunks / 1024 / 1024 / 1024
-    print("Memory use (GB)")
-    pp.pprint(memory_use)
-    total_memory_use = numpy.sum([memory_use[key] for key in memory_use.keys()])
+    advice_list = rsexecute.execute(advise_wide_field)(future_vis_list[0], guard_band_image=1.0, delA=0.02)
+    advice = rsexecute.compute(advice_list, sync=True)
+    cellsize = advice['cellsize']
+    
+    if show:
+        vis_list = rsexecute.compute(future_vis_list, sync=True)
+        bvis_list = rsexecute.compute(future_bvis_list, sync=True)
+        plot_uvcoverage(vis_list, title=basename)
+        plot_azel(bvis_list, title=basename)
+        del vis_list, bvis_list
+    
+    nants = bvis_summary0['nants']
+    ntimes = bvis_summary0['ntimes']
+    nbaselines = nants * (nants - 1) // 2
     
     print("Summary of processing:")
     print("    There are %d workers" % nworkers)
@@ -269,40 +449,101 @@ if __name__ == '__main__':
     print("    %d scenario(s) will be tested" % len(scenarios))
     ntotal = ntimes * nbaselines * len(original_components) * len(scenarios)
     print("    Total processing %g times-baselines-components-scenarios" % ntotal)
-    print("    Approximate total memory use for data = %.3f GB" % total_memory_use)
+    print("    Size of visibility data = %.3f GB" % (nchunks * (bvis_summary0['size'] + vis_summary0['size'])))
+    print("    Predicted peak memory per worker = %.3f GB" % plan['estimate']['peak'])
     nworkers = len(rsexecute.client.scheduler_info()['workers'])
     print("    Using %s Dask workers" % nworkers)
+    print("    Residual visibilities are accumulated in groups of %d components" % component_group)
     
-    # Uniform weighting
-    psf_list = [rsexecute.execute(create_image_from_visibility)(v, npixel=npixel, frequency=frequency,
-                                                                 nchan=nfreqwin, cellsize=cellsize,
-                                                                 phasecentre=phasecentre,
-                                                                 polarisation_frame=PolarisationFrame("stokesI"))
-                for v in future_vis_list]
-    psf_list = rsexecute.compute(psf_list, sync=True)
-    future_psf_list = rsexecute.scatter(psf_list)
-    del psf_list
-    
-    if use_natural:
-        print("Using natural weighting")
-    else:
-        print("Using uniform weighting")
+    if cached_baseline is None and single_graph:
+        # Weighting and the PSF are composed into the graph and persisted on the workers
+        with timer.stage('weighting'):
+            psf_list = [rsexecute.execute(create_image_from_visibility)(v, npixel=npixel, frequency=frequency,
+                                                                         nchan=nfreqwin, cellsize=cellsize,
+                                                                         phasecentre=phasecentre,
+                                                                         polarisation_frame=image_polarisation_frame)
+                        for v in future_vis_list]
+            
+            if use_natural:
+                print("Using natural weighting")
+            else:
+                print("Using uniform weighting")
+                vis_list = weight_list_rsexecute_workflow(future_vis_list, psf_list)
+                future_vis_list = timer.wait(rsexecute.persist(vis_list))
+                del vis_list
+                
+                bvis_list = [rsexecute.execute(convert_visibility_to_blockvisibility)(vis)
+                             for vis in future_vis_list]
+                future_bvis_list = timer.wait(rsexecute.persist(bvis_list))
+                del bvis_list
         
-        vis_list = weight_list_rsexecute_workflow(future_vis_list, future_psf_list)
-        vis_list = rsexecute.compute(vis_list, sync=True)
-        future_vis_list = rsexecute.scatter(vis_list)
-        del vis_list
+        with timer.stage('psf'):
+            print("Inverting to get PSF")
+            psf_list = invert_list_rsexecute_workflow(future_vis_list, psf_list, '2d', dopsf=True)
+            future_psf = rsexecute.persist(sum_invert_results_rsexecute(psf_list))
+            del psf_list
+            psf_summary = rsexecute.compute(rsexecute.execute(summarise_dirty_image)(future_psf), sync=True)
+            sumwt = psf_summary['sumwt']
+            if export_images or show or cache is not None:
+                psf, _ = rsexecute.compute(future_psf, sync=True)
+            del future_psf
         
-        bvis_list = [rsexecute.execute(convert_visibility_to_blockvisibility)(vis)
-                     for vis in future_vis_list]
-        bvis_list = rsexecute.compute(bvis_list, sync=True)
-        future_bvis_list = rsexecute.scatter(bvis_list)
-        del bvis_list
-    
-    print("Inverting to get PSF")
-    psf_list = invert_list_rsexecute_workflow(future_vis_list, future_psf_list, '2d', dopsf=True)
-    psf_list = rsexecute.compute(psf_list, sync=True)
-    psf, sumwt = sum_invert_results(psf_list)
+        if cache is not None:
+            # The visibilities are saved by the workers holding them; only the PSF comes back to the client
+            saved = [rsexecute.execute(cache.save)(baseline_key, '%s_%d' % (name, ichunk), v)
+                     for name, v_list in [('bvis', future_bvis_list), ('vis', future_vis_list)]
+                     for ichunk, v in enumerate(v_list)]
+            rsexecute.compute(saved, sync=True)
+            cache.save(baseline_key, 'baseline', {'nchunks': len(future_bvis_list), 'psf': psf, 'sumwt': sumwt})
+    
+    elif cached_baseline is None:
+        with timer.stage('weighting'):
+            # Uniform weighting
+            psf_list = [rsexecute.execute(create_image_from_visibility)(v, npixel=npixel, frequency=frequency,
+                                                                         nchan=nfreqwin, cellsize=cellsize,
+                                                                         phasecentre=phasecentre,
+                                                                         polarisation_frame=image_polarisation_frame)
+                        for v in future_vis_list]
+            psf_list = rsexecute.compute(psf_list, sync=True)
+            future_psf_list = rsexecute.scatter(psf_list)
+            del psf_list
+            
+            if use_natural:
+                print("Using natural weighting")
+            else:
+                print("Using uniform weighting")
+                
+                vis_list = weight_list_rsexecute_workflow(future_vis_list, future_psf_list)
+                vis_list = rsexecute.compute(vis_list, sync=True)
+                future_vis_list = rsexecute.scatter(vis_list)
+                del vis_list
+                
+                bvis_list = [rsexecute.execute(convert_visibility_to_blockvisibility)(vis)
+                             for vis in future_vis_list]
+                bvis_list = rsexecute.compute(bvis_list, sync=True)
+                future_bvis_list = rsexecute.scatter(bvis_list)
+                del bvis_list
+        
+        with timer.stage('psf'):
+            print("Inverting to get PSF")
+            psf_list = invert_list_rsexecute_workflow(future_vis_list, future_psf_list, '2d', dopsf=True)
+            psf_list = rsexecute.compute(psf_list, sync=True)
+            psf, sumwt = sum_invert_results(psf_list)
+            psf_summary = summarise_dirty_image((psf, sumwt))
+            del psf_list
+            del future_psf_list
+        
+        if cache is not None:
+            saved = [rsexecute.execute(cache.save)(baseline_key, '%s_%d' % (name, ichunk), v)
+                     for name, v_list in [('bvis', future_bvis_list), ('vis', future_vis_list)]
+                     for ichunk, v in enumerate(v_list)]
+            rsexecute.compute(saved, sync=True)
+            cache.save(baseline_key, 'baseline', {'nchunks': len(future_bvis_list), 'psf': psf, 'sumwt': sumwt})
+    else:
+        psf, sumwt = cached_baseline['psf'], cached_baseline['sumwt']
+        psf_summary = summarise_dirty_image((psf, sumwt))
+        del cached_baseline
+    
     print("PSF sumwt ", sumwt)
     if export_images:
         export_image_to_fits(psf, 'PSF_rascil.fits')
@@ -310,50 +551,231 @@ if __name__ == '__main__':
         show_image(psf, cm='gray_r', title='%s PSF' % basename, vmin=-0.01, vmax=0.1)
         plt.savefig('PSF_rascil.png')
         plt.show(block=False)
-    del psf_list
-    del future_psf_list
-    
-    # ### Calculate the voltage pattern without errors
-    vp_list = [rsexecute.execute(create_image_from_visibility)(bv, npixel=pb_npixel, frequency=frequency,
-                                                                nchan=nfreqwin, cellsize=pb_cellsize,
-                                                                phasecentre=phasecentre,
-                                                                override_cellsize=False) for bv in future_bvis_list]
-    print("Constructing voltage pattern")
-    vp_list = [rsexecute.execute(create_vp)(vp, pbtype, pointingcentre=phasecentre, use_local=not use_radec)
-               for vp in vp_list]
-    future_vp_list = rsexecute.persist(vp_list)
-    del vp_list
-    
-    # Make one image per component
-    future_model_list = [rsexecute.execute(create_image_from_visibility)(future_vis_list[0], npixel=npixel,
-                                                                          frequency=frequency,
-                                                                          nchan=nfreqwin, cellsize=cellsize,
-                                                                          phasecentre=offset_direction,
-                                                                          polarisation_frame=PolarisationFrame(
-                                                                              "stokesI"))
-                         for i, _ in enumerate(original_components)]
-    
-    # Make a set of seeds, one per bvis, to ensure that we can get the same errors on different passes
-    seeds = numpy.round(numpy.random.uniform(1, numpy.power(2, 31), len(future_bvis_list))).astype('int')
+    
+    with timer.stage('vp'):
+        # ### Calculate the voltage pattern without errors
+        if beam_fit != '':
+            print("The gains are evaluated from the beam fits in %s, so no voltage pattern is constructed" % beam_fit)
+            vp_list = None
+        elif vp_cube != '':
+            print("Constructing voltage pattern at the elevation of each chunk from %s" % vp_cube)
+            vp_list = [rsexecute.execute(create_vp_from_beam_cube)(bv, os.path.abspath(vp_cube), frequency,
+                                                                   use_local=not use_radec,
+                                                                   pointingcentre=phasecentre)
+                       for bv in future_bvis_list]
+        else:
+            vp_list = [rsexecute.execute(create_image_from_visibility)(bv, npixel=pb_npixel, frequency=frequency,
+                                                                        nchan=nfreqwin, cellsize=pb_cellsize,
+                                                                        phasecentre=phasecentre,
+                                                                        override_cellsize=False)
+                       for bv in future_bvis_list]
+            print("Constructing voltage pattern")
+            vp_list = [rsexecute.execute(create_vp)(vp, pbtype, pointingcentre=phasecentre, use_local=not use_radec)
+                       for vp in vp_list]
+        if vp_list is not None:
+            future_vp_list = timer.wait(rsexecute.persist(vp_list))
+        else:
+            future_vp_list = [None for bv in future_bvis_list]
+        del vp_list
+        
+        if gain_method != 'interpolate':
+            print("Constructing voltage pattern gradients for %s gains" % gain_method)
+            vp_gradient_list = [rsexecute.execute(create_vp_gradients)(vp, second_order=gain_method == 'quadratic')
+                                for vp in future_vp_list]
+            future_vp_gradient_list = timer.wait(rsexecute.persist(vp_gradient_list))
+            del vp_gradient_list
+        else:
+            future_vp_gradient_list = None
+    
+    # A single template image: the residual visibilities of all components are inverted together
+    future_model = rsexecute.execute(create_image_from_visibility)(future_vis_list[0], npixel=npixel,
+                                                                   frequency=frequency,
+                                                                   nchan=nfreqwin, cellsize=cellsize,
+                                                                   phasecentre=offset_direction,
+                                                                   polarisation_frame=image_polarisation_frame)
+    future_model = rsexecute.persist(future_model)
+    
+    if checkpoint_directory != '':
+        checkpoint = ScenarioCheckpoint(checkpoint_directory)
+        state = checkpoint.load_state() if resume else None
+    else:
+        checkpoint = None
+        state = None
+    
+    # The settings that determine the chunk images: a checkpoint made with other settings cannot be resumed
+    settings = {'nchunks': nchunks, 'scenarios': [str(scenario) for scenario in scenarios], 'seed': seed,
+                'gain_method': gain_method, 'time_series_method': time_series_method, 'time_chunk': float(time_chunk),
+                'component_group': int(component_group), 'npixel': int(npixel)}
+    if state is not None:
+        # The seeds must be those of the checkpointed run for the finished chunks to be valid
+        print("Resuming from checkpoint in %s" % checkpoint_directory)
+        mismatched = [key for key in settings if state.get(key) != settings[key]]
+        if len(mismatched) > 0:
+            raise ValueError("Checkpoint in %s does not match this simulation: %s differ" %
+                             (checkpoint_directory, ', '.join(mismatched)))
+        seeds = numpy.array(state['seeds'])
+        filename = state['filename']
+        plotfile = state['plotfile']
+        epoch = state['epoch']
+    else:
+        # Make a set of seeds, one per bvis, to ensure that we can get the same errors on different passes. The
+        # seed of each chunk is derived from the run's seed and the chunk's index, so any chunk can be remade alone
+        seeds = numpy.array(create_chunk_seeds(seed, len(future_bvis_list)))
+        
+        filename = seqfile.findNextFile(prefix='pointing_simulation_%s_' % socket.gethostname(), suffix='.csv')
+        plotfile = seqfile.findNextFile(prefix='pointing_simulation_%s_' % socket.gethostname(), suffix='.jpg')
+        
+        epoch = time.strftime("%Y-%m-%d %H:%M:%S")
+        
+        if checkpoint is not None:
+            state = dict(settings)
+            state.update({'seeds': [int(s) for s in seeds], 'filename': filename, 'plotfile': plotfile,
+                          'epoch': epoch})
+            checkpoint.save_state(state)
+    
     print("Seeds per chunk:")
     pp.pprint(seeds)
-    
-    filename = seqfile.findNextFile(prefix='pointing_simulation_%s_' % socket.gethostname(), suffix='.csv')
     print('Saving results to %s' % filename)
-    plotfile = seqfile.findNextFile(prefix='pointing_simulation_%s_' % socket.gethostname(), suffix='.jpg')
     
-    epoch = time.strftime("%Y-%m-%d %H:%M:%S")
+    def write_results(results):
+        # Rewrite the whole file so that it is complete after every scenario. Results from a checkpoint may
+        # lack some columns.
+        fieldnames = list(results[0].keys())
+        for result in results[1:]:
+            fieldnames += [key for key in result.keys() if key not in fieldnames]
+        with open(filename, 'w') as csvfile:
+            writer = csv.DictWriter(csvfile, fieldnames=fieldnames, delimiter=',', quotechar='|',
+                                    quoting=csv.QUOTE_MINIMAL)
+            writer.writeheader()
+            for result in results:
+                writer.writerow(result)
+            csvfile.close()
     
     time_started = time.time()
     
+    a2r = numpy.pi / (3600.0 * 180.0)
+    
+    # Synthesise the time series from the PSDs rather than use those of RASCIL
+    psd_directory = os.path.abspath(pointing_directory) if time_series_method == 'synthesis' else None
+    # Read the time series from the packed store, only the times of each chunk
+    packed_directory = os.path.abspath(time_series_directory) if time_series_method == 'packed' else None
+    # A streamed series is one series for the whole observation, as is the packed series of each antenna, so all
+    # chunks share the run's seed
+    stack_seeds = [seed for _ in seeds] if stream_time_series or packed_directory is not None else seeds
+    
+    # The error-free products depend on the voltage patterns but not on the pointing errors, so they are cached
+    # under one key in every mode. The error-free visibility of each chunk is the same for every scenario, so with a
+    # cache it is predicted (or loaded) once and each scenario predicts only its error visibility. Without the
+    # multi-scenario pass the error-free gaintables are also made (or loaded from the cache) once.
+    future_no_error_gtl = None
+    future_no_error_vis_list = None
+    if cache is not None:
+        no_error_key = hash_inputs(baseline=baseline_key, components=original_components, pbtype=pbtype,
+                                   vp_cube=os.path.abspath(vp_cube) if vp_cube != '' else '',
+                                   vp_cube_mtime=os.path.getmtime(vp_cube) if vp_cube != '' else 0.0,
+                                   beam_fit=os.path.abspath(beam_fit) if beam_fit != '' else '',
+                                   beam_fit_mtime=os.path.getmtime(beam_fit) if beam_fit != '' else 0.0,
+                                   gain_method=gain_method, pb_npixel=pb_npixel, pb_cellsize=pb_cellsize,
+                                   use_radec=use_radec)
+        if all(cache.contains(no_error_key, 'no_error_vis_%d' % ichunk) for ichunk in range(nchunks)):
+            print("Using error-free visibilities from cache")
+            with timer.stage('error_free'):
+                no_error_vis_list = [rsexecute.execute(cache.load)(no_error_key, 'no_error_vis_%d' % ichunk)
+                                     for ichunk in range(nchunks)]
+                future_no_error_vis_list = timer.wait(rsexecute.persist(no_error_vis_list))
+                del no_error_vis_list
+        if not multi_scenario:
+            no_error_gt_list = cache.load(no_error_key, 'no_error_gaintables')
+            if no_error_gt_list is not None:
+                print("Using error-free gaintables from cache")
+                future_no_error_gtl = scatter_gaintable_lists(no_error_gt_list)
+            del no_error_gt_list
+    
+    def predict_error_free_visibility(no_error_gtl=None, gain_stack_list=None):
+        """ Predict the error-free visibility of each chunk and save it to the cache, on the workers
+        """
+        print("Predicting the error-free visibilities once for all scenarios")
+        with timer.stage('error_free'):
+            no_error_vis_list = \
+                predict_error_free_visibility_rsexecute_workflow(future_bvis_list, original_components,
+                                                                 no_error_gt_list=no_error_gtl,
+                                                                 gain_stack_list=gain_stack_list,
+                                                                 component_group=component_group,
+                                                                 full_jones=full_jones)
+            no_error_vis_list = timer.wait(rsexecute.persist(no_error_vis_list))
+            saved = [rsexecute.execute(cache.save)(no_error_key, 'no_error_vis_%d' % ichunk, v)
+                     for ichunk, v in enumerate(no_error_vis_list)]
+            rsexecute.compute(saved, sync=True)
+        return no_error_vis_list
+    
+    if multi_scenario:
+        # Sample the voltage pattern for all scenarios in one pass per chunk. The first scenario in the stack
+        # is error-free.
+        print("Constructing gains for all %d scenarios in one pass" % len(scenarios))
+        with timer.stage('gain_stack'):
+            gain_stack_list = \
+                create_pointing_errors_gain_stack_rsexecute_workflow(future_bvis_list, original_components,
+                                                                     sub_vp_list=future_vp_list,
+                                                                     scenarios=scenarios,
+                                                                     use_radec=use_radec,
+                                                                     pointing_error=a2r * dynamic_pe,
+                                                                     static_pointing_error=a2r * static_pe,
+                                                                     global_pointing_error=a2r * global_pe,
+                                                                     time_series=time_series,
+                                                                     seeds=stack_seeds,
+                                                                     sub_vp_gradient_list=future_vp_gradient_list,
+                                                                     pointing_directory=psd_directory,
+                                                                     interpolate_psd=interpolate_psd,
+                                                                     correlate_wind=correlate_wind,
+                                                                     wind_speed=wind_speed,
+                                                                     stream=stream_time_series,
+                                                                     stream_origin=3600.0 * time_range[0],
+                                                                     full_jones=full_jones,
+                                                                     beam_fit=os.path.abspath(beam_fit)
+                                                                     if beam_fit != '' else None,
+                                                                     time_series_directory=packed_directory)
+            future_gain_stack_list = timer.wait(rsexecute.persist(gain_stack_list))
+            del gain_stack_list
+        if cache is not None and future_no_error_vis_list is None:
+            future_no_error_vis_list = predict_error_free_visibility(gain_stack_list=future_gain_stack_list)
+    
     # Now loop over all scenarios
     print("")
     print("***** Starting loop over scenarios ******")
     print("")
     results = []
     
+    def finish_result(result, summary):
+        for field in ['maxabs', 'rms', 'medianabs', 'abscentral']:
+            result["onsource_" + field] = summary[field]
+        # The leakage into the other Stokes parameters of a full-Jones simulation, e.g. onsource_maxabs_Q
+        for field in summary:
+            if field.split('_')[0] in ['maxabs', 'rms', 'medianabs'] and '_' in field:
+                result["onsource_" + field] = summary[field]
+        for field in ['maxabs', 'rms', 'medianabs']:
+            result["psf_" + field] = psf_summary[field]
+        result['elapsed_time'] = time.time() - time_started
+        print('Elapsed time = %.1f (s)' % result['elapsed_time'])
+    
+    def persist_chunks(graph_list, todo):
+        # When instrumented, persist only the chunks not yet checkpointed; the graphs of the others are never computed
+        graph_list = list(graph_list)
+        if len(todo) > 0:
+            for ichunk, graph in zip(todo, timer.persist([graph_list[ichunk] for ichunk in todo])):
+                graph_list[ichunk] = graph
+        return graph_list
+    
+    # In single graph mode the residuals of all scenarios are computed together after the loop
+    deferred_results = []
+    deferred_summaries = []
+    
     for scenario in scenarios:
         
+        if checkpoint is not None and checkpoint.is_finished(str(scenario)):
+            print("Scenario %s loaded from checkpoint" % scenario)
+            results.append(checkpoint.load_result(str(scenario)))
+            continue
+        
         result = dict()
         result['context'] = context
         result['nb_name'] = sys.argv[0]
@@ -366,6 +788,8 @@ if __name__ == '__main__':
         result['pb_npixel'] = pb_npixel
         result['flux_limit'] = flux_limit
         result['pbtype'] = pbtype
+        result['vp_cube'] = vp_cube
+        result['beam_fit'] = beam_fit
         result['snapshot'] = snapshot
         result['offset_dir'] = offset_dir
         result['opposite'] = opposite
@@ -379,13 +803,26 @@ if __name__ == '__main__':
         result['se'] = scenario
         result['band'] = band
         result['frequency'] = frequency
+        result['nfreqwin'] = nfreqwin
+        result['bandwidth'] = bandwidth
         
         result['time_series'] = time_series
         result['global_pe'] = global_pe
         result['static_pe'] = static_pe
         result['dynamic_pe'] = dynamic_pe
-        
-        a2r = numpy.pi / (3600.0 * 180.0)
+        result['multi_scenario'] = multi_scenario
+        result['gain_method'] = gain_method
+        result['full_jones'] = full_jones
+        result['time_series_method'] = time_series_method
+        result['time_series_directory'] = time_series_directory
+        result['interpolate_psd'] = interpolate_psd
+        result['correlate_wind'] = correlate_wind
+        result['wind_speed'] = wind_speed
+        result['stream_time_series'] = stream_time_series
+        result['single_graph'] = single_graph
+        result['time_chunk'] = time_chunk
+        result['component_group'] = component_group
+        result['predicted_peak_memory'] = plan['estimate']['peak']
         
         if time_series == '':
             global_pointing_error = global_pe
@@ -399,16 +836,6 @@ if __name__ == '__main__':
                   (global_pointing_error[0], global_pointing_error[1], static_pointing_error[0],
                    static_pointing_error[1], pointing_error))
             file_name = 'PE_%.1f_arcsec' % scenario
-            
-            no_error_gtl, error_gtl = \
-                create_pointing_errors_gaintable_rsexecute_workflow(future_bvis_list, original_components,
-                                                                     sub_vp_list=future_vp_list,
-                                                                     use_radec=use_radec,
-                                                                     pointing_error=a2r * pointing_error,
-                                                                     static_pointing_error=a2r * static_pointing_error,
-                                                                     global_pointing_error=a2r * global_pointing_error,
-                                                                     seeds=seeds,
-                                                                     show=show, basename=basename)
         
         else:
             result['static_pointing_error'] = [0.0, 0.0]
@@ -416,29 +843,101 @@ if __name__ == '__main__':
             result['global_pointing_error'] = [0.0, 0.0]
             
             file_name = 'PE_%s_%s' % (time_series, scenario)
+        
+        timer.reset(scenario_stages)
+        # The chunks of an interrupted scenario already in the checkpoint are loaded rather than recomputed
+        if checkpoint is not None:
+            todo = checkpoint.remaining_chunks(str(scenario), nchunks)
+        else:
+            todo = list(range(nchunks))
+        if multi_scenario:
+            # The residual is predicted directly from the gain stack so there are no gaintables to construct;
+            # the stack is recreated from the (checkpointed) seeds if the run is resumed
+            with timer.stage('residual'):
+                residual_vis_list = calculate_residual_visibility_from_gain_stack_rsexecute_workflow(
+                    future_bvis_list, original_components, future_gain_stack_list, scenarios.index(scenario) + 1,
+                    component_group=component_group, full_jones=full_jones,
+                    no_error_vis_list=future_no_error_vis_list)
+                residual_vis_list = persist_chunks(residual_vis_list, todo)
+        
+        else:
+            with timer.stage('gaintable'):
+                if time_series == '':
+                    no_error_gtl, error_gtl = create_pointing_errors_gaintable_rsexecute_workflow(
+                        future_bvis_list, original_components, sub_vp_list=future_vp_list, use_radec=use_radec,
+                        pointing_error=a2r * pointing_error, static_pointing_error=a2r * static_pointing_error,
+                        global_pointing_error=a2r * global_pointing_error, seeds=seeds, show=show, basename=basename)
+                
+                else:
+                    no_error_gtl, error_gtl = \
+                        create_pointing_errors_gaintable_rsexecute_workflow(future_bvis_list, original_components,
+                                                                             sub_vp_list=future_vp_list,
+                                                                             use_radec=use_radec,
+                                                                             time_series=time_series,
+                                                                             time_series_type=scenario,
+                                                                             seeds=seeds,
+                                                                             show=show, basename=basename)
+                
+                if checkpoint is not None:
+                    # Keep the error gaintables, reusing them if the scenario was interrupted
+                    error_gt_list = checkpoint.load_product(str(scenario), 'gaintables')
+                    if error_gt_list is None:
+                        error_gt_list = rsexecute.compute(error_gtl, sync=True)
+                        checkpoint.save_product(str(scenario), 'gaintables', error_gt_list)
+                    error_gtl = scatter_gaintable_lists(error_gt_list)
+                    del error_gt_list
+                else:
+                    error_gtl = timer.persist(error_gtl)
+                if future_no_error_gtl is None:
+                    future_no_error_gtl = timer.persist(no_error_gtl)
+                    if cache is not None:
+                        cache.save(no_error_key, 'no_error_gaintables',
+                                   rsexecute.compute(future_no_error_gtl, sync=True))
+                no_error_gtl = future_no_error_gtl
+            if cache is not None and future_no_error_vis_list is None:
+                future_no_error_vis_list = predict_error_free_visibility(no_error_gtl=no_error_gtl)
             
-            no_error_gtl, error_gtl = \
-                create_pointing_errors_gaintable_rsexecute_workflow(future_bvis_list, original_components,
-                                                                     sub_vp_list=future_vp_list,
-                                                                     use_radec=use_radec,
-                                                                     time_series=time_series,
-                                                                     time_series_type=scenario,
-                                                                     seeds=seeds,
-                                                                     show=show, basename=basename)
+            # Now make all the residual images
+            with timer.stage('residual'):
+                residual_vis_list = \
+                    calculate_residual_visibility_rsexecute_workflow(future_bvis_list, original_components,
+                                                                     no_error_gtl, error_gtl,
+                                                                     component_group=component_group,
+                                                                     no_error_vis_list=future_no_error_vis_list)
+                residual_vis_list = persist_chunks(residual_vis_list, todo)
         
-        # Now make all the residual images
-        vis_comp_chunk_dirty_list = \
-            calculate_residual_from_gaintables_rsexecute_workflow(future_bvis_list, original_components,
-                                                                   future_model_list,
-                                                                   no_error_gtl, error_gtl)
+        with timer.stage('invert'):
+            vis_comp_chunk_dirty_list = invert_list_rsexecute_workflow(residual_vis_list,
+                                                                       [future_model for _ in residual_vis_list],
+                                                                       '2d')
+            vis_comp_chunk_dirty_list = persist_chunks(vis_comp_chunk_dirty_list, todo)
+            del residual_vis_list
         
-        # Add the resulting images
-        error_dirty_list = sum_invert_results_rsexecute(vis_comp_chunk_dirty_list)
+        if single_graph and checkpoint is None:
+            error_dirty_list = sum_invert_results_rsexecute(vis_comp_chunk_dirty_list)
+            deferred_summaries.append(rsexecute.execute(summarise_dirty_image)(error_dirty_list))
+            result.update(timer.columns(stages))
+            deferred_results.append(result)
+            del error_dirty_list
+            continue
         
-        # Actually compute the graph assembled above
-        error_dirty, sumwt = rsexecute.compute(error_dirty_list, sync=True)
+        with timer.stage('sum'):
+            if checkpoint is not None:
+                # Compute and save the image for each chunk separately so that an interrupted scenario restarts
+                # from the chunks not yet done
+                chunk_dirty_list = compute_chunks_with_checkpoint(vis_comp_chunk_dirty_list, checkpoint,
+                                                                  str(scenario))
+                error_dirty, sumwt = sum_invert_results(chunk_dirty_list)
+                del chunk_dirty_list
+                checkpoint.save_product(str(scenario), 'residual', (error_dirty, sumwt))
+            else:
+                # Add the resulting images
+                error_dirty_list = sum_invert_results_rsexecute(vis_comp_chunk_dirty_list)
+                
+                # Actually compute the graph assembled above
+                error_dirty, sumwt = rsexecute.compute(error_dirty_list, sync=True)
+                del error_dirty_list
         print("Dirty image sumwt", sumwt)
-        del error_dirty_list
         print(qa_image(error_dirty))
         
         if show:
@@ -446,21 +945,28 @@ if __name__ == '__main__':
             plt.savefig('residual_image.png')
             plt.show(block=False)
         
-        qa = qa_image(error_dirty)
-        _, _, ny, nx = error_dirty.shape
-        for field in ['maxabs', 'rms', 'medianabs']:
-            result["onsource_" + field] = qa.data[field]
-        result['onsource_abscentral'] = numpy.abs(error_dirty.data[0, 0, ny // 2, nx // 2])
-        
-        qa_psf = qa_image(psf)
-        _, _, ny, nx = psf.shape
-        for field in ['maxabs', 'rms', 'medianabs']:
-            result["psf_" + field] = qa_psf.data[field]
+        summary = summarise_dirty_image((error_dirty, sumwt))
+        finish_result(result, summary)
+        result.update(timer.columns(stages))
         
-        result['elapsed_time'] = time.time() - time_started
-        print('Elapsed time = %.1f (s)' % result['elapsed_time'])
+        if checkpoint is not None:
+            checkpoint.save_product(str(scenario), 'qa', summary)
+            checkpoint.save_result(str(scenario), result)
         
         results.append(result)
+        write_results(results)
+    
+    if len(deferred_results) > 0:
+        print("Computing the residual images of all scenarios in one graph")
+        with timer.stage('sum'):
+            summaries = rsexecute.compute(deferred_summaries, sync=True)
+        for result, summary in zip(deferred_results, summaries):
+            print("Dirty image sumwt", summary['sumwt'])
+            finish_result(result, summary)
+            # The summation is shared by all scenarios
+            result.update(timer.columns(['sum']))
+            results.append(result)
+        write_results(results)
     
     pp.pprint(results)
     
@@ -471,13 +977,10 @@ if __name__ == '__main__':
     for result in results:
         result["processing_rate"] = processing_rate
     
-    with open(filename, 'a') as csvfile:
-        writer = csv.DictWriter(csvfile, fieldnames=results[0].keys(), delimiter=',', quotechar='|',
-                                quoting=csv.QUOTE_MINIMAL)
-        writer.writeheader()
-        for result in results:
-            writer.writerow(result)
-        csvfile.close()
+    write_results(results)
+    
+    if trace_file != '':
+        timer.write_chrome_trace(trace_file)
     
     if time_series == '':
         title = '%s, %.3f GHz, %d times: dynamic %g, static %g, %g \n%s %s %s' % \
@@ -0,0 +1,126 @@
+"""Tests of the antenna-factorized DFT against a direct sum over baselines and components"""
+
+import numpy
+from astropy import constants
+
+from mid_pointing.dft import dft_factorized, dft_factorized_jones
+
+NTIMES, NANT, NCHAN, NCOMP = 3, 5, 2, 4
+FREQUENCY = numpy.array([1.0e9, 1.2e9])
+
+
+def random_setup(npol, seed=180):
+    """ Antenna vectors, direction cosines and fluxes of a small random observation """
+    rng = numpy.random.default_rng(seed)
+    antenna_uvw = rng.normal(scale=500.0, size=(NTIMES, NANT, 3))
+    lm = rng.uniform(-0.02, 0.02, size=(NCOMP, 2))
+    direction_cosines = numpy.column_stack([lm, numpy.sqrt(1.0 - numpy.sum(lm ** 2, axis=1)) - 1.0])
+    flux = rng.uniform(0.5, 2.0, size=(NCOMP, NCHAN, npol))
+    return rng, antenna_uvw, direction_cosines, flux
+
+
+def random_complex(rng, shape):
+    """ Complex gains scattered about unity """
+    return rng.normal(1.0, 0.1, size=shape) + 1j * rng.normal(0.0, 0.1, size=shape)
+
+
+def baseline_phasor(antenna_uvw, direction_cosines, itime, i, j, ichan, icomp):
+    """ exp(-2 pi i k u_ij . s_c) of the baseline u_ij = p_j - p_i """
+    k = FREQUENCY[ichan] / constants.c.to('m s^-1').value
+    uvw = antenna_uvw[itime, j] - antenna_uvw[itime, i]
+    return numpy.exp(-2j * numpy.pi * k * numpy.dot(uvw, direction_cosines[icomp]))
+
+
+def direct_vis(antenna_uvw, direction_cosines, flux, gains):
+    """ V_ij = sum_c g_ic conj(g_jc) S_c exp(-2 pi i k u_ij . s_c), one baseline at a time """
+    vis = numpy.zeros([NTIMES, NANT, NANT, NCHAN, flux.shape[-1]], dtype='complex')
+    for itime in range(NTIMES):
+        for i in range(NANT):
+            for j in range(NANT):
+                for ichan in range(NCHAN):
+                    for icomp in range(NCOMP):
+                        g = gains[itime, i, ichan, icomp] * numpy.conjugate(gains[itime, j, ichan, icomp])
+                        vis[itime, i, j, ichan] += g * flux[icomp, ichan] * \
+                            baseline_phasor(antenna_uvw, direction_cosines, itime, i, j, ichan, icomp)
+    return vis
+
+
+def test_dft_factorized():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=2)
+    gains = random_complex(rng, (NTIMES, NANT, NCHAN, NCOMP))
+    vis = dft_factorized(antenna_uvw, FREQUENCY, direction_cosines, flux, gains=gains)
+    numpy.testing.assert_allclose(vis, direct_vis(antenna_uvw, direction_cosines, flux, gains), rtol=0, atol=1e-10)
+
+
+def test_dft_factorized_unity_and_channel_independent_gains():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=1)
+    unity = numpy.ones([NTIMES, NANT, NCHAN, NCOMP])
+    numpy.testing.assert_allclose(dft_factorized(antenna_uvw, FREQUENCY, direction_cosines, flux),
+                                  direct_vis(antenna_uvw, direction_cosines, flux, unity), rtol=0, atol=1e-10)
+
+    gains = random_complex(rng, (NTIMES, NANT, NCOMP))
+    vis = dft_factorized(antenna_uvw, FREQUENCY, direction_cosines, flux, gains=gains)
+    expanded = numpy.repeat(gains[:, :, numpy.newaxis, :], NCHAN, axis=2)
+    numpy.testing.assert_allclose(vis, direct_vis(antenna_uvw, direction_cosines, flux, expanded), rtol=0,
+                                  atol=1e-10)
+
+
+def test_dft_factorized_difference():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=1)
+    gains = random_complex(rng, (NTIMES, NANT, NCHAN, NCOMP))
+    no_error_gains = random_complex(rng, (NTIMES, NANT, NCHAN, NCOMP))
+    vis = dft_factorized(antenna_uvw, FREQUENCY, direction_cosines, flux, gains=gains, no_error_gains=no_error_gains)
+    expected = direct_vis(antenna_uvw, direction_cosines, flux, gains) - \
+        direct_vis(antenna_uvw, direction_cosines, flux, no_error_gains)
+    numpy.testing.assert_allclose(vis, expected, rtol=0, atol=1e-10)
+
+
+def direct_jones_vis(antenna_uvw, direction_cosines, brightness, jones):
+    """ V_ij = sum_c J_ic B_c J_jc^H exp(-2 pi i k u_ij . s_c), one baseline at a time, as XX, XY, YX, YY """
+    vis = numpy.zeros([NTIMES, NANT, NANT, NCHAN, 4], dtype='complex')
+    for itime in range(NTIMES):
+        for i in range(NANT):
+            for j in range(NANT):
+                for ichan in range(NCHAN):
+                    for icomp in range(NCOMP):
+                        coherency = jones[itime, i, ichan, icomp] @ brightness[icomp, ichan] @ \
+                            numpy.conjugate(jones[itime, j, ichan, icomp]).T
+                        vis[itime, i, j, ichan] += coherency.ravel() * \
+                            baseline_phasor(antenna_uvw, direction_cosines, itime, i, j, ichan, icomp)
+    return vis
+
+
+def random_jones(rng):
+    """ Jones matrices scattered about the identity """
+    return numpy.identity(2) + 0.1 * random_complex(rng, (NTIMES, NANT, NCHAN, NCOMP, 2, 2))
+
+
+def test_dft_factorized_jones_linear():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=4)
+    flux = flux + 1j * rng.normal(scale=0.1, size=flux.shape)
+    jones = random_jones(rng)
+    vis = dft_factorized_jones(antenna_uvw, FREQUENCY, direction_cosines, flux, jones)
+    brightness = flux.reshape(NCOMP, NCHAN, 2, 2)
+    numpy.testing.assert_allclose(vis, direct_jones_vis(antenna_uvw, direction_cosines, brightness, jones), rtol=0,
+                                  atol=1e-10)
+
+
+def test_dft_factorized_jones_stokesI_difference():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=1)
+    jones = random_jones(rng)
+    no_error_jones = random_jones(rng)
+    vis = dft_factorized_jones(antenna_uvw, FREQUENCY, direction_cosines, flux, jones, no_error_jones=no_error_jones)
+    brightness = flux[..., numpy.newaxis] * numpy.identity(2)
+    expected = direct_jones_vis(antenna_uvw, direction_cosines, brightness, jones) - \
+        direct_jones_vis(antenna_uvw, direction_cosines, brightness, no_error_jones)
+    numpy.testing.assert_allclose(vis, expected, rtol=0, atol=1e-10)
+
+
+def test_dft_factorized_jones_matches_scalar():
+    rng, antenna_uvw, direction_cosines, flux = random_setup(npol=1)
+    gains = random_complex(rng, (NTIMES, NANT, NCHAN, NCOMP))
+    jones = gains[..., numpy.newaxis, numpy.newaxis] * numpy.identity(2)
+    vis = dft_factorized_jones(antenna_uvw, FREQUENCY, direction_cosines, flux, jones)
+    scalar = dft_factorized(antenna_uvw, FREQUENCY, direction_cosines, flux, gains=gains)
+    numpy.testing.assert_allclose(vis[..., [0, 3]], numpy.repeat(scalar, 2, axis=-1), rtol=0, atol=1e-10)
+    numpy.testing.assert_allclose(vis[..., [1, 2]], 0.0, rtol=0, atol=1e-10)
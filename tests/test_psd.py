@@ -0,0 +1,86 @@
+"""Tests of the synthesis of pointing error time series from PSDs"""
+
+import glob
+import os
+
+import numpy
+import pytest
+
+from mid_pointing.psd import read_psd, spatial_correlation, synthesize_time_series_slice, stream_time_series, \
+    simulate_pointingtable_from_psd
+
+FREQUENCY = numpy.logspace(-2, 2, 200)
+PSD = 1.0 / (1.0 + (FREQUENCY / 0.1) ** 2)
+
+
+class FakePointingTable:
+    """ The parts of a PointingTable used by simulate_pointingtable_from_psd """
+
+    def __init__(self, time, nant):
+        self.time = numpy.asarray(time, dtype='float')
+        self.interval = numpy.full(len(time), time[1] - time[0])
+        self.data = {'pointing': numpy.zeros([len(time), nant, 1, 1, 2])}
+        self.nominal = numpy.zeros([len(time), nant, 1, 1, 2])
+        self.nominal[..., 1] = numpy.deg2rad(45.0)
+
+    @property
+    def pointing(self):
+        return self.data['pointing']
+
+
+@pytest.fixture
+def pointing_directory(tmp_path, monkeypatch):
+    monkeypatch.setenv('MID_POINTING_PSD_CACHE', str(tmp_path / 'cache'))
+    directory = tmp_path / 'precision'
+    directory.mkdir()
+    table = numpy.stack([FREQUENCY] + [PSD] * 4, axis=-1)
+    numpy.savetxt(str(directory / 'El45Az0.dat'), table)
+    return str(tmp_path)
+
+
+def test_slices_join():
+    whole = synthesize_time_series_slice(FREQUENCY, PSD, 0, 3000, 1.0, 12345, nseries=2, key=(0, 1))
+    chunks = numpy.concatenate(list(stream_time_series(FREQUENCY, PSD, 3000, 1.0, 700, 12345, nseries=2,
+                                                       key=(0, 1))), axis=-1)
+    numpy.testing.assert_allclose(chunks, whole, rtol=0.0, atol=1e-12)
+
+
+def test_stream_before_transit(pointing_directory):
+    # Hour angles are negative before transit: the series is measured from the start of the observation
+    origin = -7200.0
+    times = origin + 2.0 * numpy.arange(2000)
+    whole = simulate_pointingtable_from_psd(FakePointingTable(times, 3), pointing_directory, seed=5, stream=True,
+                                            stream_origin=origin).pointing
+    first = simulate_pointingtable_from_psd(FakePointingTable(times[:900], 3), pointing_directory, seed=5,
+                                            stream=True, stream_origin=origin).pointing
+    second = simulate_pointingtable_from_psd(FakePointingTable(times[900:], 3), pointing_directory, seed=5,
+                                             stream=True, stream_origin=origin).pointing
+    numpy.testing.assert_allclose(numpy.concatenate([first, second]), whole, rtol=0.0, atol=1e-18)
+    assert numpy.std(whole) > 0.0
+
+
+def test_binary_cache_outside_source(pointing_directory, tmp_path):
+    filename = os.path.join(pointing_directory, 'precision', 'El45Az0.dat')
+    read_psd(filename)
+    assert os.listdir(os.path.join(pointing_directory, 'precision')) == ['El45Az0.dat']
+    assert len(glob.glob(str(tmp_path / 'cache' / '*' / 'El45Az0.dat.npz'))) == 1
+
+
+def test_spatial_correlation():
+    lag = numpy.array([0.0, 1.0, 2.0, 5.0, 20.0, 100.0, 1000.0])
+    correlation = spatial_correlation(10.0 * lag, FREQUENCY, PSD, wind_speed=10.0)
+    # The trapezoidal integral of the linearly interpolated PSD on a fine grid; the taper starts at a lag of 50 s
+    fine = numpy.linspace(FREQUENCY[0], FREQUENCY[-1], 2000001)
+    psd = numpy.interp(fine, FREQUENCY, PSD)
+    psd[[0, -1]] *= 0.5
+    expected = [numpy.sum(psd * numpy.cos(2.0 * numpy.pi * fine * tau)) / numpy.sum(psd) for tau in lag[:5]]
+    numpy.testing.assert_allclose(correlation[:5], expected, atol=1e-4)
+    numpy.testing.assert_array_equal(correlation[5:], 0.0)
+
+
+@pytest.mark.parametrize('integration_time, ntimes', [(1.0, 20000), (60.0, 2000), (600.0, 2000)])
+def test_streamed_variance(integration_time, ntimes):
+    # However coarse the sampling, the power above the Nyquist frequency is folded back and none is lost
+    series = synthesize_time_series_slice(FREQUENCY, PSD, 0, ntimes, integration_time, 2024, nseries=8, key=(0, 0))
+    expected = 0.1 * (numpy.arctan(FREQUENCY[-1] / 0.1) - numpy.arctan(FREQUENCY[0] / 0.1))
+    numpy.testing.assert_allclose(numpy.var(series), expected, rtol=0.05)
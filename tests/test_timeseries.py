@@ -0,0 +1,118 @@
+"""Tests of the packed store of time series: packing, slicing, padding and sampling"""
+
+import os
+
+import numpy
+
+from mid_pointing.timeseries import pack_time_series, PackedTimeSeries, get_packed_time_series, \
+    simulate_pointingtable_from_packed_time_series
+
+# The tracking axes are sampled more finely and for longer than the wind axes, as in pointing_error_models/out
+SAMPLING = {'az': (0.0, 2.5, 40), 'el': (0.0, 2.5, 40), 'pxel': (0.0, 10.0, 9), 'pel': (0.0, 10.0, 9)}
+POINTINGS = [(15.0, 0.0), (15.0, 90.0), (45.0, 0.0), (45.0, 90.0)]
+
+
+def write_time_series(directory, seed=180):
+    """ Write a time series file per pointing and axis, returning the series {(el, az, axis): [2, ntimes]} """
+    rng = numpy.random.default_rng(seed)
+    series = dict()
+    for el, az in POINTINGS:
+        for axis, (start, interval, ntimes) in SAMPLING.items():
+            data = numpy.stack([start + interval * numpy.arange(ntimes), rng.normal(size=ntimes)])
+            numpy.save(os.path.join(directory, 'El%dAz%d_time_series_%s.npy' % (el, az, axis)), data)
+            series[(el, az, axis)] = data
+    return series
+
+
+def test_pack_round_trip(tmp_path):
+    series = write_time_series(str(tmp_path))
+    pack_time_series(str(tmp_path))
+    store = PackedTimeSeries(str(tmp_path))
+    assert store.header['elevations'] == [15.0, 45.0]
+    assert store.header['azimuths'] == [0.0, 90.0]
+    assert store.axes == ['az', 'el', 'pxel', 'pel']
+    assert store.data.shape == (2, 2, 4, 40)
+
+    for (el, az, axis), data in series.items():
+        numpy.testing.assert_array_equal(store.times(axis), data[0])
+        numpy.testing.assert_array_equal(store.series(el, az, axis), data[1])
+
+    # The shorter wind axes are padded with NaN, which series does not return
+    iel, iaz = store.nearest(45.0, 90.0)
+    assert numpy.all(numpy.isnan(store.data[iel, iaz, store.axes.index('pel'), 9:]))
+    assert not numpy.any(numpy.isnan(store.data[iel, iaz, store.axes.index('az')]))
+    assert len(store.series(45.0, 90.0, 'pel', start_time=50.0, stop_time=1000.0)) == 4
+
+
+def test_series_slice_and_nearest(tmp_path):
+    series = write_time_series(str(tmp_path))
+    pack_time_series(str(tmp_path))
+    store = PackedTimeSeries(str(tmp_path))
+
+    # Inclusive of both ends, rounding inwards off the sample times
+    pel = store.series(44.0, 80.0, 'pel', start_time=20.0, stop_time=50.0)
+    numpy.testing.assert_array_equal(pel, series[(45.0, 90.0, 'pel')][1, 2:6])
+    az = store.series(20.0, -10.0, 'az', start_time=11.0, stop_time=19.0)
+    numpy.testing.assert_array_equal(az, series[(15.0, 0.0, 'az')][1, 5:8])
+    assert isinstance(az, numpy.memmap)
+
+    # An azimuth of 270 deg is folded onto 90 deg
+    assert store.nearest(45.0, 270.0) == store.nearest(45.0, 90.0)
+
+
+def test_sample_is_periodic(tmp_path):
+    series = write_time_series(str(tmp_path))
+    pack_time_series(str(tmp_path))
+    store = PackedTimeSeries(str(tmp_path))
+    values = series[(15.0, 90.0, 'pxel')][1]
+    assert store.period('pxel') == 90.0
+
+    numpy.testing.assert_allclose(store.sample(15.0, 90.0, 'pxel', [0.0, 10.0, 15.0]),
+                                  [values[0], values[1], 0.5 * (values[1] + values[2])])
+    # Across the end of the series, the last sample joins the first
+    times = numpy.arange(70.0, 300.0, 5.0)
+    expected = numpy.interp(times % 90.0, 10.0 * numpy.arange(10), numpy.append(values, values[0]))
+    numpy.testing.assert_allclose(store.sample(15.0, 90.0, 'pxel', times), expected)
+
+
+class FakePointingTable:
+    """ The part of a PointingTable filled by simulate_pointingtable_from_packed_time_series """
+
+    def __init__(self, time, nant, elevation=45.0, azimuth=90.0):
+        self.time = time
+        self.data = {'pointing': numpy.zeros([len(time), nant, 1, 1, 2])}
+        self.nominal = numpy.zeros([len(time), nant, 1, 1, 2])
+        self.nominal[...] = numpy.deg2rad([azimuth, elevation])
+
+    @property
+    def pointing(self):
+        return self.data['pointing']
+
+
+def test_simulate_pointingtable_joins_chunks(tmp_path):
+    write_time_series(str(tmp_path))
+    pack_time_series(str(tmp_path))
+    directory, condition = os.path.split(str(tmp_path))
+    assert get_packed_time_series(str(tmp_path)) is get_packed_time_series(str(tmp_path))
+
+    time = -3600.0 + 10.0 * numpy.arange(30)
+    whole = simulate_pointingtable_from_packed_time_series(FakePointingTable(time, 3), directory,
+                                                           time_series_type=condition, seed=2024,
+                                                           time_origin=-3600.0)
+    first = simulate_pointingtable_from_packed_time_series(FakePointingTable(time[:12], 3), directory,
+                                                           time_series_type=condition, seed=2024,
+                                                           time_origin=-3600.0)
+    second = simulate_pointingtable_from_packed_time_series(FakePointingTable(time[12:], 3), directory,
+                                                            time_series_type=condition, seed=2024,
+                                                            time_origin=-3600.0)
+    joined = numpy.concatenate([first.pointing, second.pointing])
+    numpy.testing.assert_allclose(joined, whole.pointing)
+    assert numpy.all(numpy.isfinite(whole.pointing))
+
+    # Each antenna and scenario starts at its own time in the series
+    pel = whole.pointing[:, :, 0, 0, 1]
+    assert not numpy.allclose(pel[:, 0], pel[:, 1])
+    other = simulate_pointingtable_from_packed_time_series(FakePointingTable(time, 3), directory,
+                                                           time_series_type=condition, seed=2024, scenario=1,
+                                                           time_origin=-3600.0)
+    assert not numpy.allclose(other.pointing, whole.pointing)
@@ -0,0 +1,81 @@
+"""Tests of the spline coefficient sampler of voltage patterns against RectBivariateSpline"""
+
+import numpy
+import pytest
+from scipy.interpolate import RectBivariateSpline
+
+from mid_pointing.vp_sampler import VoltagePatternSampler, get_vp_sampler
+
+NCHAN, NPOL, NY, NX = 2, 4, 24, 30
+
+
+class FakeVP:
+    """ The part of a voltage pattern image used by the sampler """
+
+    def __init__(self, data):
+        self.data = data
+
+
+def random_vp(seed=180):
+    """ A smooth complex voltage pattern with some noise """
+    rng = numpy.random.default_rng(seed)
+    y, x = numpy.meshgrid(numpy.arange(NY), numpy.arange(NX), indexing='ij')
+    r2 = ((x - NX / 2) / 8.0) ** 2 + ((y - NY / 2) / 6.0) ** 2
+    data = numpy.zeros([NCHAN, NPOL, NY, NX], dtype='complex')
+    for chan in range(NCHAN):
+        for pol in range(NPOL):
+            data[chan, pol] = numpy.exp(-(1.0 + chan) * r2) * numpy.exp(0.3j * pol * x / NX) + \
+                0.01 * (rng.normal(size=(NY, NX)) + 1j * rng.normal(size=(NY, NX)))
+    return FakeVP(data), rng
+
+
+def spline_values(vp, order, x, y):
+    """ Values of RectBivariateSpline fitted to the real and imaginary parts of each plane [npoints, nchan, npol] """
+    values = numpy.zeros([len(x), NCHAN, NPOL], dtype='complex')
+    for chan in range(NCHAN):
+        for pol in range(NPOL):
+            plane = vp.data[chan, pol]
+            real_spline = RectBivariateSpline(range(NY), range(NX), plane.real, kx=order, ky=order)
+            imag_spline = RectBivariateSpline(range(NY), range(NX), plane.imag, kx=order, ky=order)
+            values[:, chan, pol] = real_spline.ev(y, x) + 1j * imag_spline.ev(y, x)
+    return values
+
+
+@pytest.mark.parametrize('order', [1, 3])
+def test_sampler_matches_rect_bivariate_spline(order):
+    vp, rng = random_vp()
+    x = rng.uniform(2.5, NX - 3.5, size=500)
+    y = rng.uniform(2.5, NY - 3.5, size=500)
+    # Include the pixel centres, where the spline interpolates
+    x[:10] = numpy.arange(3, 13)
+    y[:10] = 5.0
+    sampler = VoltagePatternSampler(vp, order=order)
+    values = sampler.sample(numpy.stack([x, y], axis=-1), block_size=64)
+    numpy.testing.assert_allclose(values, spline_values(vp, order, x, y), rtol=0, atol=1e-10)
+    numpy.testing.assert_allclose(values[:10, 0, 0], vp.data[0, 0, 5, 3:13], rtol=0, atol=1e-10)
+
+
+def test_sampler_polarisations_shape_and_edges():
+    vp, rng = random_vp()
+    locations = numpy.stack([rng.uniform(0, NX - 1, size=(7, 9)), rng.uniform(0, NY - 1, size=(7, 9))], axis=-1)
+    locations[0, 0] = [1.5, NY / 2]
+    locations[0, 1] = [NX / 2, NY - 2.5]
+    sampler = VoltagePatternSampler(vp, polarisations=[0, 3])
+    values = sampler.sample(locations)
+    assert values.shape == (7, 9, NCHAN, 2)
+
+    x, y = locations[..., 0].ravel(), locations[..., 1].ravel()
+    inside = (x > 2) & (x < NX - 3) & (y > 2) & (y < NY - 3)
+    assert not inside[0] and not inside[1]
+    flat = values.reshape(-1, NCHAN, 2)
+    assert numpy.all(flat[~inside] == 0.0)
+    expected = spline_values(vp, 3, x[inside], y[inside])[..., [0, 3]]
+    numpy.testing.assert_allclose(flat[inside], expected, rtol=0, atol=1e-10)
+
+
+def test_get_vp_sampler_reuses_by_contents():
+    vp, _ = random_vp()
+    sampler = get_vp_sampler(vp)
+    assert get_vp_sampler(FakeVP(vp.data.copy())) is sampler
+    assert get_vp_sampler(vp, polarisations=[0]) is not sampler
+    assert get_vp_sampler(FakeVP(2.0 * vp.data)) is not sampler